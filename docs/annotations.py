@@ -0,0 +1,307 @@
+#!/usr/bin/python3
+'''
+An indexed annotation store for the /__annotations endpoint of ssi_server.py.
+
+Charts with tens of thousands of markers (deploys, incidents) should not
+pass them all to setAnnotations(). The server keeps them indexed instead
+and answers, for the visible x range, only the annotations of the
+requested series that intersect it, thinned so that markers are at least
+a given number of pixels apart on a chart of the given width, and capped.
+
+Annotations are loaded in bulk from a JSON file holding an array of
+annotation objects, as setAnnotations() takes them, or from a CSV file
+whose header names their properties:
+
+  series,x,shortText,text
+  Y,2020/01/05,D,Deploy 1.2.3
+
+Besides the annotation properties dygraphs knows, an annotation may have
+an end, making it an interval [x, end] (e.g. an incident), which matches
+any range it overlaps. x and end are numbers, or dates, which are turned
+into milliseconds as Dygraph uses them for date axes.
+
+Per series, point annotations are sorted by x, and intervals are sorted by
+x in buckets of spans within a factor of two, the longest of which bounds
+how far before a range one of the bucket may start. A long interval thus
+widens the search of its own bucket only, and a query is a few bisections
+and a scan of about the matches.
+
+Usage:
+
+  python3 annotations.py --test
+  python3 annotations.py --generate N output.csv
+
+--generate writes N random markers for the series S0 and S1 of
+/__gen?dates=1&rows=100000&series=2, for tests/annotations-server.html.
+'''
+
+import array
+import bisect
+import csv
+import io
+import json
+import math
+import os
+import sys
+
+import colstore
+
+class Error(Exception):
+  pass
+
+# properties read from CSV as numbers or booleans; the rest are strings
+_int_fields = ('width', 'height', 'tickHeight', 'tickWidth')
+_bool_fields = ('attachAtBottom',)
+
+def _parse_x(value, what):
+  """Returns (x, is_date) for a number or a date string."""
+  if isinstance(value, (int, float)) and not isinstance(value, bool):
+    return float(value), False
+  if isinstance(value, str):
+    x = colstore.parse_float(value)
+    if colstore.is_date(value):
+      x = colstore.parse_date(value)
+      if not math.isnan(x):
+        return x, True
+    elif not math.isnan(x):
+      return x, False
+  raise Error('%s: bad x value %r' % (what, value))
+
+def _from_csv(text):
+  out = []
+  for row in csv.DictReader(io.StringIO(text)):
+    annotation = {}
+    for key, value in row.items():
+      if key is None or value is None or value == '':
+        continue
+      if key in _int_fields:
+        try:
+          value = int(value)
+        except ValueError:
+          raise Error('%s: not an integer: %r' % (key, value))
+      elif key in _bool_fields:
+        value = value.lower() in ('1', 'true', 'yes')
+      annotation[key] = value
+    out.append(annotation)
+  return out
+
+class _Series(object):
+  """The annotations of one series, sorted by x.
+
+  Points and intervals are indexed apart: points by x, intervals by x in
+  buckets of spans [2**(e - 1), 2**e).
+  """
+
+  def __init__(self, annotations):
+    annotations.sort(key=lambda a: a['x'])
+    self.items = annotations
+    self.x = array.array('d', (a['x'] for a in annotations))
+    points = array.array('l')
+    buckets = {}
+    for i, a in enumerate(annotations):
+      span = a.get('end', a['x']) - a['x']
+      if span == 0:
+        points.append(i)
+      else:
+        buckets.setdefault(math.frexp(span)[1], array.array('l')).append(i)
+    self._points = (array.array('d', (self.x[i] for i in points)), points)
+    self._intervals = []
+    for e, indices in sorted(buckets.items()):
+      self._intervals.append((math.ldexp(1, e),
+          array.array('d', (self.x[i] for i in indices)),
+          array.array('d', (annotations[i]['end'] for i in indices)),
+          indices))
+
+  def query(self, x0, x1):
+    """Returns the indices of the annotations overlapping [x0, x1], by x."""
+    if x0 is None and x1 is None:
+      return range(len(self.items))
+    xs, indices = self._points
+    lo = 0 if x0 is None else bisect.bisect_left(xs, x0)
+    hi = len(xs) if x1 is None else bisect.bisect_right(xs, x1)
+    out = indices[lo:hi].tolist()
+    for max_span, xs, ends, indices in self._intervals:
+      lo = 0 if x0 is None else bisect.bisect_left(xs, x0 - max_span)
+      hi = len(xs) if x1 is None else bisect.bisect_right(xs, x1)
+      out.extend(indices[i] for i in range(lo, hi)
+          if x0 is None or ends[i] >= x0)
+    if self._intervals:
+      out.sort()
+    return out
+
+class Index(object):
+  """The annotations of one file, indexed per series by x."""
+
+  def __init__(self, annotations):
+    if not isinstance(annotations, list):
+      raise Error('annotations must be an array of objects')
+    by_series = {}
+    dates = set()
+    for i, a in enumerate(annotations):
+      if not isinstance(a, dict):
+        raise Error('annotation %d is not an object' % i)
+      if not isinstance(a.get('series'), str) or not a['series']:
+        raise Error('annotation %d has no series' % i)
+      a = dict(a)
+      a['x'], is_date = _parse_x(a.get('x'), 'annotation %d' % i)
+      dates.add(is_date)
+      if 'end' in a:
+        a['end'], is_date = _parse_x(a['end'], 'annotation %d' % i)
+        if a['end'] < a['x']:
+          raise Error('annotation %d ends before it starts' % i)
+      by_series.setdefault(a['series'], []).append(a)
+    self.is_date = True in dates
+    self._series = dict((name, _Series(items)) for name, items in
+        by_series.items())
+    self._count = len(annotations)
+
+  @classmethod
+  def load(cls, path):
+    """Reads a .json or .csv file of annotations."""
+    with open(path, 'r', encoding='UTF-8') as f:
+      text = f.read()
+    if path.endswith('.csv'):
+      return cls(_from_csv(text))
+    try:
+      return cls(json.loads(text))
+    except ValueError as e:
+      raise Error('%s: %s' % (os.path.basename(path), e))
+
+  @property
+  def nbytes(self):
+    """Approximate memory use in bytes, for cache accounting."""
+    return self._count * 512
+
+  @property
+  def series(self):
+    return sorted(self._series)
+
+  def parse_x(self, s):
+    """Parses a query bound: a number, or a date if x values were dates."""
+    return colstore.parse_bound(s, self.is_date)
+
+  def query(self, x0=None, x1=None, series=None, width=None, spacing=16,
+      limit=100):
+    """Returns (annotations, number matching before thinning).
+
+    The annotations of the given series (default all) overlapping [x0, x1]
+    are thinned so that, on a chart width pixels wide showing [x0, x1],
+    those kept of each series are at least spacing pixels apart; at most
+    limit are returned, evenly spread over the matches, sorted by x.
+    """
+    names = self.series if series is None else [s for s in series
+        if s in self._series]
+    cell = None
+    if width and x0 is not None and x1 is not None and x1 > x0:
+      cell = (x1 - x0) * spacing / float(width)
+    matching = 0
+    kept = []
+    for name in names:
+      s = self._series[name]
+      indices = s.query(x0, x1)
+      matching += len(indices)
+      last = -math.inf
+      for i in indices:
+        x = s.x[i] if x0 is None else max(s.x[i], x0)
+        if cell is not None and x - last < cell:
+          continue
+        last = x
+        kept.append(s.items[i])
+    kept.sort(key=lambda a: a['x'])
+    if len(kept) > limit:
+      kept = [kept[i * len(kept) // limit] for i in range(limit)]
+    return kept, matching
+
+def _selftest():
+  import random
+
+  rv = 0
+  def check(what, ok):
+    nonlocal rv
+    if not ok:
+      print('FAIL: %s' % what)
+      rv = 1
+
+  rng = random.Random(1)
+  items = []
+  for i in range(5000):
+    a = {'series': rng.choice('ABC'), 'x': rng.uniform(0, 1000),
+        'shortText': str(i)}
+    if rng.random() < 0.1:
+      a['end'] = a['x'] + rng.uniform(0, 50)
+    items.append(a)
+  index = Index(items)
+  for x0, x1, series in ((None, None, None), (100, 200, None),
+      (500, 501, ['A']), (-10, 0, ['B', 'C']), (990, None, ['C', 'D'])):
+    got, matching = index.query(x0, x1, series, limit=len(items))
+    want = [a for a in items if (series is None or a['series'] in series)
+        and (x1 is None or a['x'] <= x1) and
+        (x0 is None or a.get('end', a['x']) >= x0)]
+    check('%s-%s %s: matching' % (x0, x1, series), matching == len(want))
+    check('%s-%s %s: annotations' % (x0, x1, series),
+        sorted(a['shortText'] for a in got) ==
+        sorted(a['shortText'] for a in want))
+  got, matching = index.query(0, 1000, ['A'], width=500, spacing=20)
+  xs = [max(a['x'], 0) for a in got]
+  check('thinned to the spacing', all(q - p >= 40 for p, q in zip(xs, xs[1:])))
+  check('thinned', 0 < len(got) <= 25 and matching > 1000)
+  got, _ = index.query(limit=30)
+  check('capped', len(got) == 30 and got == sorted(got, key=lambda a: a['x']))
+
+  # one interval over everything must not make queries scan all the points
+  items = [{'series': 'A', 'x': float(i), 'shortText': str(i)}
+      for i in range(100000)]
+  items.append({'series': 'A', 'x': -1, 'end': 1e6, 'shortText': 'wide'})
+  series = Index(items)._series['A']
+  check('points apart', len(series._points[1]) == 100000 and
+      [len(b[3]) for b in series._intervals] == [1])
+  got = series.query(5000, 5002.5)
+  check('wide interval', [series.items[i]['shortText'] for i in got] ==
+      ['wide', '5000', '5001', '5002'])
+  check('after the points', [series.items[i]['shortText']
+      for i in series.query(2e5, None)] == ['wide'])
+
+  dated = Index(_from_csv('series,x,shortText,width,attachAtBottom\n'
+      'Y,2020/01/05,D,20,1\nY,2020/01/01 12:00,E,,\n'))
+  check('dates', dated.is_date and dated.parse_x('2020/01/02') ==
+      colstore.parse_date('2020/01/02'))
+  got, _ = dated.query(dated.parse_x('2020/01/02'), None)
+  check('csv', got == [{'series': 'Y', 'x': colstore.parse_date('2020/01/05'),
+      'shortText': 'D', 'width': 20, 'attachAtBottom': True}])
+  for bad in ([{'x': 1}], [{'series': 'Y', 'x': 'soon'}], {'a': 1},
+      [{'series': 'Y', 'x': 2, 'end': 1}]):
+    try:
+      Index(bad)
+      check('rejects %r' % bad, False)
+    except Error:
+      pass
+  print('test finished')
+  return rv
+
+def _generate(n, path, rows=100000):
+  """Writes n markers on the minutes of the data made by datagen.py."""
+  import random
+  import time
+
+  import datagen
+
+  rng = random.Random(1)
+  with open(path, 'w', encoding='UTF-8', newline='') as f:
+    out = csv.writer(f, lineterminator='\n')
+    out.writerow(['series', 'x', 'shortText', 'text'])
+    for i in sorted(rng.randrange(rows) for _ in range(n)):
+      x = time.strftime('%Y/%m/%d %H:%M:%S',
+          time.localtime(datagen._start + 60 * i))
+      kind = rng.choice(('D', 'I'))
+      out.writerow([rng.choice(('S0', 'S1')), x, kind, '%s %d' % (
+          'Deploy' if kind == 'D' else 'Incident', i)])
+
+if __name__ == '__main__':
+  if sys.argv[1:] == ['--test']:
+    sys.exit(_selftest())
+  if len(sys.argv) == 4 and sys.argv[1] == '--generate':
+    _generate(int(sys.argv[2]), sys.argv[3])
+    sys.exit(0)
+  sys.stderr.write('E: syntax: python3 annotations.py --test\n'
+      '   or: python3 annotations.py --generate N output.csv\n')
+  sys.exit(1)
@@ -0,0 +1,376 @@
+#!/usr/bin/python3
+'''
+Release archives served as directory trees by ssi_server.py --mount.
+
+An Archive maps member names to where their bytes are, so that a member
+is served without extracting anything:
+
+- entries stored uncompressed (members of a plain .tar, stored entries of
+  a .zip) are byte ranges of the archive file, sent with sendfile(2);
+- deflated .zip entries are inflated on their own;
+- members of a .tar.gz/.tgz are read by resuming the inflation from the
+  nearest of the checkpoints (copies of the zlib state) taken every
+  _checkpoint_span bytes while indexing, so reading one costs at most
+  that much inflating, not a pass over the whole archive;
+- members of .tar.bz2 and .tar.xz are read sequentially, as those
+  decompressors cannot be resumed.
+
+The index is built on first use, in one pass over the archive. When all
+members share a top-level directory (package/ in an npm tarball,
+dygraphs-X.Y.Z/ in a source tarball), it is left out of the names.
+
+Usage:
+
+  python3 archives.py --test
+  python3 archives.py ARCHIVE [MEMBER]
+
+lists the members of an archive, or writes one to standard output.
+'''
+
+import bisect
+import os
+import posixpath
+import re
+import struct
+import sys
+import tarfile
+import zipfile
+import zlib
+
+import ssi
+
+class Error(Exception):
+  pass
+
+_STORED = 0   # (kind, offset in the archive file, size)
+_ZIPPED = 1   # (kind, name in the zip file, size)
+_INFLATE = 2  # (kind, offset in the inflated tar, size)
+_STREAM = 3   # (kind, offset in the decompressed tar, size)
+
+_checkpoint_span = 2 << 20
+_read_size = 1 << 16
+_version = re.compile(
+    r'(\d+\.\d+(?:\.\d+)?(?:[-.\w]*?))(?:\.orig)?\.(?:tar(?:\.\w+)?|tgz|zip)$')
+
+def version_of(path):
+  """Guesses the version from an archive's name, e.g. dygraphs-2.2.1.tgz."""
+  m = _version.search(os.path.basename(path))
+  return m.group(1) if m else None
+
+def _stamp(path):
+  st = os.stat(path)
+  return (st.st_mtime_ns, st.st_size)
+
+class _Inflater(object):
+  """A forward-only file over a gzip stream, taking zlib checkpoints.
+
+  checkpoints gets (inflated offset, compressed offset, decompressor)
+  every _checkpoint_span inflated bytes; concatenated gzip members are
+  followed.
+  """
+
+  def __init__(self, f, checkpoints=None, start=None):
+    self._f = f
+    self._checkpoints = checkpoints
+    if start is None:
+      self._d = zlib.decompressobj(31)
+      self.out_pos = 0
+      self._in_pos = 0
+    else:
+      self.out_pos, self._in_pos, d = start
+      self._d = d.copy()
+      f.seek(self._in_pos)
+    self._buf = b''
+    self._last = self.out_pos
+
+  def _fill(self):
+    data = self._f.read(_read_size)
+    if not data:
+      return False
+    self._in_pos += len(data)
+    out = []
+    while data:
+      out.append(self._d.decompress(data))
+      if not self._d.eof:
+        break
+      data = self._d.unused_data
+      self._d = zlib.decompressobj(31)
+    self._buf += b''.join(out)
+    end = self.out_pos + len(self._buf)
+    if self._checkpoints is not None and end - self._last >= _checkpoint_span:
+      self._checkpoints.append((end, self._in_pos, self._d.copy()))
+      self._last = end
+    return True
+
+  def read(self, n=-1):
+    while n < 0 or len(self._buf) < n:
+      if not self._fill():
+        break
+    if n < 0:
+      n = len(self._buf)
+    out, self._buf = self._buf[:n], self._buf[n:]
+    self.out_pos += len(out)
+    return out
+
+  def skip(self, n):
+    while n > 0:
+      if not self._buf and not self._fill():
+        break
+      k = min(n, len(self._buf))
+      self._buf = self._buf[k:]
+      self.out_pos += k
+      n -= k
+
+class Archive(object):
+  """The member index of a .zip or (compressed) .tar file."""
+
+  def __init__(self, path):
+    self.path = path
+    self.stamp = _stamp(path)
+    self._members = {}
+    self._dirs = set([''])
+    self._checkpoints = []
+    self._templates = {}
+    with open(path, 'rb') as f:
+      magic = f.read(262)
+      # a zip's end record can also be found near the end of a tar whose
+      # last member is a zip, so look for the other signatures first
+      is_zip = magic[:2] != b'\x1f\x8b' and magic[:3] != b'BZh' and \
+          magic[:6] != b'\xfd7zXZ\x00' and magic[257:262] != b'ustar' and \
+          zipfile.is_zipfile(f)
+      f.seek(0)
+      if is_zip:
+        self.kind = 'zip'
+        self._index_zip(f)
+      elif magic[:2] == b'\x1f\x8b':
+        self.kind = 'tar.gz'
+        self._index_tar(_Inflater(f, self._checkpoints), _INFLATE)
+      elif magic[:3] == b'BZh' or magic[:6] == b'\xfd7zXZ\x00':
+        self.kind = 'tar.bz2' if magic[:3] == b'BZh' else 'tar.xz'
+        with tarfile.open(path, 'r:*') as tar:
+          self._index_members(tar, _STREAM)
+      else:
+        self.kind = 'tar'
+        self._index_tar(f, _STORED)
+    self._checkpoint_at = [c[0] for c in self._checkpoints]
+    self._strip_prefix()
+
+  def _index_zip(self, f):
+    with zipfile.ZipFile(f) as z:
+      for info in z.infolist():
+        if info.is_dir():
+          self._dirs.add(info.filename.rstrip('/'))
+          continue
+        if info.compress_type == zipfile.ZIP_STORED and not \
+            info.flag_bits & 1:
+          f.seek(info.header_offset)
+          header = f.read(30)
+          if header[:4] != b'PK\x03\x04':
+            raise Error('%s: bad local header for %s' % (self.path,
+                info.filename))
+          name_len, extra_len = struct.unpack('<HH', header[26:30])
+          entry = (_STORED, info.header_offset + 30 + name_len + extra_len,
+              info.file_size)
+        else:
+          entry = (_ZIPPED, info.filename, info.file_size)
+        self._add(info.filename, entry)
+
+  def _index_tar(self, fileobj, kind):
+    try:
+      with tarfile.open(fileobj=fileobj, mode='r|') as tar:
+        self._index_members(tar, kind)
+    except (tarfile.TarError, zlib.error, EOFError) as e:
+      raise Error('%s: %s' % (self.path, e))
+
+  def _index_members(self, tar, kind):
+    for member in tar:
+      if member.isdir():
+        self._dirs.add(member.name.rstrip('/'))
+      elif member.isreg() and not member.issparse():
+        self._add(member.name, (kind, member.offset_data, member.size))
+
+  def _add(self, name, entry):
+    name = posixpath.normpath(name.lstrip('/'))
+    if name.startswith('..') or name == '.':
+      return
+    self._members[name] = entry
+    parent = posixpath.dirname(name)
+    while parent not in self._dirs:
+      self._dirs.add(parent)
+      parent = posixpath.dirname(parent)
+
+  def _strip_prefix(self):
+    tops = set(name.split('/', 1)[0] for name in self._members)
+    if len(tops) != 1 or not all('/' in name for name in self._members):
+      return
+    cut = len(tops.pop()) + 1
+    self._members = dict((name[cut:], entry) for name, entry in
+        self._members.items())
+    self._dirs = set(d[cut:] for d in self._dirs if len(d) >= cut) | set([''])
+
+  def names(self):
+    return sorted(self._members)
+
+  def size(self, name):
+    """Returns the size of member name, or None if there is no such member."""
+    entry = self._members.get(name)
+    return None if entry is None else entry[2]
+
+  def is_dir(self, name):
+    return name.rstrip('/') in self._dirs
+
+  def stored(self, name):
+    """Returns (offset, size) if member name is a range of the archive."""
+    entry = self._members.get(name)
+    if entry is None or entry[0] != _STORED:
+      return None
+    return entry[1], entry[2]
+
+  def read(self, name):
+    """Returns the contents of member name."""
+    entry = self._members.get(name)
+    if entry is None:
+      raise FileNotFoundError(name)
+    kind, where, size = entry
+    if _stamp(self.path) != self.stamp:
+      raise Error('%s changed since it was indexed' % self.path)
+    with open(self.path, 'rb') as f:
+      if kind == _STORED:
+        f.seek(where)
+        return f.read(size)
+      if kind == _ZIPPED:
+        with zipfile.ZipFile(f) as z:
+          return z.read(where)
+      if kind == _INFLATE:
+        i = bisect.bisect_right(self._checkpoint_at, where) - 1
+        inflater = _Inflater(f, None, self._checkpoints[i] if i >= 0 else None)
+        inflater.skip(where - inflater.out_pos)
+        return inflater.read(size)
+      with tarfile.open(fileobj=f, mode='r:*') as tar:
+        stream = tar.fileobj
+        stream.seek(where)
+        return stream.read(size)
+
+  def templates(self, directory):
+    """Returns the SSI templates for pages in directory of the archive.
+
+    Their includes are members of the same directory, as in docs/.
+    """
+    templates = self._templates.get(directory)
+    if templates is None:
+      templates = ssi.Templates(
+          lambda p: self.read(posixpath.normpath(posixpath.join(directory,
+              p))), lambda p: self.stamp)
+      self._templates[directory] = templates
+    return templates
+
+  def render(self, name, errorfn):
+    """Returns the page member name with its SSI directives expanded."""
+    directory = posixpath.dirname(name)
+    return self.templates(directory).render(posixpath.basename(name), errorfn)
+
+def _selftest():
+  import random
+  import shutil
+  import tempfile
+
+  global _checkpoint_span
+  rv = 0
+  def check(what, ok):
+    nonlocal rv
+    if not ok:
+      print('FAIL: %s' % what)
+      rv = 1
+
+  _checkpoint_span = 1 << 16
+  rng = random.Random(1)
+  tmp = tempfile.mkdtemp()
+  files = {
+      'docs/header.html': b'<h1><!--#echo var="pagetitle" --></h1>\n',
+      'docs/index.html': b'<!--#set var="pagetitle" value="home" -->\n'
+          b'<!--#include virtual="header.html" -->body\n',
+      'dist/dygraph.js': b'var Dygraph;\n' * 5000,
+  }
+  for i in range(40):
+    files['data/%02d.bin' % i] = bytes(rng.getrandbits(8)
+        for _ in range(rng.randrange(1, 30000)))
+  root = os.path.join(tmp, 'package')
+  for name, data in files.items():
+    os.makedirs(os.path.dirname(os.path.join(root, name)), exist_ok=True)
+    with open(os.path.join(root, name), 'wb') as f:
+      f.write(data)
+  paths = []
+  for mode, suffix in ('w', '.tar'), ('w:gz', '.tgz'), ('w:bz2', '.tar.bz2'):
+    path = os.path.join(tmp, 'dygraphs-2.2.1' + suffix)
+    with tarfile.open(path, mode) as tar:
+      tar.add(root, 'package')
+    paths.append(path)
+  path = os.path.join(tmp, 'dygraphs-2.2.1.zip')
+  with zipfile.ZipFile(path, 'w') as z:
+    for i, (name, data) in enumerate(sorted(files.items())):
+      z.writestr(name, data, zipfile.ZIP_STORED if i % 2 else
+          zipfile.ZIP_DEFLATED)
+  paths.append(path)
+  # a tar ending in a zip is still a tar
+  inner = os.path.join(tmp, 'inner.zip')
+  with zipfile.ZipFile(inner, 'w') as z:
+    z.writestr('a.txt', b'inner')
+  tar_zip = os.path.join(tmp, 'dygraphs-1.0.0.tar')
+  with tarfile.open(tar_zip, 'w') as tar:
+    tar.add(root, 'package')
+    tar.add(inner, 'package/z.zip')
+  check('tar ending in a zip: is a zip', zipfile.is_zipfile(tar_zip))
+  archive = Archive(tar_zip)
+  check('tar ending in a zip', archive.kind == 'tar' and
+      archive.names() == sorted(list(files) + ['z.zip']))
+
+  for path in paths:
+    archive = Archive(path)
+    what = os.path.basename(path)
+    check('%s: version' % what, version_of(path) == '2.2.1')
+    check('%s: names' % what, archive.names() == sorted(files))
+    check('%s: contents' % what, all(archive.read(name) == data
+        for name, data in files.items()))
+    check('%s: dirs' % what, archive.is_dir('docs') and archive.is_dir('') and
+        not archive.is_dir('docs/index.html'))
+    stored = [(archive.stored(name), data) for name, data in files.items()
+        if archive.stored(name) is not None]
+    with open(path, 'rb') as f:
+      for (offset, size), data in stored:
+        f.seek(offset)
+        check('%s: stored range' % what, f.read(size) == data)
+    page = archive.render('docs/index.html', lambda msg, fn=None: None)
+    check('%s: ssi' % what, page == b'<h1>home</h1>\nbody\n')
+    if archive.kind == 'tar.gz':
+      check('checkpoints', len(archive._checkpoints) > 5)
+    if archive.kind in ('tar', 'zip'):
+      check('%s: stored members' % what, len(stored) > 10)
+  check('not an archive', _raises(Error, Archive, __file__))
+  shutil.rmtree(tmp)
+  print('test finished')
+  return rv
+
+def _raises(error, fn, *args):
+  try:
+    fn(*args)
+  except error:
+    return True
+  return False
+
+if __name__ == '__main__':
+  if sys.argv[1:] == ['--test']:
+    sys.exit(_selftest())
+  if len(sys.argv) not in (2, 3):
+    sys.stderr.write('E: syntax: python3 archives.py --test\n'
+        '   or: python3 archives.py ARCHIVE [MEMBER]\n')
+    sys.exit(1)
+  try:
+    archive = Archive(sys.argv[1])
+    if len(sys.argv) == 2:
+      for name in archive.names():
+        print('%10d %s' % (archive.size(name), name))
+    else:
+      sys.stdout.buffer.write(archive.read(sys.argv[2]))
+  except (Error, OSError) as e:
+    sys.stderr.write('E: %s\n' % e)
+    sys.exit(1)
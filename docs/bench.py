@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+'''
+Benchmark results for the /__bench endpoint of ssi_server.py.
+
+Benchmark pages (tests/benchmark-suite.html) POST one JSON record per run:
+
+  {"build": "2.2.1-abc1234", "page": "benchmark-suite",
+   "params": {"rows": 100000, "series": 4, ...},
+   "timings": {"construct": 812.5, "zoom": 40.1, ...}}
+
+Records are appended to a JSON lines file, with the time of arrival and
+the client's User-Agent added. GET /__bench returns them, filtered with
+build=, page= and any number of param.NAME=VALUE; GET /__bench?compare=A
+&compare=B returns the median of every timing per page and parameter set
+for each of the builds, to compare builds with.
+
+Usage:
+
+  python3 bench.py --test
+
+starts ssi_server.py on a free local port and checks /__gen and /__bench
+with a scripted client, no browser needed.
+'''
+
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+MAX_RECORD = 64 << 10
+
+class Error(Exception):
+  pass
+
+def _validate(record):
+  if not isinstance(record, dict):
+    raise Error('a record must be a JSON object')
+  for key in 'build', 'page':
+    if not isinstance(record.get(key), str) or not record[key]:
+      raise Error('%s must be a non-empty string' % key)
+  params = record.setdefault('params', {})
+  if not isinstance(params, dict) or not all(
+      isinstance(v, (str, int, float, bool)) for v in params.values()):
+    raise Error('params must be an object of plain values')
+  timings = record.get('timings')
+  if not isinstance(timings, dict) or not timings or not all(
+      isinstance(v, (int, float)) and not isinstance(v, bool)
+      for v in timings.values()):
+    raise Error('timings must be a non-empty object of numbers')
+
+def _params_key(params):
+  return json.dumps(params, sort_keys=True)
+
+class Results(object):
+  """A JSON lines file of benchmark records."""
+
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+
+  def add(self, record, user_agent=None):
+    """Validates and appends a record; returns it as stored."""
+    _validate(record)
+    record = dict(record, received=round(time.time(), 3))
+    if user_agent:
+      record['user_agent'] = user_agent
+    line = json.dumps(record, sort_keys=True) + '\n'
+    with self._lock:
+      with open(self.path, 'a', encoding='UTF-8') as f:
+        f.write(line)
+    return record
+
+  def records(self, build=None, page=None, params=None):
+    """Returns the stored records matching the given filters.
+
+    params maps parameter names to values as strings.
+    """
+    out = []
+    with self._lock:
+      try:
+        f = open(self.path, 'r', encoding='UTF-8')
+      except FileNotFoundError:
+        return out
+      with f:
+        lines = f.readlines()
+    for line in lines:
+      try:
+        record = json.loads(line)
+      except ValueError:
+        continue
+      if build is not None and record.get('build') != build:
+        continue
+      if page is not None and record.get('page') != page:
+        continue
+      if params and any(str(record['params'].get(k)) != v
+          for k, v in params.items()):
+        continue
+      out.append(record)
+    return out
+
+  def compare(self, builds, page=None):
+    """Returns {page: {params: {timing: {build: median}}}} for builds."""
+    out = {}
+    samples = {}
+    for build in builds:
+      for record in self.records(build, page):
+        key = (record['page'], _params_key(record['params']))
+        for name, value in record['timings'].items():
+          samples.setdefault(key + (name, build), []).append(value)
+    for (page, params, name, build), values in sorted(samples.items()):
+      out.setdefault(page, {}).setdefault(params, {}).setdefault(
+          name, {})[build] = statistics.median(values)
+    return out
+
+def _selftest():
+  import shutil
+  import tempfile
+  import urllib.error
+  import urllib.request
+
+  import colstore
+  import ssi_server
+
+  rv = 0
+  def check(what, ok):
+    nonlocal rv
+    if not ok:
+      print('FAIL: %s' % what)
+      rv = 1
+
+  class QuietHandler(ssi_server.SSIRequestHandler):
+    def log_message(self, *args):
+      pass
+
+  tmp = tempfile.mkdtemp()
+  # this module is __main__ here; the server uses the imported one
+  ssi_server._bench_results = ssi_server.bench.Results(
+      os.path.join(tmp, 'results.jsonl'))
+  server = ssi_server.SSIHTTPServer(('127.0.0.1', 0), QuietHandler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  base = 'http://127.0.0.1:%d' % server.server_address[1]
+
+  def get(path):
+    with urllib.request.urlopen(base + path) as r:
+      return r.read(), r.headers
+
+  def post(path, record):
+    req = urllib.request.Request(base + path, json.dumps(record).encode(
+        'UTF-8'), {'Content-Type': 'application/json'})
+    try:
+      with urllib.request.urlopen(req) as r:
+        return r.status, json.loads(r.read())
+    except urllib.error.HTTPError as e:
+      return e.code, None
+
+  # the generator, through the server, for every layout
+  for layout in ('plain', 'errorBars', 'customBars', 'fractions'):
+    data, headers = get('/__gen?rows=5000&series=3&gaps=0.1&dates=1&layout='
+        + layout)
+    store = colstore.ColumnStore(data, layout)
+    check('%s: rows' % layout, len(store.x) == 5000)
+    check('%s: labels' % layout, store.labels == ['Date', 'S0', 'S1', 'S2'])
+    check('%s: dates' % layout, store.is_date)
+    missing = sum(v != v for s in store.series for v in s) / 15000.0
+    check('%s: gaps %.3f' % (layout, missing), 0.08 < missing < 0.12)
+    again, _ = get('/__gen?rows=5000&series=3&gaps=0.1&dates=1&layout='
+        + layout)
+    check('%s: deterministic' % layout, again == data)
+  try:
+    get('/__gen?rows=100&series=1000')
+    check('too many series rejected', False)
+  except urllib.error.HTTPError as e:
+    check('too many series rejected', e.code == 400)
+
+  # the collector
+  for build, ms in ('a', 100), ('a', 120), ('a', 110), ('b', 90):
+    status, _ = post('/__bench', {'build': build, 'page': 'suite',
+        'params': {'rows': 1000}, 'timings': {'construct': ms}})
+    check('post accepted', status == 200)
+  status, _ = post('/__bench', {'build': 'a', 'timings': {}})
+  check('bad record rejected', status == 400)
+  records = json.loads(get('/__bench?build=a&param.rows=1000')[0])
+  check('filtered records', len(records) == 3 and
+      all(r['build'] == 'a' for r in records))
+  check('no records for other params',
+      json.loads(get('/__bench?param.rows=5')[0]) == [])
+  medians = json.loads(get('/__bench?compare=a&compare=b')[0])
+  check('compare', medians == {'suite': {'{"rows": 1000}': {
+      'construct': {'a': 110, 'b': 90}}}})
+
+  server.shutdown()
+  server.server_close()
+  shutil.rmtree(tmp)
+  print('test finished')
+  return rv
+
+if __name__ == '__main__':
+  if sys.argv[1:] == ['--test']:
+    sys.exit(_selftest())
+  sys.stderr.write('E: syntax: python3 bench.py --test\n')
+  sys.exit(1)
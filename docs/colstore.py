@@ -0,0 +1,466 @@
+'''
+Column store and downsampling for the /__data endpoint of ssi_server.py.
+
+A CSV file in the form Dygraph.prototype.parseCSV_ reads is parsed once
+into compact columns: the x value of every row (dates as milliseconds
+since the epoch, local time, as dygraphs uses them), the central value of
+every series and the byte range of the row in the file. An x-range is
+then found by bisection and reduced to about a target number of rows,
+either keeping the minimum and maximum of every series per x bucket or by
+Largest-Triangle-Three-Buckets on one series.
+
+Rows are selected, never synthesised: the output is the header line and
+the selected rows verbatim, so it is in exactly the format parseCSV_ was
+given, including the errorBars, customBars and fractions layouts.
+
+NumPy is used for the reductions when it is installed.
+
+Usage:
+
+  python3 colstore.py --test
+'''
+
+import array
+import bisect
+import datetime
+import math
+import re
+import sys
+import time
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+LAYOUTS = ('plain', 'errorBars', 'customBars', 'fractions')
+METHODS = ('minmax', 'lttb')
+
+_nan = float('nan')
+_number = re.compile(r'\s*[+-]?(?:Infinity|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)')
+_date = re.compile(r'\s*(\d{4})[-/](\d{1,2})[-/](\d{1,2})'
+    r'(?:[ T](\d{1,2}):(\d{2})(?::(\d{2})(?:\.(\d+))?)?)?\s*(Z)?\s*$')
+
+class Error(Exception):
+  pass
+
+def parse_float(s):
+  """Like JavaScript's parseFloat: parses a numeric prefix, else NaN."""
+  try:
+    return float(s)
+  except ValueError:
+    pass
+  m = _number.match(s)
+  if m is None:
+    return _nan
+  return float(m.group(0).replace('Infinity', 'inf'))
+
+def is_date(s):
+  """Dygraph.prototype.detectTypeFromString_."""
+  dash = s.find('-')
+  return ((dash > 0 and s[dash - 1] not in 'eE') or '/' in s or
+      math.isnan(parse_float(s)))
+
+def parse_date(s):
+  """Returns milliseconds since the epoch for the usual date formats.
+
+  Dates without a zone are local time, as utils.dateParser treats them.
+  """
+  m = _date.match(s)
+  if m is None:
+    return _nan
+  y, mo, d, h, mi, sec, frac, utc = m.groups()
+  fields = (int(y), int(mo), int(d), int(h or 0), int(mi or 0), int(sec or 0))
+  ms = int((frac or '0')[:3].ljust(3, '0'))
+  try:
+    if utc:
+      t = datetime.datetime(*fields, tzinfo=datetime.timezone.utc).timestamp()
+    else:
+      # mktime would take 2020/13/05 for 2021/01/05
+      datetime.datetime(*fields)
+      t = time.mktime(fields + (0, 0, -1))
+  except (ValueError, OverflowError):
+    return _nan
+  return t * 1000 + ms
+
+def _center(layout):
+  """Returns a function extracting the central values from a row's fields."""
+  if layout == 'errorBars':
+    return lambda fields: [parse_float(v) for v in fields[::2]]
+  if layout == 'customBars':
+    def center(fields):
+      out = []
+      for v in fields:
+        parts = v.split(';')
+        out.append(parse_float(parts[1]) if len(parts) == 3 else _nan)
+      return out
+    return center
+  if layout == 'fractions':
+    def center(fields):
+      out = []
+      for v in fields:
+        num, _, den = v.partition('/')
+        num = parse_float(num)
+        den = parse_float(den)
+        out.append(num / den if den else _nan)
+      return out
+    return center
+  return lambda fields: [parse_float(v) for v in fields]
+
+def _line_delimiter(data):
+  """utils.detectLineDelimiter, on bytes."""
+  for i, c in enumerate(data[:1 << 16]):
+    if c == 13:
+      return b'\r\n' if data[i + 1:i + 2] == b'\n' else b'\r'
+    if c == 10:
+      return b'\n\r' if data[i + 1:i + 2] == b'\r' else b'\n'
+  return b'\n'
+
+def parse_bound(s, dates):
+  """Parses a query bound: a number, or a date if x values are dates."""
+  x = parse_float(s)
+  if dates and (math.isnan(x) or is_date(s)):
+    x = parse_date(s)
+  return x
+
+def format_number(v):
+  """Formats a number for JSON: integers without .0; null if not finite."""
+  if not math.isfinite(v):
+    return 'null'
+  return repr(int(v)) if v.is_integer() and abs(v) < 1e16 else repr(v)
+
+def format_date(ms):
+  """Formats milliseconds since the epoch as parse_date reads them back.
+
+  Milliseconds are rounded once, so .9995 s does not come out as .1000.
+  """
+  seconds, ms = divmod(int(round(ms)), 1000)
+  s = time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(seconds))
+  return s + ('.%03d' % ms if ms else '')
+
+def split_header(header):
+  """Returns (labels, separator) of a header line, as parseCSV_ splits it."""
+  sep = ',' if ',' in header or '\t' not in header else '\t'
+  return header.split(sep), sep
+
+def x_parser(s):
+  """Returns the function parsing x values of the kind of s, the first."""
+  return parse_date if is_date(s) else parse_float
+
+def parse_lines(data):
+  """Splits CSV bytes into lines as parseCSV_ does.
+
+  Returns (header, labels, separator, rows): rows yields (start, end,
+  fields) for every data line with an x and at least one field, with the
+  byte range of the line; blank lines and # comments are skipped.
+  """
+  delim = _line_delimiter(data)
+  lines = data.split(delim)
+  labels, sep = split_header(lines[0].decode('UTF-8', 'replace'))
+
+  def rows():
+    pos = len(lines[0]) + len(delim)
+    for line in lines[1:]:
+      start = pos
+      pos += len(line) + len(delim)
+      if not line or line[:1] == b'#':
+        continue
+      fields = line.decode('UTF-8', 'replace').split(sep)
+      if len(fields) >= 2:
+        yield start, start + len(line), fields
+
+  return lines[0], labels, sep, rows()
+
+class ColumnStore(object):
+  """The parsed columns of one CSV file."""
+
+  def __init__(self, data, layout='plain'):
+    if layout not in LAYOUTS:
+      raise Error('unknown layout %r' % layout)
+    self.layout = layout
+    self._data = data
+    self.header, self.labels, self._sep, lines = parse_lines(data)
+    center = _center(layout)
+    nseries = len(self.labels) - 1
+    rows = []
+    parse_x = None
+    for start, end, fields in lines:
+      if parse_x is None:
+        parse_x = x_parser(fields[0])
+      x = parse_x(fields[0])
+      if math.isnan(x):
+        continue
+      values = center(fields[1:])
+      values.extend([_nan] * (nseries - len(values)))
+      rows.append((x, start, end, values[:nseries]))
+    # parseCSV_ sorts rows that are out of order
+    if any(rows[i][0] > rows[i + 1][0] for i in range(len(rows) - 1)):
+      rows.sort(key=lambda row: row[0])
+    self.is_date = parse_x is parse_date
+    self.x = array.array('d', (row[0] for row in rows))
+    self._start = array.array('q', (row[1] for row in rows))
+    self._end = array.array('q', (row[2] for row in rows))
+    self.series = [array.array('d', (row[3][j] for row in rows))
+        for j in range(nseries)]
+
+  @classmethod
+  def load(cls, path, layout='plain'):
+    with open(path, 'rb') as f:
+      return cls(f.read(), layout)
+
+  @property
+  def nbytes(self):
+    """Approximate memory use in bytes, for cache accounting."""
+    return len(self._data) + len(self.x) * 8 * (3 + len(self.series))
+
+  def parse_x(self, s):
+    """Parses a query bound: a number, or a date if the x axis has dates."""
+    return parse_bound(s, self.is_date)
+
+  def window(self, x0=None, x1=None):
+    """Returns the row range [lo, hi) for x in [x0, x1].
+
+    One row on either side is included, so lines reach the chart edges.
+    """
+    lo = 0 if x0 is None else max(0, bisect.bisect_left(self.x, x0) - 1)
+    hi = len(self.x) if x1 is None else min(len(self.x),
+        bisect.bisect_right(self.x, x1) + 1)
+    return lo, max(lo, hi)
+
+  def series_index(self, label):
+    try:
+      return self.labels.index(label) - 1
+    except ValueError:
+      raise Error('no series %r' % label)
+
+  def downsample(self, lo, hi, points, method='minmax', series=0):
+    """Returns the sorted row indices representing rows [lo, hi)."""
+    if method not in METHODS:
+      raise Error('unknown method %r' % method)
+    if hi - lo <= max(points, 2) or not self.series:
+      return list(range(lo, hi))
+    if method == 'lttb':
+      fn = _lttb_numpy if numpy is not None else _lttb
+      return fn(self.x, self.series[series], lo, hi, max(points, 3))
+    # the first and last rows are kept so the chart spans the window
+    edges = self._edges(lo + 1, hi - 1, max(1, points // 2))
+    fn = _minmax_numpy if numpy is not None else _minmax
+    rows = set(fn(self.series, edges))
+    rows.update((lo, hi - 1))
+    return sorted(rows)
+
+  def _edges(self, lo, hi, nbuckets):
+    """Splits rows [lo, hi) into nbuckets of equal x width."""
+    x0 = self.x[lo]
+    width = (self.x[hi - 1] - x0) / nbuckets
+    edges = [lo]
+    for b in range(1, nbuckets):
+      edges.append(max(edges[-1],
+          bisect.bisect_left(self.x, x0 + b * width, lo, hi)))
+    edges.append(hi)
+    return edges
+
+  def fields(self, i):
+    """Returns the series fields of row i, as parseCSV_ splits them."""
+    line = self._data[self._start[i]:self._end[i]].decode('UTF-8', 'replace')
+    return line.split(self._sep)[1:]
+
+  def csv(self, rows):
+    """Returns the header and the given rows as CSV text."""
+    data = self._data
+    start = self._start
+    end = self._end
+    out = [self.header]
+    out.extend(data[start[i]:end[i]] for i in rows)
+    out.append(b'')
+    return b'\n'.join(out)
+
+def _minmax(series, edges):
+  for b in range(len(edges) - 1):
+    lo, hi = edges[b], edges[b + 1]
+    if lo == hi:
+      continue
+    for values in series:
+      best_lo = best_hi = None
+      for i in range(lo, hi):
+        v = values[i]
+        if v != v:
+          continue
+        if best_lo is None or v < values[best_lo]:
+          best_lo = i
+        if best_hi is None or v > values[best_hi]:
+          best_hi = i
+      if best_lo is None:
+        yield lo
+      else:
+        yield best_lo
+        yield best_hi
+
+def _minmax_numpy(series, edges):
+  edges = numpy.asarray(edges)
+  lo, hi = int(edges[0]), int(edges[-1])
+  counts = numpy.diff(edges)
+  starts = edges[:-1][counts > 0] - lo
+  bucket = numpy.repeat(numpy.arange(len(starts)), counts[counts > 0])
+  rows = []
+  for values in series:
+    v = numpy.frombuffer(values, dtype=numpy.float64)[lo:hi]
+    nan = numpy.isnan(v)
+    for fill, reduce in (numpy.inf, numpy.minimum), (-numpy.inf, numpy.maximum):
+      w = numpy.where(nan, fill, v)
+      best = reduce.reduceat(w, starts)
+      hit = numpy.flatnonzero(w == best[bucket])
+      _, first = numpy.unique(bucket[hit], return_index=True)
+      rows.append(hit[first] + lo)
+  return numpy.concatenate(rows).tolist() if rows else []
+
+def _lttb_buckets(lo, hi, points):
+  """Bucket boundaries of the standard LTTB: first and last row alone."""
+  every = (hi - lo - 2) / (points - 2)
+  return [lo + 1 + int(b * every) for b in range(points - 2)] + [hi - 1]
+
+def _lttb(xs, ys, lo, hi, points):
+  edges = _lttb_buckets(lo, hi, points)
+  rows = [lo]
+  a = lo
+  for b in range(len(edges) - 1):
+    start, end = edges[b], edges[b + 1]
+    nstart, nend = end, edges[b + 2] if b + 2 < len(edges) else hi
+    nxt = [i for i in range(nstart, nend) if ys[i] == ys[i]]
+    cx = sum(xs[i] for i in nxt) / len(nxt) if nxt else xs[nend - 1]
+    cy = sum(ys[i] for i in nxt) / len(nxt) if nxt else 0.0
+    ax, ay = xs[a], ys[a]
+    if ay != ay:
+      ay = 0.0
+    best, best_area = start, -1.0
+    for i in range(start, end):
+      y = ys[i]
+      if y != y:
+        continue
+      area = abs((ax - cx) * (y - ay) - (ax - xs[i]) * (cy - ay))
+      if area > best_area:
+        best, best_area = i, area
+    rows.append(best)
+    a = best
+  rows.append(hi - 1)
+  return rows
+
+def _lttb_numpy(xs, ys, lo, hi, points):
+  x = numpy.frombuffer(xs, dtype=numpy.float64)
+  y = numpy.frombuffer(ys, dtype=numpy.float64)
+  edges = _lttb_buckets(lo, hi, points)
+  rows = [lo]
+  a = lo
+  for b in range(len(edges) - 1):
+    start, end = edges[b], edges[b + 1]
+    nstart, nend = end, edges[b + 2] if b + 2 < len(edges) else hi
+    ny = y[nstart:nend]
+    ok = ~numpy.isnan(ny)
+    if ok.any():
+      cx = x[nstart:nend][ok].mean()
+      cy = ny[ok].mean()
+    else:
+      cx, cy = x[nend - 1], 0.0
+    ax, ay = x[a], y[a]
+    if ay != ay:
+      ay = 0.0
+    area = numpy.abs((ax - cx) * (y[start:end] - ay) -
+        (ax - x[start:end]) * (cy - ay))
+    area[numpy.isnan(area)] = -1.0
+    best = start + int(area.argmax())
+    rows.append(best)
+    a = best
+  rows.append(hi - 1)
+  return rows
+
+def _selftest():
+  import random
+
+  rv = 0
+  def check(what, ok):
+    nonlocal rv
+    if not ok:
+      print('FAIL: %s' % what)
+      rv = 1
+
+  def same(a, b):
+    """Compares sequences of floats, with NaN equal to NaN."""
+    return len(a) == len(b) and all(p == q or (p != p and q != q)
+        for p, q in zip(a, b))
+
+  check('parse_float', parse_float('1.5e3x') == 1500 and
+      math.isnan(parse_float('x1')) and parse_float('-Infinity') == -math.inf)
+  check('is_date', is_date('2020/01/05') and is_date('2020-01-05') and
+      not is_date('1e-5') and not is_date('-3'))
+  check('parse_date', parse_date('2020-01-05T00:00:00Z') == 1578182400000 and
+      parse_date('2020/01/05') == time.mktime((2020, 1, 5, 0, 0, 0, 0, 0, -1))
+      * 1000 and math.isnan(parse_date('2020/13/05')))
+
+  check('parse_bound', parse_bound('2020/01/05', True) ==
+      parse_date('2020/01/05') and parse_bound('1e3', True) == 1000 and
+      math.isnan(parse_bound('2020/01/05 x', True)) and
+      parse_bound('2020/01/05', False) == 2020)
+  check('format_number', [format_number(v) for v in (3.0, -0.5, 1e300,
+      _nan, math.inf)] == ['3', '-0.5', '1e+300', 'null', 'null'])
+
+  day = parse_date('2020/01/05')
+  check('format_date', [format_date(day + d) for d in (0, 250, 999.5)] == [
+      '2020/01/05 00:00:00', '2020/01/05 00:00:00.250', '2020/01/05 00:00:01']
+      and parse_date(format_date(day + 61001)) == day + 61001)
+
+  # every layout of parseCSV_, with its central values
+  rng = random.Random(1)
+  n = 5000
+  values = [[rng.uniform(-100, 100) for _ in range(n)] for _ in range(2)]
+  for i in rng.sample(range(n), 200):
+    values[rng.randrange(2)][i] = _nan
+  formats = {
+    'plain': lambda v: '' if v != v else repr(v),
+    'errorBars': lambda v: ',' if v != v else '%r,%r' % (v, abs(v) / 10),
+    'customBars': lambda v: '' if v != v else '%r;%r;%r' % (v - 1, v, v + 1),
+    'fractions': lambda v: '' if v != v else '%r/4' % (v * 4),
+  }
+  for layout in LAYOUTS:
+    lines = ['X,A,B'] + ['%d,%s,%s' % (x, formats[layout](values[0][x]),
+        formats[layout](values[1][x])) for x in range(n)]
+    data = '\r\n'.join(lines + ['']).encode()
+    store = ColumnStore(data, layout)
+    check('%s: columns' % layout, list(store.x) == list(range(n)) and all(
+        same([round(v, 9) for v in store.series[j]],
+        [round(v, 9) for v in values[j]]) for j in range(2)))
+    lo, hi = store.window(1000, 3999)
+    check('%s: window' % layout, (lo, hi) == (999, 4001))
+    rows = store.downsample(lo, hi, 100)
+    text = store.csv(rows)
+    check('%s: verbatim rows' % layout, text.split(b'\n') ==
+        [b'X,A,B'] + [lines[i + 1].encode() for i in rows] + [b''])
+    again = ColumnStore(text, layout)
+    check('%s: reparsed' % layout, list(again.x) == rows and all(
+        same(again.series[j], [store.series[j][i] for i in rows])
+        for j in range(2)))
+    check('%s: fields' % layout, store.fields(5) == lines[6].split(',')[1:])
+
+  # the pure Python reductions agree with the NumPy ones
+  if numpy is None:
+    print('numpy is not installed; not comparing the reductions')
+  else:
+    xs = array.array('d', sorted(rng.uniform(0, 1e6) for _ in range(n)))
+    series = [array.array('d', v) for v in values]
+    for lo, hi, nbuckets in ((0, n, 50), (10, 4000, 7), (100, 140, 30)):
+      edges = [lo + (hi - lo) * b // nbuckets for b in range(nbuckets + 1)]
+      check('minmax %d-%d' % (lo, hi), set(_minmax(series, edges)) ==
+          set(_minmax_numpy(series, edges)))
+      for j in range(2):
+        check('lttb %d-%d' % (lo, hi), _lttb(xs, series[j], lo, hi,
+            nbuckets + 2) == _lttb_numpy(xs, series[j], lo, hi, nbuckets + 2))
+    gaps = array.array('d', [_nan] * 100)
+    check('minmax of gaps', set(_minmax([gaps], [0, 50, 100])) ==
+        set(_minmax_numpy([gaps], [0, 50, 100])) == set([0, 50]))
+  print('test finished')
+  return rv
+
+if __name__ == '__main__':
+  if sys.argv[1:] == ['--test']:
+    sys.exit(_selftest())
+  sys.stderr.write('E: syntax: python3 colstore.py --test\n')
+  sys.exit(1)
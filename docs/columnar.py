@@ -0,0 +1,334 @@
+#!/usr/bin/python3
+'''
+A compact binary columnar format for chart data.
+
+The data endpoints of ssi_server.py send it instead of CSV to clients
+whose Accept header names MIME_TYPE; src/extras/columnar.js decodes it
+into the native array format of Dygraph.
+
+Layout, all little-endian:
+
+  8 bytes   magic, b'DYCOLS\\0\\1'
+  4 bytes   length of the JSON header (uint32)
+  ...       the JSON header, padded with spaces to a multiple of 8 bytes
+  ...       the x column, then the value columns
+
+The header has the labels, the number of rows, the layout and the number
+of values per point (plain: 1; errorBars: value, stddev; customBars: low,
+center, high; fractions: numerator, denominator), whether x is a date (in
+milliseconds since the epoch), and the byte offset of every column. Value
+columns are arrays of doubles with NaN for missing values, so a client
+wraps them in Float64Array views without copying or parsing anything.
+
+The x column is either doubles too ("f64") or, when asked for and all x
+values are integers whose differences fit in 32 bits, the first value in
+the header and the differences as an int32 array ("delta-i32"): half the
+size, and with regular timestamps it compresses to almost nothing.
+
+Usage:
+
+  python3 columnar.py --test
+  python3 columnar.py --benchmark
+  python3 columnar.py --benchmark-files ROWS SERIES DIR
+
+--test round-trips every layout through encode and decode. --benchmark
+compares payload sizes and encoding time against CSV for 1e5 to
+1e7 points; --benchmark-files writes DIR/bench.csv and DIR/bench.dyc for
+tests/columnar-benchmark.html, which compares decoding in the browser.
+'''
+
+import array
+import gzip
+import json
+import math
+import os
+import random
+import struct
+import sys
+import time
+
+import colstore
+
+MIME_TYPE = 'application/vnd.dygraphs.columns'
+
+_magic = b'DYCOLS\0\1'
+_nan = float('nan')
+_widths = {'plain': 1, 'errorBars': 2, 'customBars': 3, 'fractions': 2}
+
+class Error(Exception):
+  pass
+
+def accepts(header):
+  """Whether an Accept header asks for the binary format."""
+  return MIME_TYPE in (header or '')
+
+def parse_fields(layout, fields, nseries):
+  """Returns the values of a CSV row's series fields, width per series.
+
+  Missing or unparsable values are NaN, as in the binary columns.
+  """
+  pf = colstore.parse_float
+  width = _widths[layout]
+  out = []
+  if layout == 'errorBars':
+    for j in range(nseries):
+      k = 2 * j
+      out.append(pf(fields[k]) if k < len(fields) else _nan)
+      out.append(pf(fields[k + 1]) if k + 1 < len(fields) else _nan)
+    return out
+  for j in range(nseries):
+    if j >= len(fields):
+      out.extend([_nan] * width)
+    elif layout == 'plain':
+      out.append(pf(fields[j]))
+    else:
+      parts = fields[j].split(';' if layout == 'customBars' else '/')
+      if len(parts) == width:
+        out.extend(pf(p) for p in parts)
+      else:
+        out.extend([_nan] * width)
+  return out
+
+def _le(arr):
+  """Returns the bytes of an array, little-endian."""
+  if sys.byteorder != 'little':
+    arr = array.array(arr.typecode, arr)
+    arr.byteswap()
+  return arr.tobytes()
+
+def _delta_x(x):
+  """Returns (base, int32 differences) for x, or None if they do not fit."""
+  if not len(x):
+    return None
+  prev = x[0]
+  if prev != math.floor(prev) or abs(prev) > 2 ** 53:
+    return None
+  deltas = array.array('i', [0])
+  for v in x[1:]:
+    d = v - prev
+    if d != math.floor(d) or not -2 ** 31 <= d < 2 ** 31:
+      return None
+    deltas.append(int(d))
+    prev = v
+  return x[0], deltas
+
+def encode(labels, x, columns, layout='plain', is_date=False, delta=False):
+  """Encodes the data; returns bytes.
+
+  x is a sequence of numbers and columns a list of sequences of doubles,
+  _widths[layout] per series, in the order of the labels.
+  """
+  if layout not in _widths:
+    raise Error('unknown layout %r' % layout)
+  nseries = len(labels) - 1
+  if len(columns) != nseries * _widths[layout]:
+    raise Error('%d columns for %d series of layout %s' % (
+        len(columns), nseries, layout))
+  n = len(x)
+  blobs = []
+  xs = _delta_x(x) if delta else None
+  if xs is not None:
+    xinfo = {'type': 'delta-i32', 'base': xs[0]}
+    blobs.append(_le(xs[1]))
+  else:
+    xinfo = {'type': 'f64'}
+    blobs.append(_le(x if isinstance(x, array.array) and x.typecode == 'd'
+        else array.array('d', x)))
+  for col in columns:
+    if len(col) != n:
+      raise Error('column of %d values for %d rows' % (len(col), n))
+    if isinstance(col, memoryview):
+      blobs.append(col.tobytes() if sys.byteorder == 'little'
+          else _le(array.array('d', col)))
+    else:
+      blobs.append(_le(col if isinstance(col, array.array) and
+          col.typecode == 'd' else array.array('d', col)))
+  header = {
+    'labels': labels,
+    'nrows': n,
+    'layout': layout,
+    'width': _widths[layout],
+    'is_date': bool(is_date),
+    'x': xinfo,
+    'columns': [],
+  }
+  # offsets depend on the header length, which depends on the offsets
+  size = 0
+  while True:
+    offset = len(_magic) + 4 + size
+    offsets = []
+    for blob in blobs:
+      offsets.append(offset)
+      offset += len(blob) + -len(blob) % 8
+    xinfo['offset'] = offsets[0]
+    header['columns'] = offsets[1:]
+    text = json.dumps(header, sort_keys=True).encode('UTF-8')
+    text += b' ' * (-(len(_magic) + 4 + len(text)) % 8)
+    if len(text) == size:
+      break
+    size = len(text)
+  out = [_magic, struct.pack('<I', len(text)), text]
+  for blob in blobs:
+    out.append(blob)
+    out.append(b'\0' * (-len(blob) % 8))
+  return b''.join(out)
+
+def decode(data):
+  """Returns (header, x, columns) of encoded data, as arrays."""
+  if data[:len(_magic)] != _magic:
+    raise Error('not columnar data')
+  size, = struct.unpack_from('<I', data, len(_magic))
+  start = len(_magic) + 4
+  header = json.loads(data[start:start + size].decode('UTF-8'))
+  n = header['nrows']
+  def column(offset, typecode):
+    arr = array.array(typecode)
+    arr.frombytes(data[offset:offset + n * arr.itemsize])
+    if sys.byteorder != 'little':
+      arr.byteswap()
+    return arr
+  xinfo = header['x']
+  if xinfo['type'] == 'delta-i32':
+    x = array.array('d')
+    v = xinfo['base']
+    for d in column(xinfo['offset'], 'i'):
+      v += d
+      x.append(v)
+  else:
+    x = column(xinfo['offset'], 'd')
+  return header, x, [column(offset, 'd') for offset in header['columns']]
+
+def from_csv(data, layout='plain', delta=False):
+  """Encodes CSV bytes in the form parseCSV_ reads."""
+  store = colstore.ColumnStore(data, layout)
+  return store_rows(store, range(len(store.x)), delta)
+
+def store_rows(store, rows, delta=False):
+  """Encodes the given rows of a colstore.ColumnStore."""
+  nseries = len(store.labels) - 1
+  width = _widths[store.layout]
+  columns = [array.array('d') for _ in range(nseries * width)]
+  x = array.array('d')
+  for i in rows:
+    x.append(store.x[i])
+    for col, v in zip(columns, parse_fields(store.layout, store.fields(i),
+        nseries)):
+      col.append(v)
+  return encode(store.labels, x, columns, store.layout, store.is_date, delta)
+
+def _synthetic_csv(nrows, nseries, seed=1):
+  """A CSV of nrows per-second samples of nseries random walks."""
+  rng = random.Random(seed)
+  t0 = 1500000000000
+  ys = [0.0] * nseries
+  out = ['X,' + ','.join('S%d' % j for j in range(nseries))]
+  for i in range(nrows):
+    for j in range(nseries):
+      ys[j] += rng.gauss(0, 1)
+    out.append('%d,%s' % (t0 + 1000 * i, ','.join('%.4f' % y for y in ys)))
+  out.append('')
+  return '\n'.join(out).encode('UTF-8')
+
+def benchmark():
+  print('%10s %7s %12s %12s %12s %12s %12s %9s' % ('points', 'series',
+      'csv', 'csv.gz', 'bin', 'bin.gz', 'bin+delta.gz', 'encode'))
+  for points in 10 ** 5, 10 ** 6, 10 ** 7:
+    nseries = 4
+    data = _synthetic_csv(points // nseries, nseries)
+    store = colstore.ColumnStore(data)
+    t0 = time.time()
+    plain = store_rows(store, range(len(store.x)))
+    elapsed = time.time() - t0
+    delta = store_rows(store, range(len(store.x)), True)
+    gz = lambda b: len(gzip.compress(b, 6, mtime=0))
+    print('%10d %7d %12d %12d %12d %12d %12d %8.2fs' % (points, nseries,
+        len(data), gz(data), len(plain), gz(plain), gz(delta), elapsed))
+
+def _selftest():
+  rv = 0
+  def check(what, ok):
+    nonlocal rv
+    if not ok:
+      print('FAIL: %s' % what)
+      rv = 1
+
+  def same(a, b):
+    """Compares sequences of floats, with NaN equal to NaN."""
+    return len(a) == len(b) and all(p == q or (p != p and q != q)
+                                    for p, q in zip(a, b))
+
+  x = [1500000000000, 1500000001000, 1500000003000, 1499999999000]
+  for layout, width in sorted(_widths.items()):
+    labels = ['X', 'A', 'B']
+    columns = [[j + 0.5, _nan, -j, 1e300][:len(x)]
+               for j in range(2 * width)]
+    for delta in False, True:
+      what = '%s%s' % (layout, ' delta' if delta else '')
+      data = encode(labels, x, columns, layout, True, delta)
+      check('%s aligned' % what, len(data) % 8 == 0)
+      header, x2, columns2 = decode(data)
+      check('%s header' % what, (header['labels'], header['nrows'],
+            header['layout'], header['width'], header['is_date']) == (
+            labels, len(x), layout, width, True))
+      check('%s x type' % what, header['x']['type'] ==
+            ('delta-i32' if delta else 'f64'))
+      check('%s x' % what, list(x2) == x)
+      check('%s columns' % what, len(columns2) == len(columns) and
+            all(same(a, b) for a, b in zip(columns, columns2)))
+    for delta in False, True:
+      header, x2, columns2 = decode(encode(labels, [], [[]] * (2 * width),
+                                           layout, False, delta))
+      check('%s empty' % layout, header['nrows'] == 0 and not x2 and
+            header['x']['type'] == 'f64' and
+            all(not col for col in columns2))
+
+  check('delta of integers', _delta_x([5, 7, 2]) == (5, array.array('i',
+        [0, 2, -5])))
+  check('delta of an empty x', _delta_x([]) is None)
+  for bad in [0.5, 1.5], [0, 0.5], [0, 2 ** 31], [0, -2 ** 31 - 1], \
+      [2 ** 54, 2 ** 54 + 4]:
+    check('no delta for %r' % bad, _delta_x(bad) is None)
+    header, x2, _ = decode(encode(['X'], bad, [], delta=True))
+    check('f64 fallback for %r' % bad, header['x']['type'] == 'f64' and
+          list(x2) == bad)
+
+  csv = b'X,A,B\n1,2;3;4,5;6;7\n2,;;,1;x;3\n3,1;2;3\n'
+  header, x2, columns2 = decode(from_csv(csv, 'customBars', True))
+  check('from_csv', list(x2) == [1, 2, 3] and same(
+        [v for col in columns2 for v in col],
+        [2, _nan, 1, 3, _nan, 2, 4, _nan, 3,
+         5, 1, _nan, 6, _nan, _nan, 7, 3, _nan]))
+
+  for args in (['X', 'A'], [1], [], 'nope'), (['X', 'A'], [1], [[1, 2]]), \
+      (['X', 'A'], [1], []):
+    try:
+      encode(*args)
+      check('error for %r' % (args,), False)
+    except Error:
+      pass
+  try:
+    decode(b'DYCOLS\0\2')
+    check('error for bad magic', False)
+  except Error:
+    pass
+  print('test finished')
+  return rv
+
+if __name__ == '__main__':
+  args = sys.argv[1:]
+  if args == ['--test']:
+    sys.exit(_selftest())
+  if args == ['--benchmark']:
+    benchmark()
+    sys.exit(0)
+  if len(args) == 4 and args[0] == '--benchmark-files':
+    data = _synthetic_csv(int(args[1]), int(args[2]))
+    with open(os.path.join(args[3], 'bench.csv'), 'wb') as f:
+      f.write(data)
+    with open(os.path.join(args[3], 'bench.dyc'), 'wb') as f:
+      f.write(from_csv(data, delta=True))
+    sys.exit(0)
+  sys.stderr.write('E: syntax: python3 columnar.py --test\n'
+      '   or: python3 columnar.py --benchmark\n'
+      '   or: python3 columnar.py --benchmark-files ROWS SERIES DIR\n')
+  sys.exit(1)
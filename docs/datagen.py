@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+'''
+Generates synthetic CSV data sets for benchmarking dygraphs.
+
+Usage:
+
+  python3 datagen.py [options] output.csv
+
+  --rows N       number of rows (default 1000; up to 1e7)
+  --series N     number of series (default 1; up to 100)
+  --layout L     plain (default), errorBars, customBars or fractions
+  --gaps P       fraction of values left empty (default 0)
+  --dates        dates on the x axis, one row per minute, instead of numbers
+  --seed N       seed of the random walks (default 1)
+
+Every series is a random walk; the same parameters give the same file.
+ssi_server.py serves the same data at /__gen?rows=N&series=N&... (with
+dates=1 for --dates), streamed, so benchmark pages need no files.
+'''
+
+import argparse
+import random
+import sys
+import time
+
+import colstore
+
+MAX_ROWS = 10 ** 7
+MAX_SERIES = 100
+
+_chunk_rows = 4096
+_start = time.mktime((2020, 1, 1, 0, 0, 0, 0, 0, -1))
+
+def _check(rows, series, layout, gaps):
+  if not 0 <= rows <= MAX_ROWS:
+    raise ValueError('rows must be between 0 and %d' % MAX_ROWS)
+  if not 1 <= series <= MAX_SERIES:
+    raise ValueError('series must be between 1 and %d' % MAX_SERIES)
+  if layout not in colstore.LAYOUTS:
+    raise ValueError('unknown layout %r' % layout)
+  if not 0 <= gaps < 1:
+    raise ValueError('gaps must be in [0, 1)')
+
+def _field(layout, rng, y):
+  """Formats one value of a walk at y; y is kept in [0, 1] for fractions."""
+  if layout == 'errorBars':
+    return '%.4f,%.4f' % (y, rng.uniform(0.1, 1.0))
+  if layout == 'customBars':
+    spread = rng.uniform(0.1, 1.0)
+    return '%.4f;%.4f;%.4f' % (y - spread, y, y + spread)
+  if layout == 'fractions':
+    den = rng.randint(50, 150)
+    return '%d/%d' % (round(y * den), den)
+  return '%.4f' % y
+
+def chunks(rows, series=1, layout='plain', gaps=0.0, dates=False, seed=1):
+  """Returns an iterator over the CSV text in pieces of a few thousand rows.
+
+  Raises ValueError for parameters out of range, before generating anything.
+  """
+  _check(rows, series, layout, gaps)
+  return _chunks(rows, series, layout, gaps, dates, seed)
+
+def _chunks(rows, series, layout, gaps, dates, seed):
+  rng = random.Random(seed)
+  labels = ['Date' if dates else 'X'] + ['S%d' % j for j in range(series)]
+  empty = ',' if layout == 'errorBars' else ''
+  ys = [0.5] * series
+  out = [','.join(labels)]
+  for i in range(rows):
+    if dates:
+      x = time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(_start + 60 * i))
+    else:
+      x = str(i)
+    fields = [x]
+    for j in range(series):
+      y = ys[j] + rng.gauss(0, 0.02 if layout == 'fractions' else 1.0)
+      if layout == 'fractions':
+        y = min(1.0, max(0.0, y))
+      ys[j] = y
+      if gaps and rng.random() < gaps:
+        fields.append(empty)
+      else:
+        fields.append(_field(layout, rng, y))
+    out.append(','.join(fields))
+    if len(out) >= _chunk_rows:
+      out.append('')
+      yield '\n'.join(out).encode('UTF-8')
+      out = []
+  out.append('')
+  yield '\n'.join(out).encode('UTF-8')
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='Generate a synthetic CSV data set.')
+  parser.add_argument('--rows', type=int, default=1000)
+  parser.add_argument('--series', type=int, default=1)
+  parser.add_argument('--layout', default='plain')
+  parser.add_argument('--gaps', type=float, default=0.0)
+  parser.add_argument('--dates', action='store_true')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('output')
+  args = parser.parse_args()
+  try:
+    data = chunks(args.rows, args.series, args.layout, args.gaps, args.dates,
+        args.seed)
+    with open(args.output, 'wb') as f:
+      for chunk in data:
+        f.write(chunk)
+  except (ValueError, OSError) as e:
+    sys.stderr.write('E: %s\n' % e)
+    sys.exit(1)
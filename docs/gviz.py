@@ -0,0 +1,406 @@
+#!/usr/bin/python3
+'''
+The Google Visualization data source protocol, for the /__tq endpoint of
+ssi_server.py.
+
+google.visualization.Query('/__tq?file=F') sends a query (tq) and options
+(tqx) and gets a DataTable for Dygraph.GVizChart. The table comes from the
+ColumnStore of the CSV file F, cached by the server, so only the rows the
+query asks for are formatted and sent. The subset of the query language
+understood is:
+
+  select * | select COL, COL, ...
+  where X OP VALUE [and X OP VALUE ...]
+  limit N
+  offset N
+
+in this order. Columns are named by their IDs (A for x, then B, C, ...)
+or by their labels in backquotes. Conditions may only be on the x column,
+which is sorted, so where, limit and offset come down to a range of rows
+found by bisection. OP is one of <, <=, >, >=, =; VALUE a number, date
+"yyyy-MM-dd" or datetime "yyyy-MM-dd HH:mm:ss". For files of error bars
+(layout=errorBars or customBars), every series gives two or three number
+columns, as GVizChart expects them for those options.
+
+tqx may hold reqId, version, sig, out (json, the default, or csv) and
+responseHandler. The signature is a hash of the file's stamp and of the
+query, so a client sending it back gets the not_modified error instead of
+the data, as the protocol has it.
+
+Usage:
+
+  python3 gviz.py --test
+  python3 gviz.py --benchmark file.csv [query]
+
+--benchmark compares the time and size of the response for the full table
+with those for the query (default: the middle tenth of the rows).
+'''
+
+import bisect
+import hashlib
+import json
+import math
+import re
+import sys
+import time
+
+import colstore
+import columnar
+
+VERSION = '0.6'
+
+class Error(Exception):
+  """A query the data source cannot answer; reason is a protocol code."""
+
+  def __init__(self, reason, message):
+    Exception.__init__(self, message)
+    self.reason = reason
+
+_token = re.compile(r'\s*(?:(`[^`]*`)|("[^"]*"|\'[^\']*\')|'
+    r'([+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)|(<=|>=|!=|<>|[<>=,*])|'
+    r'(\w+))')
+_handler = re.compile(r'^[A-Za-z_$][\w$]*(?:\.[A-Za-z_$][\w$]*)*$')
+_clauses = ('select', 'where', 'limit', 'offset')
+_unsupported = ('group', 'pivot', 'order', 'label', 'format', 'options')
+_chunk_rows = 2048
+
+def parse_tqx(tqx):
+  """Parses 'key:value;key:value' into a dict."""
+  out = {}
+  for part in (tqx or '').split(';'):
+    key, _, value = part.partition(':')
+    if key.strip():
+      out[key.strip()] = value.strip()
+  return out
+
+def _tokens(tq):
+  out = []
+  pos = 0
+  tq = tq.rstrip()
+  while pos < len(tq):
+    m = _token.match(tq, pos)
+    if m is None or m.end() == pos:
+      raise Error('invalid_query', 'cannot parse the query at %r' %
+          tq[pos:pos + 20])
+    pos = m.end()
+    name, string, number, op, word = m.groups()
+    if name is not None:
+      out.append(('name', name[1:-1]))
+    elif string is not None:
+      out.append(('string', string[1:-1]))
+    elif number is not None:
+      out.append(('number', float(number)))
+    elif op is not None:
+      out.append(('op', op))
+    else:
+      out.append(('word', word))
+  return out
+
+def _column_id(i):
+  """A, B, ..., Z, AA, AB, ... as in spreadsheets."""
+  s = ''
+  i += 1
+  while i:
+    i, r = divmod(i - 1, 26)
+    s = chr(65 + r) + s
+  return s
+
+class Table(object):
+  """The columns of a ColumnStore as a DataTable sees them."""
+
+  def __init__(self, store):
+    self.store = store
+    self.width = columnar._widths[store.layout] if store.layout in (
+        'errorBars', 'customBars') else 1
+    self.labels = [store.labels[0]]
+    suffixes = {1: ('',), 2: ('', ' sd'), 3: (' low', '', ' high')}[self.width]
+    for label in store.labels[1:]:
+      self.labels.extend(label + suffix for suffix in suffixes)
+    self.ids = [_column_id(i) for i in range(len(self.labels))]
+
+  def column(self, token):
+    """Returns the index of a column named by ID or by label."""
+    kind, name = token
+    if kind == 'word' and name in self.ids:
+      return self.ids.index(name)
+    if kind == 'name' and name in self.labels:
+      return self.labels.index(name)
+    raise Error('invalid_query', 'no column %s' % (
+        name if kind == 'word' else '`%s`' % name))
+
+class Query(object):
+  """A parsed query: the selected columns and the range of rows."""
+
+  def __init__(self, table, tq):
+    self.table = table
+    store = table.store
+    self.columns = list(range(len(table.labels)))
+    self.lo = 0
+    self.hi = len(store.x)
+    limit = None
+    offset = 0
+    tokens = _tokens(tq or '')
+    seen = -1
+    pos = 0
+
+    def take():
+      nonlocal pos
+      if pos >= len(tokens):
+        raise Error('invalid_query', 'the query ends too early')
+      pos += 1
+      return tokens[pos - 1]
+
+    def integer():
+      kind, value = take()
+      if kind != 'number' or value != int(value) or value < 0:
+        raise Error('invalid_query', 'expected a count, got %r' % value)
+      return int(value)
+
+    while pos < len(tokens):
+      kind, word = take()
+      clause = word.lower() if kind == 'word' else None
+      if clause in _unsupported:
+        raise Error('unsupported_query_operation',
+            '%s is not supported by this data source' % clause)
+      if clause not in _clauses or _clauses.index(clause) <= seen:
+        raise Error('invalid_query', 'unexpected %r' % word)
+      seen = _clauses.index(clause)
+      if clause == 'select':
+        if pos < len(tokens) and tokens[pos] == ('op', '*'):
+          pos += 1
+          continue
+        self.columns = [table.column(take())]
+        while pos < len(tokens) and tokens[pos] == ('op', ','):
+          pos += 1
+          self.columns.append(table.column(take()))
+      elif clause == 'where':
+        while True:
+          self._condition(table.column(take()), take(), take(), take)
+          if pos < len(tokens) and tokens[pos][1] in ('and', 'AND'):
+            pos += 1
+            continue
+          break
+      elif clause == 'limit':
+        limit = integer()
+      else:
+        offset = integer()
+    self.lo = min(self.hi, self.lo + offset)
+    if limit is not None:
+      self.hi = min(self.hi, self.lo + limit)
+
+  def _condition(self, column, op, literal, take):
+    if column != 0:
+      raise Error('unsupported_query_operation',
+          'where is supported on the x column only')
+    if op[0] != 'op' or op[1] not in ('<', '<=', '>', '>=', '='):
+      raise Error('unsupported_query_operation', 'unsupported operator %r' %
+          (op[1],))
+    store = self.table.store
+    if literal[0] == 'number':
+      value = literal[1]
+    elif literal[0] == 'word' and literal[1].lower() in ('date', 'datetime'):
+      kind, text = take()
+      value = colstore.parse_date(text) if kind == 'string' else math.nan
+      if math.isnan(value):
+        raise Error('invalid_query', 'bad %s literal' % literal[1])
+    else:
+      raise Error('invalid_query', 'unexpected %r' % (literal[1],))
+    x = store.x
+    op = op[1]
+    if op in ('>', '>=', '='):
+      self.lo = max(self.lo, (bisect.bisect_right if op == '>' else
+          bisect.bisect_left)(x, value))
+    if op in ('<', '<=', '='):
+      self.hi = min(self.hi, (bisect.bisect_left if op == '<' else
+          bisect.bisect_right)(x, value))
+    self.hi = max(self.lo, self.hi)
+
+def signature(stamp, layout, tq):
+  """The data's signature: a hash of the file's stamp and of the query."""
+  return hashlib.sha1(repr((stamp, layout, tq)).encode('UTF-8')).hexdigest(
+      )[:16]
+
+def _date(ms):
+  t = time.localtime(ms // 1000)
+  return '"Date(%d,%d,%d,%d,%d,%d,%d)"' % (t.tm_year, t.tm_mon - 1,
+      t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, ms % 1000)
+
+def _rows(query):
+  """Yields the values of the selected columns of every row, as floats."""
+  table = query.table
+  store = table.store
+  columns = query.columns
+  nseries = len(store.labels) - 1
+  raw = table.width > 1 and any(c > 0 for c in columns)
+  for i in range(query.lo, query.hi):
+    if raw:
+      values = [store.x[i]] + columnar.parse_fields(store.layout,
+          store.fields(i), nseries)
+    else:
+      values = [store.x[i]] + [s[i] for s in store.series]
+    yield [values[c] for c in columns]
+
+def error_response(tqx, reason, message=None):
+  """The JSON response reporting an error."""
+  result = {'version': VERSION, 'reqId': tqx.get('reqId', '0'),
+      'status': 'error', 'errors': [{'reason': reason}]}
+  if message:
+    result['errors'][0]['message'] = message
+  return _wrap(tqx, json.dumps(result, sort_keys=True)).encode('UTF-8')
+
+def _response_handler(tqx):
+  handler = tqx.get('responseHandler', 'google.visualization.Query.setResponse')
+  if not _handler.match(handler):
+    handler = 'google.visualization.Query.setResponse'
+  return handler
+
+def _wrap(tqx, text):
+  return '%s(%s);' % (_response_handler(tqx), text)
+
+def response(store, tq, tqx, sig):
+  """Returns (content type, iterator over the body) answering tq.
+
+  Raises Error for queries the data source cannot answer; the caller then
+  sends error_response().
+  """
+  table = Table(store)
+  query = Query(table, tq)
+  if tqx.get('out', 'json') == 'csv':
+    return 'text/csv; charset=UTF-8', _csv(query)
+  if tqx.get('out', 'json') != 'json':
+    raise Error('not_supported', 'out:%s is not supported' % tqx['out'])
+  if tqx.get('sig') == sig:
+    raise Error('not_modified', None)
+  return 'text/javascript; charset=UTF-8', _json(query, tqx, sig)
+
+def _json(query, tqx, sig):
+  table = query.table
+  x_type = 'datetime' if table.store.is_date else 'number'
+  cols = [{'id': table.ids[c], 'label': table.labels[c],
+      'type': x_type if c == 0 else 'number'} for c in query.columns]
+  head = {'version': VERSION, 'reqId': tqx.get('reqId', '0'),
+      'status': 'ok', 'sig': sig}
+  yield ('%s(%s, "table": {"cols": %s, "rows": [' % (_response_handler(tqx),
+      json.dumps(head, sort_keys=True)[:-1], json.dumps(cols,
+      sort_keys=True))).encode('UTF-8')
+  formats = [_date if c == 0 and table.store.is_date else
+      colstore.format_number for c in query.columns]
+  out = []
+  first = True
+  for values in _rows(query):
+    cells = ','.join('null' if v != v else '{"v":%s}' % f(v)
+        for f, v in zip(formats, values))
+    out.append(('' if first else ',') + '{"c":[%s]}' % cells)
+    first = False
+    if len(out) >= _chunk_rows:
+      yield ''.join(out).encode('UTF-8')
+      out = []
+  out.append(']}});')
+  yield ''.join(out).encode('UTF-8')
+
+def _csv_number(v):
+  return colstore.format_number(v) if math.isfinite(v) else ''
+
+def _csv(query):
+  table = query.table
+  yield (','.join(table.labels[c] for c in query.columns) + '\n').encode(
+      'UTF-8')
+  formats = [colstore.format_date if c == 0 and table.store.is_date else
+      _csv_number for c in query.columns]
+  out = []
+  for values in _rows(query):
+    out.append(','.join('' if v != v else f(v)
+        for f, v in zip(formats, values)))
+    if len(out) >= _chunk_rows:
+      out.append('')
+      yield '\n'.join(out).encode('UTF-8')
+      out = []
+  out.append('')
+  yield '\n'.join(out).encode('UTF-8')
+
+def _body(store, tq, tqx=None, sig='sig'):
+  return b''.join(response(store, tq, tqx or {}, sig)[1])
+
+def _table(body):
+  """Parses a JSON response as google.visualization.Query would."""
+  text = body.decode('UTF-8')
+  return json.loads(text[text.index('(') + 1:text.rindex(')')])
+
+def _selftest():
+  import datagen
+
+  rv = 0
+  def check(what, ok):
+    nonlocal rv
+    if not ok:
+      print('FAIL: %s' % what)
+      rv = 1
+
+  data = b''.join(datagen.chunks(1000, 2, 'errorBars', 0.1, True))
+  store = colstore.ColumnStore(data, 'errorBars')
+  full = _table(_body(store, ''))['table']
+  check('columns', [c['label'] for c in full['cols']] ==
+      ['Date', 'S0', 'S0 sd', 'S1', 'S1 sd'])
+  check('rows', len(full['rows']) == 1000)
+  x0 = _date(store.x[100])
+  window = _table(_body(store, 'select A, D where A >= datetime "%s" and '
+      'A < datetime "%s" limit 20 offset 5' % (
+      colstore.format_date(store.x[100]),
+      colstore.format_date(store.x[200]))))['table']
+  check('window', [r['c'][0] for r in window['rows']] ==
+      [r['c'][0] for r in full['rows'][105:125]])
+  check('window x0', full['rows'][100]['c'][0]['v'] == json.loads(x0))
+  check('select', [r['c'][1] for r in window['rows']] ==
+      [r['c'][3] for r in full['rows'][105:125]])
+  csv = _body(store, 'select `S1` limit 3', {'out': 'csv'}).decode()
+  check('csv', csv.split('\n')[0] == 'S1' and len(csv.split('\n')) == 5)
+  # sub-second dates keep their milliseconds in CSV, as in JSON
+  fine = colstore.ColumnStore(b'Date,Y\n2020/01/05 00:00:00.250,1\n'
+      b'2020/01/05 00:00:00.750,2\n2020/01/05 00:00:01,3\n')
+  csv = _body(fine, 'select A, B', {'out': 'csv'})
+  check('csv dates', list(colstore.ColumnStore(csv).x) == list(fine.x))
+  for tq, reason in (('order by A', 'unsupported_query_operation'),
+      ('where B > 0', 'unsupported_query_operation'),
+      ('select A where', 'invalid_query'), ('limit 2 where A > 1',
+      'invalid_query'), ('where A > date "soon"', 'invalid_query')):
+    try:
+      _body(store, tq)
+      check('%s rejected' % tq, False)
+    except Error as e:
+      check('%s: %s' % (tq, e.reason), e.reason == reason)
+  try:
+    _body(store, '', {'sig': 'sig'})
+    check('not modified', False)
+  except Error as e:
+    check('not modified', e.reason == 'not_modified')
+  check('responseHandler', error_response({'responseHandler': 'x(1)'},
+      'internal_error').startswith(b'google.visualization.'))
+  print('test finished')
+  return rv
+
+def _benchmark(path, tq=None):
+  store = colstore.ColumnStore.load(path)
+  n = len(store.x)
+  if tq is None:
+    x0, x1 = store.x[int(n * 0.45)], store.x[int(n * 0.55)]
+    tq = 'where A >= %r and A <= %r' % (x0, x1)
+    if store.is_date:
+      tq = 'where A >= datetime "%s" and A <= datetime "%s"' % (
+          colstore.format_date(x0), colstore.format_date(x1))
+  print('%d rows, query: %s' % (n, tq))
+  for name, q in ('full table', ''), ('query', tq):
+    start = time.perf_counter()
+    body = _body(store, q)
+    elapsed = time.perf_counter() - start
+    print('%-12s %6d rows %10d bytes %8.1f ms' % (name,
+        len(_table(body)['table']['rows']), len(body), elapsed * 1000))
+
+if __name__ == '__main__':
+  if sys.argv[1:] == ['--test']:
+    sys.exit(_selftest())
+  if len(sys.argv) in (3, 4) and sys.argv[1] == '--benchmark':
+    _benchmark(*sys.argv[2:])
+    sys.exit(0)
+  sys.stderr.write('E: syntax: python3 gviz.py --test\n'
+      '   or: python3 gviz.py --benchmark file.csv [query]\n')
+  sys.exit(1)
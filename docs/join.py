@@ -0,0 +1,302 @@
+'''
+Merge-joins CSV files on x for the /__join endpoint of ssi_server.py.
+
+Each source is a CSV file in the form parseCSV_ reads, sorted by x, with
+lines ending in \\n or \\r\\n. Sources are read line by line, never loaded:
+with a window, every file is first positioned by bisecting on byte
+offsets, and reading stops after the window, so a query costs about the
+size of the window, not of the files. The rows of all sources are merged
+with a heap into one grid of x values, the union of those of the sources,
+which (like ColumnStore.window()) includes one x before and one after the
+window so lines reach the chart edges.
+
+The joined rows are written either as one wide CSV, the x column and then
+the series of every source (labels occurring in several sources are
+prefixed with the file's name), or as JSON with one slice per source on
+the shared grid, in the native array format of Dygraph:
+
+  {"is_date": true,
+   "charts": [{"file": "cpu.csv", "labels": ["Date", "user", "system"],
+               "rows": [[1577836800000, 1.5, null], ...]}, ...]}
+
+For dates, x is in milliseconds, to be turned into Date objects.
+'''
+
+import heapq
+import json
+import math
+import os
+import sys
+
+import colstore
+import columnar
+
+class Error(Exception):
+  pass
+
+# below this many bytes between the bisection bounds, reading is cheaper
+_seek_span = 1 << 16
+
+class Source(object):
+  """A sorted CSV file, read one row at a time."""
+
+  def __init__(self, path, layout='plain'):
+    if layout not in colstore.LAYOUTS:
+      raise Error('unknown layout %r' % layout)
+    self.file = os.path.basename(path)
+    self.name = os.path.splitext(self.file)[0]
+    self.layout = layout
+    self._f = open(path, 'rb')
+    try:
+      header = self._f.readline().decode('UTF-8', 'replace').rstrip('\r\n')
+      self.labels, self._sep = colstore.split_header(header)
+      self.nfields = (len(self.labels) - 1) * (2 if layout == 'errorBars'
+          else 1)
+      self._start = self._f.tell()
+      self._size = os.fstat(self._f.fileno()).st_size
+      first = self._line()
+      self._x = colstore.parse_float if first is None else \
+          colstore.x_parser(first.split(self._sep, 1)[0])
+      self.is_date = self._x is colstore.parse_date
+      self._f.seek(self._start)
+    except Exception:
+      self._f.close()
+      raise
+
+  def close(self):
+    self._f.close()
+
+  def parse_x(self, s):
+    """Parses a query bound: a number, or a date if the x axis has dates."""
+    return colstore.parse_bound(s, self.is_date)
+
+  def _line(self):
+    """Returns the next data line, or None at the end."""
+    while True:
+      line = self._f.readline()
+      if not line:
+        return None
+      line = line.decode('UTF-8', 'replace').rstrip('\r\n')
+      if line and not line.startswith('#'):
+        return line
+
+  def _x_after(self, pos):
+    """Returns x of the first whole line after byte pos, or None."""
+    self._f.seek(pos)
+    if pos > self._start:
+      self._f.readline()
+    line = self._line()
+    return None if line is None else self._x(line.split(self._sep, 1)[0])
+
+  def seek(self, x0):
+    """Positions the file at or shortly before the last row with x < x0."""
+    lo, hi = self._start, self._size
+    while hi - lo > _seek_span:
+      mid = (lo + hi) // 2
+      x = self._x_after(mid)
+      if x is not None and x < x0:
+        lo = mid
+      else:
+        hi = mid
+    self._f.seek(lo)
+    if lo > self._start:
+      self._f.readline()
+
+  def rows(self):
+    """Yields (x, x text, series fields) from the current position."""
+    last = -math.inf
+    while True:
+      line = self._line()
+      if line is None:
+        return
+      fields = line.split(self._sep)
+      x = self._x(fields[0])
+      if x != x:
+        continue
+      if x < last:
+        raise Error('%s is not sorted by x' % self.file)
+      last = x
+      values = fields[1:self.nfields + 1]
+      values.extend([''] * (self.nfields - len(values)))
+      yield x, fields[0], values
+
+def open_sources(paths, layout='plain'):
+  sources = []
+  try:
+    for path in paths:
+      sources.append(Source(path, layout))
+  except Exception:
+    for source in sources:
+      source.close()
+    raise
+  if len(set(s.is_date for s in sources if s.labels)) > 1:
+    for source in sources:
+      source.close()
+    raise Error('some sources have dates on the x axis and some do not')
+  return sources
+
+def _keyed(source, i):
+  for x, text, fields in source.rows():
+    yield x, i, text, fields
+
+def join(sources, x0=None, x1=None):
+  """Yields (x, x text, [series fields, or None, per source]).
+
+  The grid is the union of the x values of the sources within [x0, x1],
+  plus the one before x0 and the one after x1.
+  """
+  if x0 is not None:
+    for source in sources:
+      source.seek(x0)
+  merged = heapq.merge(*[_keyed(source, i) for i, source in
+      enumerate(sources)], key=lambda row: row[:2])
+  k = len(sources)
+  before = None
+  group = None
+
+  def groups():
+    nonlocal group
+    for x, i, text, fields in merged:
+      # a repeated x within a source starts a new row, as in the file
+      if group is not None and (x != group[0] or group[2][i] is not None):
+        yield group
+        group = None
+      if group is None:
+        group = (x, text, [None] * k)
+      group[2][i] = fields
+    if group is not None:
+      yield group
+
+  for g in groups():
+    if x0 is not None and g[0] < x0:
+      before = g
+      continue
+    if before is not None:
+      yield before
+      before = None
+    yield g
+    if x1 is not None and g[0] > x1:
+      return
+  if before is not None:
+    yield before
+
+def _unique_labels(sources):
+  """Returns the series labels of every source, prefixed where they clash."""
+  seen = {}
+  for source in sources:
+    for label in source.labels[1:]:
+      seen[label] = seen.get(label, 0) + 1
+  seen[sources[0].labels[0]] = 2
+  return [[('%s: %s' % (source.name, label)) if seen[label] > 1 else label
+      for label in source.labels[1:]] for source in sources]
+
+def wide_csv(sources, rows, chunk_rows=4096):
+  """Yields the joined rows as CSV text, in pieces."""
+  header = [sources[0].labels[0]]
+  for labels in _unique_labels(sources):
+    header.extend(labels)
+  empty = [[''] * source.nfields for source in sources]
+  out = [','.join(header)]
+  for x, text, parts in rows:
+    fields = [text]
+    for j, part in enumerate(parts):
+      fields.extend(empty[j] if part is None else part)
+    out.append(','.join(fields))
+    if len(out) >= chunk_rows:
+      out.append('')
+      yield '\n'.join(out).encode('UTF-8')
+      out = []
+  out.append('')
+  yield '\n'.join(out).encode('UTF-8')
+
+def slices_json(sources, rows):
+  """Returns the joined rows as JSON, one slice per source."""
+  charts = [[] for _ in sources]
+  widths = [columnar._widths[source.layout] for source in sources]
+  nseries = [len(source.labels) - 1 for source in sources]
+  number = colstore.format_number
+  for x, text, parts in rows:
+    x = number(x)
+    for j, part in enumerate(parts):
+      values = columnar.parse_fields(sources[j].layout, part or [],
+          nseries[j])
+      w = widths[j]
+      if w == 1:
+        points = [number(v) for v in values]
+      else:
+        points = ['null' if all(v != v for v in values[s:s + w]) else
+            '[' + ','.join(number(v) for v in values[s:s + w]) + ']'
+            for s in range(0, len(values), w)]
+      charts[j].append('[' + ','.join([x] + points) + ']')
+  out = []
+  for source, chart in zip(sources, charts):
+    meta = json.dumps({'file': source.file, 'labels': source.labels},
+        sort_keys=True)
+    out.append('%s, "rows": [%s]}' % (meta[:-1], ','.join(chart)))
+  is_date = bool(sources) and sources[0].is_date
+  return ('{"is_date": %s, "charts": [%s]}\n' % (json.dumps(is_date),
+      ',\n'.join(out))).encode('UTF-8')
+
+def _selftest():
+  import random
+  import shutil
+  import tempfile
+
+  global _seek_span
+  rv = 0
+  def check(what, ok):
+    nonlocal rv
+    if not ok:
+      print('FAIL: %s' % what)
+      rv = 1
+
+  rng = random.Random(1)
+  tmp = tempfile.mkdtemp()
+  _seek_span = 256
+  files = []
+  for k in range(3):
+    xs = sorted(rng.sample(range(5000), 1500 + 500 * k))
+    rows = [(x, '%d,%.2f' % (x, rng.uniform(-1, 1))) for x in xs]
+    path = os.path.join(tmp, 's%d.csv' % k)
+    with open(path, 'w') as f:
+      f.write('X,Y\n' + ''.join(line + '\n' for _, line in rows))
+    files.append((path, dict(rows)))
+  grid = sorted(set(x for _, rows in files for x in rows))
+  for x0, x1 in ((None, None), (100, 900), (2500, None), (None, 10),
+      (4990, 6000), (-5, -1)):
+    lo = 0 if x0 is None else max(0, sum(x < x0 for x in grid) - 1)
+    hi = len(grid) if x1 is None else min(len(grid),
+        sum(x <= x1 for x in grid) + 1)
+    sources = open_sources([path for path, _ in files])
+    try:
+      joined = list(join(sources, x0, x1))
+    finally:
+      for source in sources:
+        source.close()
+    check('%s-%s: grid' % (x0, x1), [r[0] for r in joined] == grid[lo:hi])
+    check('%s-%s: values' % (x0, x1), all(
+        (part[0] if part else None) == (rows[x].split(',')[1] if x in rows
+        else None) for x, _, parts in joined for part, (_, rows) in
+        zip(parts, files)))
+  sources = open_sources([path for path, _ in files])
+  text = b''.join(wide_csv(sources, join(sources, 100, 200))).decode()
+  for source in sources:
+    source.close()
+  check('wide labels', text.split('\n', 1)[0] ==
+      'X,s0: Y,s1: Y,s2: Y')
+  sources = open_sources([path for path, _ in files])
+  data = json.loads(slices_json(sources, join(sources, 100, 200)).decode())
+  check('slices', [c['file'] for c in data['charts']] ==
+      ['s0.csv', 's1.csv', 's2.csv'] and len(set(len(c['rows'])
+      for c in data['charts'])) == 1)
+  for source in sources:
+    source.close()
+  shutil.rmtree(tmp)
+  print('test finished')
+  return rv
+
+if __name__ == '__main__':
+  if sys.argv[1:] == ['--test']:
+    sys.exit(_selftest())
+  sys.stderr.write('E: syntax: python3 join.py --test\n')
+  sys.exit(1)
@@ -0,0 +1,359 @@
+'''
+Live channels for the /__live endpoint of ssi_server.py.
+
+A channel holds the most recent rows appended by a producer in ring
+buffers of fixed capacity: one array of doubles for the x values and one
+per series, so its memory is bounded no matter how long it runs.
+
+Subscribers get Server-Sent Events: first a snapshot of the buffered rows,
+then one event per append with just the new rows. Every event is encoded
+once, when it happens, and the same bytes are written to all subscribers;
+the last few hundred are kept so that subscribers which fall behind, or
+reconnect with Last-Event-ID, catch up from there, or from a new snapshot
+if they have missed too much.
+
+Rows are sent as JSON arrays in the native format of Dygraph (x, then a
+number or null per series); for dates, x is in milliseconds and
+"is_date" is set in the snapshot. Whether x values are dates is decided by
+the first row, so a channel created with just its header line has "is_date"
+null until rows come; they come as a new snapshot. A client does
+
+  var source = new EventSource('/__live?channel=cpu'), data, capacity;
+  function row(r) { if (isDate) r[0] = new Date(r[0]); return r; }
+  source.addEventListener('snapshot', function(e) {
+    var m = JSON.parse(e.data);
+    isDate = m.is_date; capacity = m.capacity;
+    data = m.rows.map(row);
+    g.updateOptions({file: data, labels: m.labels});
+  });
+  source.addEventListener('rows', function(e) {
+    data.push.apply(data, JSON.parse(e.data).rows.map(row));
+    data.splice(0, data.length - capacity);
+    g.updateOptions({file: data});
+  });
+
+Usage:
+
+  python3 live.py --test
+'''
+
+import array
+import collections
+import itertools
+import json
+import sys
+import threading
+
+import colstore
+
+_nan = float('nan')
+
+class Error(Exception):
+  pass
+
+def _data_lines(text):
+  return [line for line in text.splitlines()
+      if line and not line.startswith('#')]
+
+def _parse_number(s):
+  """Parses an x value strictly: unlike parseFloat, 2020/01/05 is no number."""
+  try:
+    return float(s)
+  except ValueError:
+    return _nan
+
+def _x_parser(is_date):
+  return colstore.parse_date if is_date else _parse_number
+
+def _parse_rows(lines, parse_x, nseries):
+  """Parses CSV lines into (x, [value per series]) tuples."""
+  rows = []
+  for line in lines:
+    fields = line.split(',')
+    x = parse_x(fields[0])
+    if x != x:
+      raise Error('bad x value %r' % fields[0])
+    values = [colstore.parse_float(v) for v in fields[1:nseries + 1]]
+    values.extend([_nan] * (nseries - len(values)))
+    rows.append((x, values))
+  return rows
+
+def _json_rows(columns, start, n, capacity):
+  """Encodes rows [start, start + n) of ring columns as JSON arrays."""
+  out = []
+  for i in range(start, start + n):
+    i %= capacity
+    row = [c[i] for c in columns]
+    out.append('[' + ','.join('null' if v != v else repr(v) for v in row) + ']')
+  return '[' + ','.join(out) + ']'
+
+def _event(seq, kind, payload):
+  return ('id: %d\nevent: %s\ndata: %s\n\n' % (seq, kind, payload)).encode(
+      'UTF-8')
+
+class Channel(object):
+  """The ring buffers of one live channel and its event log."""
+
+  def __init__(self, labels, capacity, is_date=None, backlog=256):
+    if capacity < 1:
+      raise Error('capacity must be at least 1')
+    if len(labels) < 2:
+      raise Error('a channel needs an x label and at least one series')
+    self.labels = labels
+    self.capacity = capacity
+    # None until the first row tells
+    self.is_date = is_date
+    self.seq = 0  # number of rows ever appended
+    self.closed = False
+    self._columns = [array.array('d', bytes(8 * capacity))
+        for _ in labels]
+    # (seq before, seq after the append, encoded event), oldest first
+    self._events = collections.deque(maxlen=backlog)
+    self._snapshot = None
+    self._cond = threading.Condition()
+
+  @classmethod
+  def create(cls, text, capacity, backlog=256):
+    """Creates a channel from CSV text: a header line, then rows if any."""
+    header, _, rest = text.partition('\n')
+    channel = cls(header.strip().split(','), capacity, backlog=backlog)
+    channel.append_csv(rest)
+    return channel
+
+  def __len__(self):
+    return min(self.seq, self.capacity)
+
+  def append_csv(self, text):
+    """Appends CSV rows; a header line equal to the labels is skipped.
+
+    The first data row decides whether x values are dates, whether it comes
+    with the header or later; rows whose x is not of that kind are rejected.
+    """
+    header, _, rest = text.partition('\n')
+    if header.strip().split(',') == self.labels:
+      text = rest
+    lines = _data_lines(text)
+    if not lines:
+      return 0
+    nseries = len(self.labels) - 1
+    if self.is_date is None:
+      with self._cond:
+        if self.is_date is None:
+          is_date = colstore.is_date(lines[0].split(',', 1)[0])
+          rows = _parse_rows(lines, _x_parser(is_date), nseries)
+          self.is_date = is_date
+          return self.append(rows)
+    return self.append(_parse_rows(lines, _x_parser(self.is_date), nseries))
+
+  def append(self, rows):
+    """Appends (x, values) rows and wakes the subscribers.
+
+    The first rows are sent as a snapshot, as subscribers which came before
+    them do not know yet whether x values are dates.
+    """
+    if not rows:
+      return 0
+    # only the last capacity rows can survive
+    rows = rows[-self.capacity:]
+    with self._cond:
+      start = self.seq
+      for x, values in rows:
+        i = self.seq % self.capacity
+        self._columns[0][i] = x
+        for j, v in enumerate(values, 1):
+          self._columns[j][i] = v
+        self.seq += 1
+      if start == 0:
+        event = self.snapshot()[1]
+      else:
+        event = _event(self.seq, 'rows', '{"rows":%s}' % _json_rows(
+            self._columns, start, len(rows), self.capacity))
+      self._events.append((start, self.seq, event))
+      self._cond.notify_all()
+    return len(rows)
+
+  def snapshot(self):
+    """Returns (seq, event) for the buffered rows; call with the lock held."""
+    if self._snapshot is None or self._snapshot[0] != self.seq:
+      n = len(self)
+      meta = json.dumps({
+        'labels': self.labels,
+        'is_date': self.is_date,
+        'capacity': self.capacity,
+      }, sort_keys=True)
+      payload = '%s, "rows": %s}' % (meta[:-1], _json_rows(self._columns,
+          self.seq - n, n, self.capacity))
+      self._snapshot = (self.seq, _event(self.seq, 'snapshot', payload))
+    return self._snapshot
+
+  def close(self):
+    with self._cond:
+      self.closed = True
+      self._cond.notify_all()
+
+  def _catch_up(self, seq):
+    """Returns (seq, events) bringing a subscriber at seq up to date.
+
+    Call with the lock held.
+    """
+    if seq == self.seq:
+      return seq, []
+    if seq is not None and seq < self.seq:
+      for k, (start, _, _) in enumerate(self._events):
+        if start == seq:
+          return self.seq, [e for _, _, e in itertools.islice(
+              self._events, k, None)]
+    # new, or behind by more than the event log holds
+    seq, event = self.snapshot()
+    return seq, [event]
+
+  def events(self, last_seq=None, keepalive=15.0):
+    """Yields encoded events for a subscriber that has seen last_seq rows.
+
+    Starts with a snapshot unless last_seq can be continued from the
+    event log; yields a comment every keepalive seconds without events,
+    so dead connections are noticed. Ends when the channel is closed.
+    """
+    with self._cond:
+      seq, pending = self._catch_up(last_seq)
+    while True:
+      for event in pending:
+        yield event
+      with self._cond:
+        while self.seq == seq and not self.closed:
+          if not self._cond.wait(keepalive):
+            break
+        if self.closed:
+          return
+        if self.seq == seq:
+          pending = [b': keepalive\n\n']
+        else:
+          seq, pending = self._catch_up(seq)
+
+class Channels(object):
+  """The live channels by name, bounded in number and rows."""
+
+  def __init__(self, max_channels=64, max_capacity=1 << 20):
+    self.max_channels = max_channels
+    self.max_capacity = max_capacity
+    self._channels = {}
+    self._lock = threading.Lock()
+
+  def get(self, name):
+    with self._lock:
+      return self._channels.get(name)
+
+  def ingest(self, name, text, capacity=None):
+    """Appends CSV text to channel name, creating it if needed.
+
+    Returns (channel, number of rows appended).
+    """
+    with self._lock:
+      channel = self._channels.get(name)
+      if channel is None:
+        if len(self._channels) >= self.max_channels:
+          raise Error('too many channels')
+        capacity = min(capacity or 10000, self.max_capacity)
+        channel = Channel.create(text, capacity)
+        self._channels[name] = channel
+        return channel, len(channel)
+    return channel, channel.append_csv(text)
+
+  def delete(self, name):
+    with self._lock:
+      channel = self._channels.pop(name, None)
+    if channel is not None:
+      channel.close()
+    return channel is not None
+
+  def close(self):
+    with self._lock:
+      channels = list(self._channels.values())
+      self._channels.clear()
+    for channel in channels:
+      channel.close()
+
+  def stats(self):
+    with self._lock:
+      return 'channels=%d rows=%d' % (len(self._channels),
+          sum(len(c) for c in self._channels.values()))
+
+def _selftest():
+  rv = 0
+  def check(what, ok):
+    nonlocal rv
+    if not ok:
+      print('FAIL: %s' % what)
+      rv = 1
+
+  def parse(event):
+    """Returns (id, kind, data) of an encoded event."""
+    lines = event.decode().split('\n')
+    return (int(lines[0][4:]), lines[1][7:], json.loads(lines[2][6:]))
+
+  def snapshot(channel):
+    with channel._cond:
+      return parse(channel.snapshot()[1])[2]
+
+  # a subscriber gets a snapshot, then the appended rows
+  channel = Channel.create('X,Y,Z\n1,10,\n2,20,0.5\n', 4, backlog=3)
+  subscriber = channel.events()
+  check('snapshot', parse(next(subscriber)) == (2, 'snapshot', {
+      'labels': ['X', 'Y', 'Z'], 'is_date': False, 'capacity': 4,
+      'rows': [[1, 10, None], [2, 20, 0.5]]}))
+  channel.append_csv('X,Y,Z\n3,30,1\n')
+  check('rows', parse(next(subscriber)) == (3, 'rows', {'rows': [[3, 30, 1]]}))
+  # the ring buffers wrap around and keep the last capacity rows in order
+  channel.append_csv('4,40,2\n5,50,3\n6,60,4\n')
+  check('wraparound', [r[0] for r in snapshot(channel)['rows']] == [3, 4, 5, 6]
+      and len(channel) == 4 and channel.seq == 6)
+  check('wraparound event', parse(next(subscriber)) == (6, 'rows',
+      {'rows': [[4, 40, 2], [5, 50, 3], [6, 60, 4]]}))
+  # of an append of more rows than that, the others are dropped
+  channel.append_csv(''.join('%d,%d,0\n' % (x, x) for x in range(7, 17)))
+  check('more than capacity', [r[0] for r in snapshot(channel)['rows']] ==
+      [13, 14, 15, 16] and channel.seq == 10)
+  check('more than capacity event', [r[0] for r in
+      parse(next(subscriber))[2]['rows']] == [13, 14, 15, 16])
+  # reconnecting subscribers continue from the event log while it reaches
+  for x in range(17, 20):
+    channel.append([(x, [x, 0])])
+  check('resume', [parse(e)[:2] for e in channel._catch_up(11)[1]] ==
+      [(12, 'rows'), (13, 'rows')])
+  check('resume current', channel._catch_up(13) == (13, []))
+  # and get a snapshot when they are behind by more than backlog events
+  check('backlog limit', [parse(e)[:2] for e in channel._catch_up(6)[1]] ==
+      [(13, 'snapshot')])
+  channel.append([(20, [20, 0])])
+  check('backlog limit subscriber', parse(next(subscriber))[:2] ==
+      (14, 'snapshot'))
+  channel.close()
+  check('closed', list(subscriber) == [])
+
+  # a header-only create leaves the kind of x to the first row
+  channel = Channel.create('Date,Y\n', 10)
+  check('header only: undecided', channel.is_date is None and len(channel) == 0)
+  channel.append_csv('2020/01/05,1\n2020/01/06 12:00,2\n')
+  got = snapshot(channel)
+  check('header only: dates', got['is_date'] and [r[0] for r in got['rows']] ==
+      [colstore.parse_date('2020/01/05'), colstore.parse_date('2020/01/06 12:00')])
+  check('header only: first rows as a snapshot',
+      channel._events[-1][2].startswith(b'id: 2\nevent: snapshot\n'))
+  numbers = Channel.create('X,Y\n1.5,1\n', 10)
+  check('numbers', numbers.is_date is False)
+  for channel, bad in ((numbers, '2020/01/07,3\n'), (numbers, '12abc,3\n'),
+      (channel, '3,3\n')):
+    try:
+      channel.append_csv(bad)
+      check('rejects %r' % bad, False)
+    except Error:
+      pass
+  check('nothing appended on errors', numbers.seq == 1 and channel.seq == 2)
+  print('test finished')
+  return rv
+
+if __name__ == '__main__':
+  if sys.argv[1:] == ['--test']:
+    sys.exit(_selftest())
+  sys.stderr.write('E: syntax: python3 live.py --test\n')
+  sys.exit(1)
@@ -0,0 +1,402 @@
+#!/usr/bin/python3
+'''
+Request metrics for ssi_server.py, exposed at /__metrics in the Prometheus
+text format when the server runs with --metrics:
+
+  ssi_http_requests_total{route,code}        requests answered
+  ssi_http_errors_total{route,kind}          4xx, 5xx and exceptions
+  ssi_http_request_duration_seconds{route}   latency histogram
+  ssi_http_response_bytes_total{route}       bytes written, headers included
+  ssi_http_phase_seconds_total{route,phase}  time in ssi (expanding
+                                             includes), cache (cache lookups
+                                             and the file reads behind them)
+                                             and write (socket writes)
+  ssi_http_requests_in_flight                requests being handled
+
+Routes are the special endpoints by path, and page, static and archive
+for the rest, so the number of series stays small.
+
+Every thread counts into a shard of its own, without locks; /__metrics
+adds the shards up, folding those of finished threads into one. Phases
+nest: time spent expanding includes during a cache lookup counts as ssi,
+not cache. When metrics are off, the hooks return at once.
+
+--trace FILE with --trace-sample P appends a JSON line for a random
+fraction P of the requests, with their phases, to find slow ones.
+
+With --workers, every process counts on its own and /__metrics answers
+for the process the connection landed on.
+
+Usage:
+
+  python3 metrics.py --test
+'''
+
+import bisect
+import json
+import random
+import sys
+import threading
+import time
+
+enabled = False
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0)
+PHASES = ('ssi', 'cache', 'write')
+MIME_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_clock = time.perf_counter
+_local = threading.local()
+_lock = threading.Lock()
+_shards = []
+_max_shards = 256
+_trace = None
+_trace_sample = 0.0
+_trace_lock = threading.Lock()
+
+class _Shard(object):
+  """The counters of one thread."""
+
+  def __init__(self, thread=None):
+    self.thread = thread
+    self.requests = {}   # (route, code) -> count
+    self.errors = {}     # (route, kind) -> count
+    self.latency = {}    # route -> bucket counts, then sum and count
+    self.bytes = {}      # route -> bytes
+    self.phases = {}     # (route, phase) -> seconds
+    self.in_flight = 0
+    # the request being handled
+    self.route = None
+    self.start = 0.0
+    self.nbytes = 0
+    self.stack = []
+    self.trace = None
+
+  def merge(self, other):
+    for mine, theirs in ((self.requests, other.requests),
+        (self.errors, other.errors), (self.bytes, other.bytes),
+        (self.phases, other.phases)):
+      for key, value in theirs.copy().items():
+        mine[key] = mine.get(key, 0) + value
+    for route, counts in other.latency.copy().items():
+      mine = self.latency.setdefault(route, [0] * (len(BUCKETS) + 3))
+      for i, value in enumerate(counts):
+        mine[i] += value
+    self.in_flight += other.in_flight
+
+def _shard():
+  shard = getattr(_local, 'shard', None)
+  if shard is None:
+    shard = _local.shard = _Shard(threading.current_thread())
+    with _lock:
+      if len(_shards) >= _max_shards:
+        _fold()
+      _shards.append(shard)
+  return shard
+
+def _fold():
+  """Folds the shards of finished threads into the first; needs _lock."""
+  alive = [s for s in _shards[1:] if s.thread.is_alive()]
+  for shard in _shards[1:]:
+    if not shard.thread.is_alive():
+      _shards[0].merge(shard)
+  _shards[1:] = alive
+
+def enable(trace=None, trace_sample=0.0):
+  """Turns metrics on; trace is a file to append sampled requests to."""
+  global enabled, _trace, _trace_sample
+  with _lock:
+    if not _shards:
+      _shards.append(_Shard())
+  _trace = trace
+  _trace_sample = trace_sample
+  enabled = True
+
+def start(route):
+  """Starts counting a request; returns a token for finish()."""
+  if not enabled:
+    return None
+  shard = _shard()
+  shard.in_flight += 1
+  shard.route = route
+  shard.nbytes = 0
+  shard.stack = []
+  shard.trace = {} if _trace and random.random() < _trace_sample else None
+  shard.start = _clock()
+  return shard
+
+def finish(shard, code, method=None, path=None, exception=False):
+  """Records a request started with start()."""
+  if shard is None:
+    return
+  elapsed = _clock() - shard.start
+  route = shard.route
+  shard.in_flight -= 1
+  key = (route, code)
+  shard.requests[key] = shard.requests.get(key, 0) + 1
+  kind = 'exception' if exception else '5xx' if code >= 500 else \
+      '4xx' if code >= 400 else None
+  if kind is not None:
+    key = (route, kind)
+    shard.errors[key] = shard.errors.get(key, 0) + 1
+  counts = shard.latency.get(route)
+  if counts is None:
+    counts = shard.latency[route] = [0] * (len(BUCKETS) + 3)
+  counts[bisect.bisect_left(BUCKETS, elapsed)] += 1
+  counts[-2] += elapsed
+  counts[-1] += 1
+  shard.bytes[route] = shard.bytes.get(route, 0) + shard.nbytes
+  if shard.trace is not None:
+    line = json.dumps({'time': round(time.time(), 3), 'method': method,
+        'path': path, 'route': route, 'code': code, 'bytes': shard.nbytes,
+        'seconds': round(elapsed, 6), 'phases': dict((k, round(v, 6))
+        for k, v in shard.trace.items())}, sort_keys=True)
+    with _trace_lock:
+      with open(_trace, 'a', encoding='UTF-8') as f:
+        f.write(line + '\n')
+  shard.route = None
+
+def _add_phase(shard, name, seconds):
+  key = (shard.route, name)
+  shard.phases[key] = shard.phases.get(key, 0.0) + seconds
+  if shard.trace is not None:
+    shard.trace[name] = shard.trace.get(name, 0.0) + seconds
+
+class _Phase(object):
+  """Times a phase of the current request; inner phases pause outer ones."""
+
+  __slots__ = ('name', 'shard', 'start')
+
+  def __init__(self, name):
+    self.name = name
+    self.shard = None
+
+  def __enter__(self):
+    shard = getattr(_local, 'shard', None)
+    if shard is None or shard.route is None:
+      return self
+    self.shard = shard
+    now = _clock()
+    if shard.stack:
+      outer = shard.stack[-1]
+      _add_phase(shard, outer.name, now - outer.start)
+    shard.stack.append(self)
+    self.start = now
+    return self
+
+  def __exit__(self, *exc):
+    shard = self.shard
+    if shard is None:
+      return False
+    self.shard = None
+    now = _clock()
+    _add_phase(shard, self.name, now - self.start)
+    shard.stack.pop()
+    if shard.stack:
+      shard.stack[-1].start = now
+    return False
+
+class _NoPhase(object):
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+_no_phase = _NoPhase()
+
+def phase(name):
+  """A context manager timing a phase (one of PHASES) of the request."""
+  return _Phase(name) if enabled else _no_phase
+
+def timed(name):
+  """Decorates a function whose calls are all in the given phase."""
+  def decorate(fn):
+    def wrapper(*args, **kwargs):
+      if not enabled:
+        return fn(*args, **kwargs)
+      with _Phase(name):
+        return fn(*args, **kwargs)
+    wrapper.__name__ = fn.__name__
+    wrapper.__doc__ = fn.__doc__
+    return wrapper
+  return decorate
+
+def wrote(nbytes, seconds):
+  """Records a socket write of the current request."""
+  shard = getattr(_local, 'shard', None)
+  if shard is None or shard.route is None:
+    return
+  shard.nbytes += nbytes
+  if shard.stack:
+    # a write inside another phase counts as write only
+    shard.stack[-1].start += seconds
+  _add_phase(shard, 'write', seconds)
+
+class MeteredWriter(object):
+  """Wraps a handler's wfile, timing and counting what is written."""
+
+  def __init__(self, wfile):
+    self._wfile = wfile
+
+  def write(self, data):
+    start = _clock()
+    n = self._wfile.write(data)
+    wrote(len(data), _clock() - start)
+    return n
+
+  def __getattr__(self, name):
+    return getattr(self._wfile, name)
+
+def sendfile(sock, f, offset=0, count=None):
+  """socket.sendfile, timed and counted."""
+  if not enabled:
+    return sock.sendfile(f, offset, count)
+  start = _clock()
+  n = sock.sendfile(f, offset, count)
+  wrote(n, _clock() - start)
+  return n
+
+def _labels(**labels):
+  return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+      .replace('"', '\\"')) for k, v in sorted(labels.items()))
+
+def render():
+  """Returns all metrics in the Prometheus text format."""
+  total = _Shard()
+  with _lock:
+    _fold()
+    shards = list(_shards)
+  for shard in shards:
+    total.merge(shard)
+  out = []
+  def family(name, kind, help):
+    out.append('# HELP %s %s' % (name, help))
+    out.append('# TYPE %s %s' % (name, kind))
+  family('ssi_http_requests_total', 'counter', 'Requests answered.')
+  for (route, code), n in sorted(total.requests.items()):
+    out.append('ssi_http_requests_total%s %d' % (_labels(route=route,
+        code=code), n))
+  family('ssi_http_errors_total', 'counter',
+      'Requests answered with 4xx or 5xx, or failing with an exception.')
+  for (route, kind), n in sorted(total.errors.items()):
+    out.append('ssi_http_errors_total%s %d' % (_labels(route=route,
+        kind=kind), n))
+  family('ssi_http_request_duration_seconds', 'histogram',
+      'Time to handle a request.')
+  for route, counts in sorted(total.latency.items()):
+    cumulative = 0
+    for bound, n in zip(BUCKETS + ('+Inf',), counts):
+      cumulative += n
+      out.append('ssi_http_request_duration_seconds_bucket%s %d' % (
+          _labels(route=route, le=bound), cumulative))
+    out.append('ssi_http_request_duration_seconds_sum%s %.6f' % (
+        _labels(route=route), counts[-2]))
+    out.append('ssi_http_request_duration_seconds_count%s %d' % (
+        _labels(route=route), counts[-1]))
+  family('ssi_http_response_bytes_total', 'counter',
+      'Bytes written in answers, headers included.')
+  for route, n in sorted(total.bytes.items()):
+    out.append('ssi_http_response_bytes_total%s %d' % (_labels(route=route),
+        n))
+  family('ssi_http_phase_seconds_total', 'counter',
+      'Time spent in SSI expansion, cache lookups and file reads, and '
+      'socket writes.')
+  for (route, name), seconds in sorted(total.phases.items()):
+    out.append('ssi_http_phase_seconds_total%s %.6f' % (_labels(route=route,
+        phase=name), seconds))
+  family('ssi_http_requests_in_flight', 'gauge', 'Requests being handled.')
+  out.append('ssi_http_requests_in_flight %d' % total.in_flight)
+  out.append('')
+  return '\n'.join(out).encode('UTF-8')
+
+def _selftest():
+  import os
+  import tempfile
+
+  rv = 0
+  def check(what, ok):
+    nonlocal rv
+    if not ok:
+      print('FAIL: %s' % what)
+      rv = 1
+
+  fd, trace = tempfile.mkstemp()
+  os.close(fd)
+  enable(trace, 1.0)
+
+  @timed('cache')
+  def lookup():
+    time.sleep(0.01)
+    with phase('ssi'):
+      time.sleep(0.02)
+
+  def request(route, code):
+    token = start(route)
+    lookup()
+    wrote(100, 0.005)
+    finish(token, code, 'GET', '/x')
+
+  threads = [threading.Thread(target=request, args=('page', 200))
+      for _ in range(20)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  request('/__data', 404)
+  text = render().decode()
+  lines = dict(line.rsplit(' ', 1) for line in text.split('\n')
+      if line and not line.startswith('#'))
+  check('requests', lines['ssi_http_requests_total{code="200",route="page"}']
+      == '20')
+  check('errors', lines['ssi_http_errors_total{kind="4xx",route="/__data"}']
+      == '1')
+  check('histogram', lines['ssi_http_request_duration_seconds_bucket'
+      '{le="+Inf",route="page"}'] == '20' and lines[
+      'ssi_http_request_duration_seconds_bucket{le="0.01",route="page"}'] ==
+      '0')
+  check('bytes', lines['ssi_http_response_bytes_total{route="page"}'] ==
+      '2000')
+  ssi = float(lines['ssi_http_phase_seconds_total{phase="ssi",route="page"}'])
+  cache = float(lines[
+      'ssi_http_phase_seconds_total{phase="cache",route="page"}'])
+  # sleeps overrun under load, but cache would exceed ssi if the nested
+  # ssi time were counted in it too
+  check('nested phases %.3f %.3f' % (ssi, cache), 0.4 <= ssi and
+      0.2 <= cache < ssi)
+  check('in flight', lines['ssi_http_requests_in_flight'] == '0')
+  check('shards folded', len(_shards) <= 2)
+  with open(trace) as f:
+    records = [json.loads(line) for line in f]
+  check('trace', len(records) == 21 and set(records[0]['phases']) ==
+      set(PHASES))
+  os.unlink(trace)
+
+  # the cost of the hooks per request, on and off
+  n = 20000
+  def hooks():
+    for _ in range(n):
+      token = start('static')
+      with phase('cache'):
+        pass
+      wrote(10, 0.0)
+      finish(token, 200)
+  global enabled, _trace
+  _trace = None
+  t0 = _clock()
+  hooks()
+  on = (_clock() - t0) / n
+  enabled = False
+  t0 = _clock()
+  hooks()
+  off = (_clock() - t0) / n
+  print('hooks per request: %.1f us on, %.2f us off' % (on * 1e6, off * 1e6))
+  print('test finished')
+  return rv
+
+if __name__ == '__main__':
+  if sys.argv[1:] == ['--test']:
+    sys.exit(_selftest())
+  sys.stderr.write('E: syntax: python3 metrics.py --test\n')
+  sys.exit(1)
@@ -0,0 +1,440 @@
+#!/usr/bin/python3
+'''
+Multi-resolution pyramid files for the /__data endpoint of ssi_server.py.
+
+Usage:
+
+  python3 pyramid.py [--layout LAYOUT] input.csv output.pyr
+  python3 pyramid.py --info file.pyr
+  python3 pyramid.py --test
+
+A pyramid holds, for k = 0, 1, 2, ..., the rows of a CSV file aggregated
+into buckets of 2**k consecutive rows: the x range of every bucket and,
+per series, the lowest low, highest high, mean of the central values and
+the count of rows with a value. LAYOUT is that of the CSV file (plain,
+errorBars, customBars or fractions); lows and highs are the values
+themselves, value -/+ stddev, the low and high of the low;center;high
+tuples and the fraction's value, respectively.
+
+The file is an 8-byte magic, a little JSON header and then flat arrays of
+doubles, so a server maps it and answers a query for about N points of an
+x range by bisecting the finest x array for the row range and slicing
+the one level whose buckets give at most N points, independent of the
+length of the data set; nothing is parsed or loaded per query, and all
+processes serving the same file share its pages.
+
+Answers are CSV in customBars form (low;mean;high per series), or with
+just the means.
+'''
+
+import array
+import bisect
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+
+import colstore
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+_magic = b'DYPYR\0\1\n'
+_inf = float('inf')
+
+# The arrays of a level are x_lo and x_hi, then low, high, mean and count
+# for every series.
+
+class Error(Exception):
+  pass
+
+def _bounds(layout):
+  """Returns a function mapping a row's fields to (low, center, high)s."""
+  pf = colstore.parse_float
+  if layout == 'errorBars':
+    def bounds(fields):
+      out = []
+      for j in range(0, len(fields) - 1, 2):
+        v, sd = pf(fields[j]), pf(fields[j + 1])
+        sd = 0.0 if sd != sd else sd
+        out.append((v - sd, v, v + sd))
+      return out
+    return bounds
+  if layout == 'customBars':
+    def bounds(fields):
+      out = []
+      for v in fields:
+        parts = v.split(';')
+        if len(parts) == 3:
+          out.append(tuple(pf(p) for p in parts))
+        else:
+          out.append((math.nan,) * 3)
+      return out
+    return bounds
+  center = colstore._center(layout)
+  return lambda fields: [(v, v, v) for v in center(fields)]
+
+def read_csv(path, layout='plain'):
+  """Parses a CSV file; returns (labels, is_date, x, [(low, mid, high)])."""
+  if layout not in colstore.LAYOUTS:
+    raise Error('unknown layout %r' % layout)
+  with open(path, 'rb') as f:
+    _, labels, _, lines = colstore.parse_lines(f.read())
+  nseries = len(labels) - 1
+  bounds = _bounds(layout)
+  parse_x = None
+  rows = []
+  for _, _, fields in lines:
+    if parse_x is None:
+      parse_x = colstore.x_parser(fields[0])
+    x = parse_x(fields[0])
+    if x != x:
+      continue
+    values = bounds(fields[1:])[:nseries]
+    values.extend([(math.nan,) * 3] * (nseries - len(values)))
+    rows.append((x, values))
+  rows.sort(key=lambda row: row[0])
+  x = array.array('d', (row[0] for row in rows))
+  series = []
+  for j in range(nseries):
+    low = array.array('d')
+    mid = array.array('d')
+    high = array.array('d')
+    for _, values in rows:
+      lo, m, hi = values[j]
+      low.append(lo)
+      mid.append(m)
+      high.append(hi)
+    series.append((low, mid, high))
+  return labels, parse_x is colstore.parse_date, x, series
+
+def _level0(x, series):
+  """The finest level: one bucket per row."""
+  arrays = [x, array.array('d', x)]
+  for low, mid, high in series:
+    lows = array.array('d')
+    highs = array.array('d')
+    means = array.array('d')
+    counts = array.array('d')
+    for l, m, h in zip(low, mid, high):
+      if m != m:
+        lows.append(_inf)
+        highs.append(-_inf)
+        means.append(0.0)
+        counts.append(0.0)
+        continue
+      lows.append(l if l == l else m)
+      highs.append(h if h == h else m)
+      means.append(m)
+      counts.append(1.0)
+    arrays.extend((lows, highs, means, counts))
+  return arrays
+
+def _coarsen(arrays):
+  """Combines pairs of buckets; an odd last bucket stays alone."""
+  n = len(arrays[0])
+  if numpy is not None:
+    a = [numpy.frombuffer(arr, dtype=numpy.float64) for arr in arrays]
+    even = n - n % 2
+    def pairs(v, fn):
+      out = fn(v[0:even:2], v[1:even:2])
+      return numpy.concatenate((out, v[even:])) if n % 2 else out
+    out = [pairs(a[0], numpy.minimum), pairs(a[1], numpy.maximum)]
+    for s in range(2, len(a), 4):
+      low, high, mean, count = a[s:s + 4]
+      c = pairs(count, numpy.add)
+      total = pairs(mean * count, numpy.add)
+      out.append(pairs(low, numpy.minimum))
+      out.append(pairs(high, numpy.maximum))
+      with numpy.errstate(invalid='ignore', divide='ignore'):
+        out.append(numpy.where(c > 0, total / numpy.where(c > 0, c, 1), 0.0))
+      out.append(c)
+    return [array.array('d', v.tobytes()) for v in out]
+  idx = range(0, n, 2)
+  def pairs(v, fn):
+    return array.array('d', (fn(v[i], v[i + 1]) if i + 1 < n else v[i]
+        for i in idx))
+  add = lambda p, q: p + q
+  out = [pairs(arrays[0], min), pairs(arrays[1], max)]
+  for s in range(2, len(arrays), 4):
+    low, high, mean, count = arrays[s:s + 4]
+    c = pairs(count, add)
+    total = pairs(array.array('d', (m * k for m, k in zip(mean, count))), add)
+    out.append(pairs(low, min))
+    out.append(pairs(high, max))
+    out.append(array.array('d', (t / k if k else 0.0 for t, k in zip(total, c))))
+    out.append(c)
+  return out
+
+def build(csv_path, out_path, layout='plain'):
+  labels, is_date, x, series = read_csv(csv_path, layout)
+  levels = [_level0(x, series)]
+  while len(levels[-1][0]) > 1:
+    levels.append(_coarsen(levels[-1]))
+  header = {
+    'labels': labels,
+    'layout': layout,
+    'is_date': is_date,
+    'nrows': len(x),
+    'byteorder': sys.byteorder,
+    'levels': [],
+  }
+  # offsets depend on the header length, which depends on the offsets
+  size = 0
+  while True:
+    offset = len(_magic) + 4 + size
+    offset += -offset % 8
+    header['levels'] = []
+    for level in levels:
+      header['levels'].append({'offset': offset, 'n': len(level[0])})
+      offset += 8 * len(level[0]) * len(level)
+    blob = json.dumps(header, sort_keys=True).encode('UTF-8')
+    if len(blob) == size:
+      break
+    size = len(blob)
+  tmp = out_path + '.tmp'
+  with open(tmp, 'wb') as f:
+    f.write(_magic + struct.pack('<I', len(blob)) + blob)
+    f.write(b'\0' * (header['levels'][0]['offset'] - f.tell()))
+    for level in levels:
+      for arr in level:
+        arr.tofile(f)
+  os.replace(tmp, out_path)
+  return header
+
+class Pyramid(object):
+  """A memory-mapped pyramid file."""
+
+  def __init__(self, path):
+    with open(path, 'rb') as f:
+      self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      header = self._header(path)
+    except Exception:
+      self._map.close()
+      raise
+    self.labels = header['labels']
+    self.layout = header['layout']
+    self.is_date = header['is_date']
+    self.nrows = header['nrows']
+    self.nseries = len(self.labels) - 1
+    self._view = memoryview(self._map).cast('d')
+    self._levels = [(level['offset'] // 8, level['n'])
+        for level in header['levels']]
+
+  def _header(self, path):
+    if self._map[:len(_magic)] != _magic:
+      raise Error('%s is not a pyramid file' % path)
+    n, = struct.unpack_from('<I', self._map, len(_magic))
+    start = len(_magic) + 4
+    header = json.loads(self._map[start:start + n].decode('UTF-8'))
+    if header['byteorder'] != sys.byteorder:
+      raise Error('%s was built on a %s-endian machine' % (
+          path, header['byteorder']))
+    return header
+
+  def close(self):
+    self._view.release()
+    self._map.close()
+
+  def column(self, k, j):
+    """Returns array j of level k as a memoryview of doubles."""
+    base, n = self._levels[k]
+    return self._view[base + j * n:base + (j + 1) * n]
+
+  def parse_x(self, s):
+    return colstore.parse_bound(s, self.is_date)
+
+  def query(self, x0=None, x1=None, points=1000):
+    """Returns (k, lo, hi): level k buckets [lo, hi) cover [x0, x1].
+
+    As in ColumnStore.window(), one row beyond each end is included.
+    """
+    if not self.nrows:
+      return 0, 0, 0
+    xs = self.column(0, 0)
+    lo = 0 if x0 is None else max(0, bisect.bisect_left(xs, x0) - 1)
+    hi = self.nrows if x1 is None else min(self.nrows,
+        bisect.bisect_right(xs, x1) + 1)
+    hi = max(lo, hi)
+    k = 0
+    points = max(points, 1)
+    while k + 1 < len(self._levels) and ((hi - 1) >> k) - (lo >> k) + 1 > points:
+      k += 1
+    return k, lo >> k, ((hi - 1) >> k) + 1 if hi > lo else lo >> k
+
+  def _format_x(self, x):
+    if self.is_date:
+      return colstore.format_date(x)
+    return repr(x)
+
+  def columns(self, k, lo, hi, mean_only=False):
+    """Returns (x, columns) of buckets [lo, hi) of level k.
+
+    The columns are low, mean and high per series, or just the means, as
+    arrays of doubles with NaN for empty buckets.
+    """
+    x_lo = self.column(k, 0)[lo:hi]
+    x_hi = self.column(k, 1)[lo:hi]
+    x = array.array('d', ((a + b) / 2 for a, b in zip(x_lo, x_hi)))
+    out = []
+    for s in range(self.nseries):
+      base = 2 + 4 * s
+      count = self.column(k, base + 3)[lo:hi]
+      wanted = (2,) if mean_only else (0, 2, 1)
+      for j in wanted:
+        values = self.column(k, base + j)[lo:hi]
+        out.append(array.array('d', (v if c else math.nan
+            for v, c in zip(values, count))))
+    return x, out
+
+  def csv(self, k, lo, hi, mean_only=False):
+    """Returns buckets [lo, hi) of level k as CSV text."""
+    x_lo = self.column(k, 0)[lo:hi]
+    x_hi = self.column(k, 1)[lo:hi]
+    cols = []
+    for s in range(self.nseries):
+      base = 2 + 4 * s
+      cols.append([self.column(k, base + j)[lo:hi] for j in range(4)])
+    out = [','.join(self.labels)]
+    for i in range(hi - lo):
+      fields = [self._format_x((x_lo[i] + x_hi[i]) / 2)]
+      for low, high, mean, count in cols:
+        if not count[i]:
+          fields.append('')
+        elif mean_only:
+          fields.append(repr(mean[i]))
+        else:
+          fields.append('%r;%r;%r' % (low[i], mean[i], high[i]))
+      out.append(','.join(fields))
+    out.append('')
+    return '\n'.join(out).encode('UTF-8')
+
+def _selftest():
+  import random
+  import shutil
+  import tempfile
+
+  rv = 0
+  def check(what, ok):
+    nonlocal rv
+    if not ok:
+      print('FAIL: %s' % what)
+      rv = 1
+
+  rng = random.Random(1)
+  n = 3000
+  lines = ['X,A,B']
+  for i in range(n):
+    fields = ['' if rng.random() < 0.05 else repr(rng.uniform(-100, 100))
+        for _ in range(2)]
+    if i > 2000 and i < 2100:
+      fields[1] = ''
+    lines.append('%r,%s' % (i * 0.5, ','.join(fields)))
+  tmp = tempfile.mkdtemp()
+  csv_path = os.path.join(tmp, 'data.csv')
+  with open(csv_path, 'w') as f:
+    f.write('\n'.join(lines) + '\n')
+  store = colstore.ColumnStore.load(csv_path)
+  build(csv_path, os.path.join(tmp, 'data.pyr'))
+  p = Pyramid(os.path.join(tmp, 'data.pyr'))
+  # every bucket holds the minimum and maximum colstore finds in its rows
+  for x0, x1, points in ((None, None, 100), (100.2, 900, 50), (990, 1010, 3),
+      (None, 10, 1000), (1450, None, 7)):
+    k, lo, hi = p.query(x0, x1, points)
+    rlo, rhi = store.window(x0, x1)
+    what = '%s-%s/%d' % (x0, x1, points)
+    check(what + ': range', (lo, hi) == (rlo >> k, ((rhi - 1) >> k) + 1) and
+        (hi - lo <= points or k == len(p._levels) - 1) and
+        (k == 0 or ((rhi - 1) >> (k - 1)) - (rlo >> (k - 1)) + 1 > points))
+    for j in range(2):
+      low, high, mean, count = [p.column(k, 2 + 4 * j + c)[lo:hi]
+          for c in range(4)]
+      for b in range(lo, hi):
+        start, end = b << k, min((b + 1) << k, n)
+        rows = list(colstore._minmax([store.series[j]], [start, end]))
+        i = b - lo
+        values = [v for v in store.series[j][start:end] if v == v]
+        if len(rows) == 1:
+          ok = count[i] == 0
+        else:
+          ok = (low[i], high[i], count[i]) == (store.series[j][rows[0]],
+              store.series[j][rows[1]], len(values)) and abs(
+              mean[i] - sum(values) / len(values)) < 1e-9
+        if not ok:
+          check('%s: series %d bucket %d' % (what, j, b), False)
+          break
+    # the answer parses back, in customBars form, to the buckets' means
+    again = colstore.ColumnStore(p.csv(k, lo, hi), 'customBars')
+    x, columns = p.columns(k, lo, hi, mean_only=True)
+    check(what + ': csv', list(again.x) == list(x) and all(
+        [v for v in again.series[j] if v == v] ==
+        [v for v in columns[j] if v == v] for j in range(2)))
+    del low, high, mean, count
+  p.close()
+
+  # dates, with a bucket midpoint on half a millisecond
+  start = colstore.parse_date('2020/01/01')
+  with open(csv_path, 'w') as f:
+    f.write('Date,A\n2020/01/01 00:00:00.999,1\n2020/01/01 00:00:01,2\n'
+        '2020/01/01 00:00:01.250,3\n')
+  build(csv_path, os.path.join(tmp, 'dates.pyr'))
+  p = Pyramid(os.path.join(tmp, 'dates.pyr'))
+  want = [start + 999, start + 1000, start + 1250]
+  for k, points in ((0, 3), (1, 2)):
+    x, _ = p.columns(k, 0, 3 >> k, mean_only=True)
+    again = colstore.ColumnStore(p.csv(k, 0, 3 >> k))
+    check('dates at level %d' % k, p.is_date and again.is_date and
+        list(again.x) == [round(v) for v in x] and (k or list(x) == want))
+  check('half a millisecond', p._format_x(start + 999.5) ==
+      '2020/01/01 00:00:01')
+  p.close()
+
+  bad = os.path.join(tmp, 'bad.pyr')
+  with open(bad, 'wb') as f:
+    f.write(b'not a pyramid')
+  fds = '/proc/self/fd'
+  before = len(os.listdir(fds)) if os.path.isdir(fds) else None
+  error = None
+  try:
+    Pyramid(bad)
+    check('bad magic', False)
+  except Error as e:
+    # the traceback keeps the half-made Pyramid alive
+    error = e
+  check('bad magic: unmapped', before is None or len(os.listdir(fds)) == before)
+  del error
+  shutil.rmtree(tmp)
+  print('test finished')
+  return rv
+
+if __name__ == '__main__':
+  args = sys.argv[1:]
+  if args == ['--test']:
+    sys.exit(_selftest())
+  if len(args) == 2 and args[0] == '--info':
+    p = Pyramid(args[1])
+    print('%s: %d rows, layout %s, labels %s' % (args[1], p.nrows, p.layout,
+        ','.join(p.labels)))
+    for k, (_, n) in enumerate(p._levels):
+      print('  level %d: %d buckets' % (k, n))
+    sys.exit(0)
+  layout = 'plain'
+  if len(args) == 4 and args[0] == '--layout':
+    layout = args[1]
+    args = args[2:]
+  if len(args) != 2:
+    sys.stderr.write('E: syntax: python3 pyramid.py [--layout LAYOUT] input.csv output.pyr\n'
+        '   or: python3 pyramid.py --info file.pyr\n')
+    sys.exit(1)
+  try:
+    header = build(args[0], args[1], layout)
+  except (Error, OSError) as e:
+    sys.stderr.write('E: %s\n' % e)
+    sys.exit(1)
+  print('%s: %d rows, %d levels' % (args[1], header['nrows'],
+      len(header['levels'])))
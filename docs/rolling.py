@@ -0,0 +1,600 @@
+#!/usr/bin/python3
+'''
+Server-side rolling averages for the /__rolled endpoint of ssi_server.py.
+
+This computes what the data handlers in src/datahandler do on the client
+when rollPeriod is set, so that clients can be sent rolled data instead:
+
+  default        DefaultHandler (plain values)
+  errorBars      ErrorBarsHandler (value, stddev pairs; sigma)
+  customBars     CustomBarsHandler (low;center;high)
+  fractions      DefaultFractionHandler (num/den, no bars)
+  fractionsBars  FractionsBarsHandler (num/den; sigma, wilsonInterval)
+
+extractSeries and rollingAverage are implemented twice: reference_roll()
+is a line-by-line port of the JavaScript, including its treatment of null
+(an empty field) and NaN, and roll() computes the same with NumPy using
+cumulative sums; it falls back to the reference without NumPy.
+
+Usage:
+
+  python3 rolling.py --test
+
+checks both against the expectations of auto_tests/tests/rolling_average.js
+and against each other on random data.
+'''
+
+import array
+import math
+import random
+import re
+import sys
+
+import colstore
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+MODES = ('default', 'errorBars', 'customBars', 'fractions', 'fractionsBars')
+BAR_MODES = ('errorBars', 'customBars', 'fractionsBars')
+
+_nan = float('nan')
+_blank = re.compile(r'^ *$')
+_nanstr = re.compile(r'^ *nan *$', re.I)
+
+def _isnan(v):
+  """JavaScript isNaN() for a number or null (None)."""
+  return v is not None and v != v
+
+def _num(v):
+  """JavaScript ToNumber() of a number or null, as used by + and -."""
+  return 0.0 if v is None else v
+
+def parse_value(s):
+  """utils.parseFloat_: a number, None for null, or NaN."""
+  if s is None:
+    return None
+  m = colstore._number.match(s)
+  if m is not None:
+    return float(m.group(0).replace('Infinity', 'inf'))
+  if _blank.match(s):
+    return None
+  if _nanstr.match(s):
+    return _nan
+  return None
+
+def parse_field(mode, fields, j):
+  """Parses series j of a row like parseCSV_; returns a number or tuple.
+
+  None stands for a null point.
+  """
+  if mode in ('fractions', 'fractionsBars'):
+    if j >= len(fields):
+      return None
+    vals = fields[j].split('/')
+    if len(vals) != 2:
+      return (0.0, 0.0)
+    return (parse_value(vals[0]), parse_value(vals[1]))
+  if mode == 'errorBars':
+    k = 2 * j
+    if k >= len(fields):
+      return None
+    return (parse_value(fields[k]),
+        parse_value(fields[k + 1] if k + 1 < len(fields) else None))
+  if mode == 'customBars':
+    if j >= len(fields):
+      return None
+    if _blank.match(fields[j]):
+      return (None, None, None)
+    vals = fields[j].split(';')
+    if len(vals) != 3:
+      return None
+    return tuple(parse_value(v) for v in vals)
+  return parse_value(fields[j]) if j < len(fields) else None
+
+def read_csv(data, mode):
+  """Parses CSV bytes; returns (labels, x strings, [[point per row]])."""
+  if mode not in MODES:
+    raise colstore.Error('unknown mode %r' % mode)
+  _, labels, _, lines = colstore.parse_lines(data)
+  nseries = len(labels) - 1
+  rows = []
+  parse_x = None
+  for _, _, fields in lines:
+    if parse_x is None:
+      parse_x = colstore.x_parser(fields[0])
+    rows.append((parse_x(fields[0]), fields[0],
+        [parse_field(mode, fields[1:], j) for j in range(nseries)]))
+  # parseCSV_ sorts rows that are out of order
+  if any(rows[i][0] > rows[i + 1][0] for i in range(len(rows) - 1)):
+    rows.sort(key=lambda row: row[0])
+  xs = [row[1] for row in rows]
+  series = [[row[2][j] for row in rows] for j in range(nseries)]
+  return labels, xs, series
+
+# The reference implementation: the JavaScript, transliterated. Points are
+# numbers, tuples or None for null; results are lists of (y, low, high).
+
+def reference_extract(mode, points, sigma=2.0, logscale=False):
+  """extractSeries, minus the x values."""
+  out = []
+  for point in points:
+    if mode == 'default':
+      if logscale and (point is None or point <= 0):
+        point = None
+      out.append((point, None))
+      continue
+    if logscale and point is not None:
+      if mode == 'errorBars':
+        bad = (_num(point[0]) <= 0 or
+            _num(point[0]) - sigma * _num(point[1]) <= 0)
+      elif mode == 'customBars':
+        bad = any(_num(v) <= 0 for v in point)
+      else:
+        bad = _num(point[0]) <= 0 or _num(point[1]) <= 0
+      if bad:
+        point = None
+    if mode == 'errorBars':
+      if point is None:
+        out.append((None, (None, None, None)))
+        continue
+      y = point[0]
+      if y is not None and y == y:
+        variance = sigma * _num(point[1])
+        out.append((y, (y - variance, y + variance, point[1])))
+      else:
+        out.append((y, (y, y, y)))
+    elif mode == 'customBars':
+      if point is None:
+        out.append((None, (None, None)))
+        continue
+      y = point[1]
+      if y is not None and y == y:
+        out.append((y, (point[0], point[2])))
+      else:
+        out.append((y, (y, y)))
+    elif mode == 'fractions':
+      if point is None:
+        out.append((None, (None, None)))
+        continue
+      num, den = point
+      if num is not None and num == num:
+        value = num / den if den else 0.0
+        out.append((100.0 * value, (num, den)))
+      else:
+        out.append((num, (num, den)))
+    else:
+      if point is None:
+        out.append((None, (None, None, None, None)))
+        continue
+      num, den = point
+      if num is not None and num == num:
+        value = num / den if den else 0.0
+        stddev = sigma * _sqrt(value * (1 - value) / den) if den else 1.0
+        variance = 100.0 * stddev
+        y = 100.0 * value
+        out.append((y, (y - variance, y + variance, num, den)))
+      else:
+        out.append((num, (num, num, num, den)))
+  return out
+
+def _sqrt(v):
+  return math.sqrt(v) if v >= 0 else _nan
+
+def _div(a, b):
+  """JavaScript division: by zero gives an infinity or NaN."""
+  if b:
+    return a / b
+  if a != a or not a:
+    return _nan
+  return math.copysign(math.inf, a) * math.copysign(1.0, b)
+
+def reference_roll(mode, points, roll_period, sigma=2.0, wilson=True,
+    logscale=False):
+  """rollingAverage of the data handler for mode."""
+  data = reference_extract(mode, points, sigma, logscale)
+  n = len(data)
+  roll_period = min(roll_period, n)
+  out = []
+  if mode == 'default':
+    if roll_period == 1:
+      return [(y, None, None) for y, _ in data]
+    for i in range(n):
+      total = 0.0
+      num_ok = 0
+      for j in range(max(0, i - roll_period + 1), i + 1):
+        y = data[j][0]
+        if y is None or y != y:
+          continue
+        num_ok += 1
+        total += y
+      out.append((total / num_ok if num_ok else None, None, None))
+    return out
+  if mode == 'errorBars':
+    for i in range(n):
+      total = variance = 0.0
+      num_ok = 0
+      for j in range(max(0, i - roll_period + 1), i + 1):
+        y = data[j][0]
+        if y is None or y != y:
+          continue
+        num_ok += 1
+        total += y
+        variance += _num(data[j][1][2]) ** 2
+      if num_ok:
+        stddev = _sqrt(variance) / num_ok
+        value = total / num_ok
+        out.append((value, value - sigma * stddev, value + sigma * stddev))
+      else:
+        v = data[i][0] if roll_period == 1 else None
+        out.append((v, v, v))
+    return out
+  if mode == 'customBars':
+    low = mid = high = 0.0
+    count = 0
+    for i in range(n):
+      y, extremes = data[i]
+      if y is not None and y == y:
+        low += _num(extremes[0])
+        mid += y
+        high += _num(extremes[1])
+        count += 1
+      if i - roll_period >= 0:
+        prev = data[i - roll_period]
+        if prev[0] is not None and prev[0] == prev[0]:
+          low -= _num(prev[1][0])
+          mid -= prev[0]
+          high -= _num(prev[1][1])
+          count -= 1
+      if count:
+        out.append((mid / count, low / count, high / count))
+      else:
+        out.append((None, None, None))
+    return out
+  # fractions, with (fractionsBars) or without bars
+  a, b = (0, 1) if mode == 'fractions' else (2, 3)
+  num = den = 0.0
+  for i in range(n):
+    num += _num(data[i][1][a])
+    den += _num(data[i][1][b])
+    if i - roll_period >= 0:
+      num -= _num(data[i - roll_period][1][a])
+      den -= _num(data[i - roll_period][1][b])
+    value = num / den if den and den == den else 0.0
+    if mode == 'fractions':
+      out.append((100.0 * value, None, None))
+    elif wilson:
+      if den and den == den:
+        p = 0 if value < 0 else value
+        pm = sigma * _sqrt(p * (1 - p) / den + sigma * sigma / (4 * den * den))
+        denom = 1 + sigma * sigma / den
+        lo = _div(p + sigma * sigma / (2 * den) - pm, denom)
+        hi = _div(p + sigma * sigma / (2 * den) + pm, denom)
+        out.append((p * 100.0, lo * 100.0, hi * 100.0))
+      else:
+        out.append((0, 0, 0))
+    else:
+      stddev = sigma * _sqrt(value * (1 - value) / den) \
+          if den and den == den else 1.0
+      out.append((100.0 * value, 100.0 * (value - stddev),
+          100.0 * (value + stddev)))
+  return out
+
+# The vectorised implementation. Columns are float arrays with NaN where
+# the JavaScript has NaN, plus a mask of where it has null.
+
+def _columns(points, width):
+  """Returns (values, nulls) arrays of shape (width, n), and point nulls."""
+  n = len(points)
+  values = numpy.full((width, n), numpy.nan)
+  nulls = numpy.ones((width, n), dtype=bool)
+  missing = numpy.zeros(n, dtype=bool)
+  for i, point in enumerate(points):
+    if point is None:
+      missing[i] = True
+      continue
+    if width == 1:
+      point = (point,)
+    for k, v in enumerate(point):
+      if v is not None:
+        values[k, i] = v
+        nulls[k, i] = False
+  return values, nulls, missing
+
+def _window_sum(v, period):
+  """Sum over the trailing window of period elements, like the JS loops."""
+  c = numpy.concatenate(([0.0], numpy.cumsum(v)))
+  idx = numpy.arange(1, len(v) + 1)
+  return c[idx] - c[numpy.maximum(idx - period, 0)]
+
+def _window_sum_nan(v, period):
+  """As _window_sum, but NaN in a window makes its sum NaN (and only it)."""
+  bad = numpy.isnan(v)
+  total = _window_sum(numpy.where(bad, 0.0, v), period)
+  total[_window_sum(bad.astype(float), period) > 0] = numpy.nan
+  return total
+
+def _running_sum(v, period):
+  """Like the incremental add/subtract loops: NaN poisons all later sums."""
+  total = _window_sum_nan(v, period)
+  bad = numpy.isnan(v)
+  if bad.any():
+    total[numpy.argmax(bad):] = numpy.nan
+  return total
+
+def roll(mode, points, roll_period, sigma=2.0, wilson=True, logscale=False):
+  """Like reference_roll(); returns (y, low, high, null) arrays.
+
+  Without NumPy, returns the reference result as lists.
+  """
+  if mode not in MODES:
+    raise colstore.Error('unknown mode %r' % mode)
+  if numpy is None:
+    rolled = reference_roll(mode, points, roll_period, sigma, wilson, logscale)
+    return ([_nan if r[0] is None else r[0] for r in rolled],
+        [_nan if r[1] is None else r[1] for r in rolled],
+        [_nan if r[2] is None else r[2] for r in rolled],
+        [r[0] is None for r in rolled])
+  n = len(points)
+  period = max(1, min(roll_period, n))
+  nan = numpy.full(n, numpy.nan)
+  width = {'default': 1, 'errorBars': 2, 'customBars': 3}.get(mode, 2)
+  values, nulls, missing = _columns(points, width)
+  # JavaScript arithmetic (and comparison) treats null as 0
+  numeric = numpy.where(nulls, 0.0, values)
+  with numpy.errstate(invalid='ignore', divide='ignore'):
+    if logscale and mode != 'default':
+      if mode == 'errorBars':
+        bad = (numeric[0] <= 0) | (numeric[0] - sigma * numeric[1] <= 0)
+      else:
+        bad = (numeric <= 0).any(axis=0)
+      bad &= ~missing
+      missing = missing | bad
+      nulls = nulls | bad
+      values = numpy.where(bad, numpy.nan, values)
+      numeric = numpy.where(bad, 0.0, numeric)
+
+    if mode == 'default':
+      y = values[0]
+      ynull = nulls[0] | missing
+      if logscale:
+        neg = ynull | (numeric[0] <= 0)
+        ynull = neg
+        y = numpy.where(neg, numpy.nan, y)
+      if period == 1:
+        return y, nan, nan, ynull
+      ok = ~ynull & ~numpy.isnan(y)
+      count = _window_sum(ok.astype(float), period)
+      total = _window_sum(numpy.where(ok, y, 0.0), period)
+      null = count == 0
+      return numpy.where(null, numpy.nan, total / numpy.where(null, 1, count)), \
+          nan, nan, null
+
+    if mode == 'errorBars':
+      y = values[0]
+      ynull = nulls[0] | missing
+      ok = ~ynull & ~numpy.isnan(y)
+      count = _window_sum(ok.astype(float), period)
+      total = _window_sum(numpy.where(ok, y, 0.0), period)
+      var = _window_sum_nan(numpy.where(ok, numeric[1] ** 2, 0.0), period)
+      none = count == 0
+      safe = numpy.where(none, 1, count)
+      value = total / safe
+      stddev = numpy.sqrt(var) / safe
+      if period == 1:
+        value = numpy.where(none, y, value)
+        null = none & ynull
+      else:
+        value = numpy.where(none, numpy.nan, value)
+        null = none
+      low = numpy.where(none, value, value - sigma * stddev)
+      high = numpy.where(none, value, value + sigma * stddev)
+      return value, low, high, null
+
+    if mode == 'customBars':
+      y = values[1]
+      ok = ~(nulls[1] | missing) & ~numpy.isnan(y)
+      count = _window_sum(ok.astype(float), period)
+      mid = _running_sum(numpy.where(ok, y, 0.0), period)
+      low = _running_sum(numpy.where(ok, numeric[0], 0.0), period)
+      high = _running_sum(numpy.where(ok, numeric[2], 0.0), period)
+      null = count == 0
+      safe = numpy.where(null, 1, count)
+      return numpy.where(null, numpy.nan, mid / safe), \
+          numpy.where(null, numpy.nan, low / safe), \
+          numpy.where(null, numpy.nan, high / safe), null
+
+    num = _running_sum(numpy.where(missing, 0.0, numeric[0]), period)
+    den = _running_sum(numpy.where(missing, 0.0, numeric[1]), period)
+    has = (den != 0) & ~numpy.isnan(den)
+    safe = numpy.where(has, den, 1.0)
+    value = numpy.where(has, num / safe, 0.0)
+    null = numpy.zeros(n, dtype=bool)
+    if mode == 'fractions':
+      return 100.0 * value, nan, nan, null
+    if wilson:
+      p = numpy.where(value < 0, 0.0, value)
+      pm = sigma * numpy.sqrt(p * (1 - p) / safe + sigma * sigma / (4 * safe * safe))
+      denom = 1 + sigma * sigma / safe
+      lo = (p + sigma * sigma / (2 * safe) - pm) / denom
+      hi = (p + sigma * sigma / (2 * safe) + pm) / denom
+      return numpy.where(has, p * 100.0, 0.0), \
+          numpy.where(has, lo * 100.0, 0.0), \
+          numpy.where(has, hi * 100.0, 0.0), null
+    stddev = numpy.where(has, sigma * numpy.sqrt(value * (1 - value) / safe), 1.0)
+    return 100.0 * value, 100.0 * (value - stddev), 100.0 * (value + stddev), null
+
+def parse_xs(xs):
+  """Returns (array of x values, is_date) for the x strings of read_csv()."""
+  date = bool(xs) and colstore.is_date(xs[0])
+  parse_x = colstore.parse_date if date else colstore.parse_float
+  return array.array('d', (parse_x(x) for x in xs)), date
+
+def rolled_columns(series, mode, roll_period, sigma=2.0, wilson=True,
+    logscale=False):
+  """Returns the rolled data as columns of doubles, NaN for null.
+
+  These are low, value and high per series for bar modes, else the values.
+  """
+  out = []
+  for points in series:
+    y, low, high, null = roll(mode, points, roll_period, sigma, wilson,
+        logscale)
+    wanted = (low, y, high) if mode in BAR_MODES else (y,)
+    for values in wanted:
+      out.append(array.array('d', (_nan if n else v
+          for v, n in zip(values, null))))
+  return out
+
+def _format(v):
+  if v != v:
+    return 'NaN'
+  if v == int(v) and abs(v) < 1e15:
+    return '%d' % v
+  return repr(float(v))
+
+def rolled_csv(labels, xs, series, mode, roll_period, sigma=2.0, wilson=True,
+    logscale=False):
+  """Returns the rolled data as CSV for parseCSV_.
+
+  Bar modes give customBars (low;value;high) fields, the others plain
+  values; either way, the client should use rollPeriod 1.
+  """
+  columns = [roll(mode, points, roll_period, sigma, wilson, logscale)
+      for points in series]
+  bars = mode in BAR_MODES
+  out = [','.join(labels)]
+  for i, x in enumerate(xs):
+    fields = [x]
+    for y, low, high, null in columns:
+      if null[i]:
+        fields.append('')
+      elif bars:
+        fields.append('%s;%s;%s' % (_format(low[i]), _format(y[i]),
+            _format(high[i])))
+      else:
+        fields.append(_format(y[i]))
+    out.append(','.join(fields))
+  out.append('')
+  return '\n'.join(out).encode('UTF-8')
+
+def _same(a, b):
+  if a is None or b is None:
+    return a is None and b is None
+  if a != a or b != b:
+    return a != a and b != b
+  if math.isinf(a) or math.isinf(b):
+    return a == b
+  return abs(a - b) <= 1e-9 * max(1.0, abs(a), abs(b))
+
+def _as_reference(rolled):
+  """Converts the result of roll() into reference_roll() form."""
+  y, low, high, null = rolled
+  out = []
+  for i in range(len(y)):
+    if null[i]:
+      out.append((None, None, None))
+    else:
+      out.append((float(y[i]), float(low[i]), float(high[i])))
+  return out
+
+def _selftest():
+  rv = 0
+  impls = [('reference', lambda *a, **kw: reference_roll(*a, **kw))]
+  if numpy is not None:
+    impls.append(('numpy', lambda *a, **kw: _as_reference(roll(*a, **kw))))
+
+  def check(name, got, want, rounded=False):
+    nonlocal rv
+    for i, (g, w) in enumerate(zip(got, want)):
+      g = tuple(round(v) if rounded and v is not None else v
+          for v in g[:len(w)])
+      if not all(_same(p, q) for p, q in zip(g, w)):
+        print('%s: row %d: got %r, expected %r' % (name, i, g, w))
+        rv = 1
+        return
+
+  # the cases of auto_tests/tests/rolling_average.js
+  for impl, fn in impls:
+    pts = [0.0, 1.0, 2.0, 3.0]
+    for period, want in ((1, [0, 1, 2, 3]), (2, [0, 0.5, 1.5, 2.5]),
+        (3, [0, 0.5, 1, 2]), (4, [0, 0.5, 1, 1.5])):
+      check('%s testRollingAverage %d' % (impl, period),
+          fn('default', pts, period), [(v,) for v in want])
+    check('%s testRollShortFractions' % impl,
+        fn('customBars', [(1.0, 10.0, 20.0)], 1),
+        fn('customBars', [(1.0, 10.0, 20.0), (1.0, 20.0, 30.0)], 1)[:1])
+    check('%s testRollCustomBars' % impl,
+        fn('customBars', [(1.0, 10.0, 20.0), (1.0, 20.0, 30.0),
+            (1.0, 30.0, 40.0), (1.0, 40.0, 50.0)], 2),
+        [(10, 1, 20), (15, 1, 25), (25, 1, 35), (35, 1, 45)])
+    s2 = math.sqrt(2)
+    check('%s testRollErrorBars' % impl,
+        fn('errorBars', [(10.0, 1.0), (20.0, 1.0), (30.0, 1.0), (40.0, 1.0)], 2),
+        [(10, 8, 12)] + [(v, v - s2, v + s2) for v in (15, 25, 35)])
+    fractions = [(1.0, 10.0), (2.0, 10.0), (3.0, 10.0), (4.0, 10.0)]
+    check('%s testRollFractions' % impl, fn('fractions', fractions, 2),
+        [(10,), (15,), (25,), (35,)])
+    check('%s testRollFractionsBars' % impl,
+        fn('fractionsBars', fractions, 2, wilson=False),
+        list(zip([10, 15, 25, 35], [-9, -1, 6, 14], [29, 31, 44, 56])), True)
+    check('%s testRollFractionsBarsWilson' % impl,
+        fn('fractionsBars', fractions, 2, wilson=True),
+        list(zip([10, 15, 25, 35], [2, 5, 11, 18], [41, 37, 47, 57])), True)
+
+  # random data, with nulls and NaNs, vectorised against the reference
+  if numpy is not None:
+    rng = random.Random(42)
+    def value(scale=100.0):
+      r = rng.random()
+      if r < 0.05:
+        return None
+      if r < 0.08:
+        return _nan
+      return rng.uniform(-0.2, 1.0) * scale
+    def point(mode):
+      if rng.random() < 0.03:
+        return None
+      if mode == 'default':
+        return value()
+      if mode == 'errorBars':
+        return (value(), value(10.0))
+      if mode == 'customBars':
+        return (value(), value(), value())
+      # counts, as fractions usually are: running sums of arbitrary floats
+      # leave rounding residue where the window empties, which the
+      # add/subtract loop and cumulative sums do not leave alike
+      return tuple(v if v is None or v != v else float(round(v))
+          for v in (value(10.0), value(20.0)))
+    cases = 0
+    for mode in MODES:
+      for trial in range(30):
+        points = [point(mode) for _ in range(rng.randrange(1, 60))]
+        for period in (1, 2, 3, 7, 100):
+          for logscale in (False, True):
+            for wilson in (False, True):
+              want = reference_roll(mode, points, period, 2.0, wilson, logscale)
+              got = _as_reference(roll(mode, points, period, 2.0, wilson,
+                  logscale))
+              cases += 1
+              width = 3 if mode in BAR_MODES else 1
+              for i, (g, w) in enumerate(zip(got, want)):
+                if not all(_same(p, q) for p, q in zip(g[:width], w[:width])):
+                  print('random %s period=%d log=%s wilson=%s row %d: '
+                      'numpy %r, reference %r' % (mode, period, logscale,
+                      wilson, i, g, w))
+                  rv = 1
+                  break
+    print('random parity: %d cases' % cases)
+  else:
+    print('NumPy not available, vectorised implementation not tested')
+  print('test finished')
+  return rv
+
+if __name__ == '__main__':
+  if sys.argv[1:] == ['--test']:
+    sys.exit(_selftest())
+  sys.stderr.write('E: syntax: python3 rolling.py --test\n')
+  sys.exit(1)
@@ -1,18 +1,34 @@
 '''
 Shared code for ssi_server.py and ssi_expander.py.
+
+Pages are compiled into a list of segments (literal text, includes and
+set/echo operations) and rendered in a single linear pass. The compiled
+fragments that pages include are cached and shared between all pages, so
+fragments such as header.html are parsed once per process rather than once
+per page; they are recompiled when their modification time changes. Pages
+themselves are not cached here: ssi_server.py caches rendered pages within
+its --cache-size, and the fragments are few. Included fragments are
+themselves expanded, with cycle detection.
 '''
 
+import os
 import re
-import pathlib
+import threading
 
 _ssierr = b"<!-- SSI ERROR -->"
 _ssiok = b""
 
-def _dovar(vars, match, e, fn):
-    cmd = match.group(1)
-    var = match.group(2)
-    val = match.group(3)
+_directive = re.compile(
+    br'<!-- *#include *virtual=[\'"]([^\'"]+)[\'"] *-->\s*'
+    br'|<!-- *#(set|echo) *var=[\'"]([^\'"]+)[\'"]'
+    br'(?: *value=[\'"]([^\'"]+)[\'"])? *-->\s*')
+
+# segment kinds
+_LITERAL = 0
+_INCLUDE = 1
+_VAR = 2
 
+def _dovar(vars, cmd, var, val, e, fn):
     if cmd == b"set":
         if val is None:
             e("SSI set(%s) without value" % var, fn)
@@ -34,14 +50,116 @@ def _slurp(path):
   with open(path, 'rb') as f:
     return f.read()
 
-def InlineIncludes(path, errorfn):
-  """Read a file, expanding <!-- #include --> statements."""
-  content = _slurp(path)
-  vars = {}
-  content = re.sub(br'<!-- *#include *virtual=[\'"]([^\'"]+)[\'"] *-->\s*',
-      lambda x: _slurp(x.group(1)),
-      content)
-  content = re.sub(br'<!-- *#(set|echo) *var=[\'"]([^\'"]+)[\'"](?: *value=[\'"]([^\'"]+)[\'"])? *-->\s*',
-      lambda x: _dovar(vars, x, errorfn, path),
-      content)
-  return content
+def _mtime(path):
+  return os.stat(path).st_mtime_ns
+
+class Template(object):
+  """A page compiled into a list of (kind, ...) segments."""
+
+  def __init__(self, path, content):
+    self.path = path
+    segments = []
+    pos = 0
+    for m in _directive.finditer(content):
+      if m.start() > pos:
+        segments.append((_LITERAL, content[pos:m.start()]))
+      if m.group(1) is not None:
+        segments.append((_INCLUDE, m.group(1).decode('UTF-8')))
+      else:
+        segments.append((_VAR, m.group(2), m.group(3), m.group(4)))
+      pos = m.end()
+    if pos < len(content):
+      segments.append((_LITERAL, content[pos:]))
+    self.segments = segments
+
+class Templates(object):
+  """Compiles templates on demand and caches included fragments by path.
+
+  read and stamp are used to load a file and to obtain a value that changes
+  whenever the file does; they default to the local filesystem.
+  """
+
+  def __init__(self, read=_slurp, stamp=_mtime):
+    self._read = read
+    self._stamp = stamp
+    self._compiled = {}
+    self._lock = threading.Lock()
+
+  def _compile(self, path):
+    return Template(path, self._read(path))
+
+  def get(self, path):
+    """Returns the compiled Template for path, caching it."""
+    stamp = self._stamp(path)
+    entry = self._compiled.get(path)
+    if entry is not None and entry[0] == stamp:
+      return entry[1]
+    template = self._compile(path)
+    with self._lock:
+      self._compiled[path] = (stamp, template)
+    return template
+
+  def preload(self, path):
+    """Compiles, recursively, everything path includes.
+
+    Useful before forking workers, which then share the compiled fragments.
+    """
+    seen = set([path])
+    try:
+      todo = [self._compile(path)]
+    except OSError:
+      return
+    while todo:
+      template = todo.pop()
+      for s in template.segments:
+        if s[0] == _INCLUDE and s[1] not in seen:
+          seen.add(s[1])
+          try:
+            todo.append(self.get(s[1]))
+          except OSError:
+            pass
+
+  def render(self, path, errorfn, deps=None):
+    """Renders the page at path, expanding includes and variables."""
+    out = []
+    self._render(self._compile(path), errorfn, {}, [path], deps, out)
+    return b''.join(out)
+
+  def _render(self, template, e, vars, stack, deps, out):
+    for segment in template.segments:
+      kind = segment[0]
+      if kind == _LITERAL:
+        out.append(segment[1])
+      elif kind == _VAR:
+        out.append(_dovar(vars, segment[1], segment[2], segment[3],
+            e, template.path))
+      else:
+        path = segment[1]
+        if deps is not None:
+          deps.append(path)
+        if path in stack:
+          e("SSI include(%s) is recursive" % path, template.path)
+          out.append(_ssierr)
+          continue
+        try:
+          included = self.get(path)
+        except OSError:
+          e("SSI include(%s) not found" % path, template.path)
+          out.append(_ssierr)
+          continue
+        stack.append(path)
+        self._render(included, e, vars, stack, deps, out)
+        stack.pop()
+
+_templates = Templates()
+
+def InlineIncludes(path, errorfn, deps=None):
+  """Read a file, expanding <!-- #include --> statements.
+
+  If deps is a list, the path of every included file is appended to it.
+  """
+  return _templates.render(path, errorfn, deps)
+
+def Preload(path):
+  """Compile everything a file includes into the shared cache."""
+  _templates.preload(path)
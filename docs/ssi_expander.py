@@ -7,21 +7,115 @@ Only files that end in '.html' are processed, with the exceptions of
 
 Usage:
 
-  python3 ssi_expander.py [source_directory] destination_directory
+  python3 ssi_expander.py [--manifest FILE] [--jobs N] [source_directory] destination_directory
+  python3 ssi_expander.py [--jobs N] --benchmark NPAGES
 
 If source_directory is not specified, then the current directory is used.
+
+With --manifest, the source and include dependencies of every output are
+recorded in FILE together with their modification times and sizes. A later
+run then only re-expands pages whose inputs (or whose output) changed, and
+leaves all other outputs untouched. Outputs whose expansion did not change
+are never rewritten either.
+
+With --jobs N, pages are expanded by N worker processes which inherit the
+shared fragments (header.html etc.) already compiled. The output does not
+depend on N. Errors are collected from all pages and reported at the end
+instead of stopping at the first one; the exit status is then nonzero.
+
+--benchmark NPAGES expands a synthetic tree of NPAGES pages serially and
+in parallel (with N jobs, or at least two), checks that both outputs are
+identical and prints wall times. Flags may be given in any order.
 '''
 
+import concurrent.futures
+import filecmp
+import json
+import multiprocessing
 import os
 import pathlib
+import shutil
 import ssi
 import sys
+import tempfile
+import time
+
+_manifest_version = 1
+
+# errors of the page currently being expanded, as (filename, message)
+_errors = []
 
 def _errorfn(msg, fn):
-    sys.stderr.write('E: %s: %s\n' % (fn, msg))
-    sys.exit(1)
+    _errors.append((fn, msg))
+
+def _report(errors):
+    for fn, msg in errors:
+        sys.stderr.write('E: %s: %s\n' % (fn, msg))
+
+def _stamp(path):
+  """Returns [mtime, size] of path, or None if it does not exist."""
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return [st.st_mtime_ns, st.st_size]
+
+def _load_manifest(path):
+  try:
+    with open(path, 'rt', encoding='UTF-8') as f:
+      manifest = json.load(f)
+  except (OSError, ValueError):
+    return {}
+  if manifest.get('version') != _manifest_version:
+    return {}
+  return manifest.get('outputs', {})
+
+def _save_manifest(path, outputs):
+  tmp = path + '.tmp'
+  with open(tmp, 'wt', encoding='UTF-8') as f:
+    json.dump({'version': _manifest_version, 'outputs': outputs}, f,
+        indent=1, sort_keys=True)
+    f.write('\n')
+  os.replace(tmp, path)
+
+def _up_to_date(entry, src_path, dest_path):
+  if entry is None or entry['source'] != src_path:
+    return False
+  if _stamp(dest_path) != entry['output']:
+    return False
+  return all(_stamp(dep) == stamp for dep, stamp in entry['deps'].items())
 
-def process(source, dest):
+def _expand(src_path, dest_path):
+  """Expands src_path into dest_path.
+
+  Returns its manifest entry and the list of errors encountered. Pages with
+  errors get no manifest entry, so that they are retried next time.
+  """
+  del _errors[:]
+  deps = [src_path]
+  content = ssi.InlineIncludes(src_path, _errorfn, deps)
+  try:
+    with open(dest_path, 'rb') as f:
+      unchanged = f.read() == content
+  except OSError:
+    unchanged = False
+  if not unchanged:
+    pathlib.Path(dest_path).unlink(missing_ok=True)
+    with open(dest_path, 'wb') as f:
+      f.write(content)
+  if _errors:
+    return None, list(_errors)
+  return {
+    'source': src_path,
+    'deps': {dep: _stamp(dep) for dep in deps},
+    'output': _stamp(dest_path),
+  }, []
+
+def _expand_job(job):
+  return _expand(*job)
+
+def pages(source, dest):
+  """Yields (src_path, dest_path) for every page, creating directories."""
   for dirpath, dirnames, filenames in os.walk(source):
     dest_dir = os.path.realpath(os.path.join(dest, os.path.relpath(dirpath, source)))
     if not os.path.exists(dest_dir):
@@ -34,22 +128,128 @@ def process(source, dest):
         continue
       src_path = os.path.abspath(os.path.join(source, dirpath, filename))
       dest_path = os.path.join(dest_dir, filename)
-      pathlib.Path(dest_path).unlink(missing_ok=True)
-      with open(dest_path, 'wb') as f:
-        f.write(ssi.InlineIncludes(src_path, _errorfn))
+      yield src_path, dest_path
 
     # ignore hidden directories
     for dirname in dirnames[:]:
       if dirname.startswith('.'):
         dirnames.remove(dirname)
 
+def process(source, dest, manifest=None, jobs=1):
+  """Expands all pages; returns the list of errors as (filename, message)."""
+  old = _load_manifest(manifest) if manifest else {}
+  outputs = {}
+  todo = []
+  total = 0
+  for src_path, dest_path in pages(source, dest):
+    total += 1
+    key = os.path.relpath(dest_path, dest)
+    entry = old.get(key)
+    if _up_to_date(entry, src_path, dest_path):
+      outputs[key] = entry
+    else:
+      todo.append((src_path, dest_path))
+
+  # workers must be forked to inherit the compiled fragments
+  if (jobs > 1 and len(todo) > 1 and
+      'fork' in multiprocessing.get_all_start_methods()):
+    # compile the shared fragments once, before the workers are forked
+    ssi.Preload(todo[0][0])
+    chunksize = max(1, len(todo) // (jobs * 8))
+    with concurrent.futures.ProcessPoolExecutor(jobs,
+        mp_context=multiprocessing.get_context('fork')) as pool:
+      results = list(pool.map(_expand_job, todo, chunksize=chunksize))
+  else:
+    results = [_expand(*job) for job in todo]
+
+  errors = []
+  for (src_path, dest_path), (entry, page_errors) in zip(todo, results):
+    errors.extend(page_errors)
+    if entry is not None:
+      outputs[os.path.relpath(dest_path, dest)] = entry
+  if manifest:
+    _save_manifest(manifest, outputs)
+    sys.stderr.write('I: expanded %d of %d pages\n' % (len(todo), total))
+  return errors
+
+def benchmark(npages, jobs):
+  """Times serial against parallel expansion of a synthetic tree."""
+  top = tempfile.mkdtemp(prefix='ssi-bench-')
+  cwd = os.getcwd()
+  try:
+    src = os.path.join(top, 'src')
+    os.mkdir(src)
+    os.chdir(src)
+    filler = b'<p>' + b'Lorem ipsum dolor sit amet. ' * 40 + b'</p>\n'
+    with open('header.html', 'wb') as f:
+      f.write(b'<html><head><title><!--#echo var="pagetitle" --></title>'
+          b'</head><body>\n' + filler * 20)
+    with open('footer.html', 'wb') as f:
+      f.write(filler * 5 + b'</body></html>\n')
+    for i in range(npages):
+      subdir = 'd%03d' % (i % 100)
+      if i < 100:
+        os.mkdir(subdir)
+      with open(os.path.join(subdir, 'page%05d.html' % i), 'wb') as f:
+        f.write(b'<!--#set var="pagetitle" value="page %d" -->\n'
+            b'<!--#include virtual="header.html" -->\n' % i +
+            filler * 30 + b'<!--#include virtual="footer.html" -->\n')
+
+    times = {}
+    for n in 1, jobs:
+      dest = os.path.join(top, 'out%d' % n)
+      os.mkdir(dest)
+      t0 = time.perf_counter()
+      errors = process('.', dest, jobs=n)
+      times[n] = time.perf_counter() - t0
+      assert not errors, errors
+    out1 = os.path.join(top, 'out1')
+    outn = os.path.join(top, 'out%d' % jobs)
+    count = 0
+    for dirpath, _, filenames in os.walk(out1):
+      for filename in filenames:
+        path = os.path.join(dirpath, filename)
+        other = os.path.join(outn, os.path.relpath(path, out1))
+        assert filecmp.cmp(path, other, shallow=False), other
+        count += 1
+    assert count == npages
+    print('%d pages: serial %.3fs, %d jobs %.3fs (%.2fx), outputs identical' % (
+        npages, times[1], jobs, times[jobs], times[1] / times[jobs]))
+  finally:
+    os.chdir(cwd)
+    shutil.rmtree(top)
+
 if __name__ == '__main__':
-  if len(sys.argv) == 2:
+  usage = ('Usage: %s [--manifest FILE] [--jobs N] [source_directory] '
+      'destination_directory\n       %s [--jobs N] --benchmark NPAGES' % (
+      sys.argv[0], sys.argv[0]))
+  args = sys.argv[1:]
+  manifest = None
+  jobs = 1
+  npages = None
+  while len(args) >= 2 and args[0].startswith('--'):
+    if args[0] == '--manifest':
+      manifest = os.path.abspath(args[1])
+    elif args[0] == '--jobs':
+      jobs = int(args[1])
+    elif args[0] == '--benchmark':
+      npages = int(args[1])
+    else:
+      break
+    args = args[2:]
+  if npages is not None and not args:
+    benchmark(npages, jobs if jobs > 1 else max(2, os.cpu_count() or 2))
+    sys.exit(0)
+  if npages is None and len(args) == 1:
     source = '.'
-    dest = sys.argv[1]
-  elif len(sys.argv) == 3:
-    source, dest = sys.argv[1:]
+    dest = args[0]
+  elif npages is None and len(args) == 2:
+    source, dest = args
   else:
-    _errorfn('Usage: %s [source_directory] destination_directory' % sys.argv[0])
+    sys.stderr.write('E: %s\n' % usage)
+    sys.exit(1)
 
-  process(source, dest)
+  errors = process(source, dest, manifest, jobs)
+  if errors:
+    _report(errors)
+    sys.exit(1)
@@ -2,42 +2,513 @@
 '''
 Use this in the same way as Python's SimpleHTTPServer:
 
-  python3 ssi_server.py [port]
+  python3 ssi_server.py [--cache-size MiB] [--data-cache-size MiB]
+      [--workers N] [port]
 
 The only difference is that, for files ending in '.html', ssi_server will
 inline SSI (Server Side Includes) of the form:
 
   <!-- #include virtual="fragment.html" -->
 
+Expanded pages are kept in a bounded in-memory cache which is keyed on the
+modification times of the page and of everything it includes, so edits to
+either are picked up on the next reload.
+
+Responses carry strong ETags and conditional requests get 304 answers.
+Clients accepting gzip or brotli get precompressed .gz/.br siblings when
+they are present and up to date, or a body compressed on the fly and kept
+in a second cache (brotli needs the optional brotli module).
+
+/__data?file=F&from=X0&to=X1&points=N serves the rows of the CSV file F
+(relative to this directory) with x in [X0, X1], reduced to about N rows
+per series, for zoomed charts on large data sets. Further parameters:
+method=minmax (default; per x bucket the rows with the minimum and maximum
+of every series) or method=lttb (Largest-Triangle-Three-Buckets on the
+series named by series=, default the first); layout=errorBars, customBars
+or fractions for files in those formats. X0 and X1 may be numbers
+(milliseconds for dates, as in dateWindow) or dates. The parsed files are
+kept in a cache of their own; see colstore.py.
+
+If F is a pyramid file built by pyramid.py, the answer is read from the
+memory-mapped level with at most N buckets in the window, in customBars
+form (low;mean;high per series; format=mean gives plain means), without
+parsing anything, so its cost does not grow with the data set.
+
+/__gen?rows=N&series=N&layout=L&gaps=P&dates=1&seed=N streams a synthetic
+data set made by datagen.py, for benchmark pages. They POST their timings
+to /__bench, which appends them to a JSON lines file (--bench-results,
+default bench-results.jsonl); GET /__bench returns the stored results, or
+compares builds; see bench.py.
+
+Clients sending "Accept: application/vnd.dygraphs.columns" get the data
+endpoints' answers in a binary columnar format instead of CSV, which
+src/extras/columnar.js decodes; see columnar.py.
+
+/__join?file=F1&file=F2...&from=X0&to=X1 merge-joins CSV files sorted by
+x into one CSV, with a row for every x of any file in [X0, X1] and the
+series of all files side by side (empty where a file has no row at that
+x), for dashboards of synchronized charts; format=slices answers with JSON
+holding each file's series on the shared x grid instead. The files are
+streamed, never loaded whole; see join.py.
+
+/__annotations?file=F&from=X0&to=X1&series=S&width=W serves, as JSON for
+setAnnotations(), the annotations stored in the JSON or CSV file F that
+overlap [X0, X1], for the series named by any number of series= (default
+all), thinned to one per spacing= pixels (default 16) per series on a chart
+W pixels wide, and at most max= (default 100). Zoomed charts thus fetch a
+few dozen markers out of any number; see annotations.py.
+
+/__tq?file=F is a Google Visualization data source for the CSV file F, as
+google.visualization.Query and Dygraph.GVizChart use it: the query in tq=
+(select, where on the x column, limit and offset) picks the rows from the
+cached ColumnStore, and the DataTable is streamed as JSON (or CSV with
+tqx=out:csv); see gviz.py.
+
+/__rolled?file=F&roll=N&mode=M serves the CSV file F with the rolling
+average of period N applied on the server, as the data handler for
+mode=default, errorBars, customBars, fractions or fractionsBars would on
+the client (with sigma=, default 2, wilson=0|1, default 1, and logscale=1
+as the options of the same names). Modes with bars answer in customBars
+form; the X-Dygraph-Options header gives the options to draw the result
+with. Rolled files are cached per file, period and options; see rolling.py.
+
+/__live?channel=C streams the rows of a live channel as Server-Sent
+Events: a snapshot of the buffered rows, then the rows appended since.
+Local producers append CSV rows with POST /__live?channel=C; the body of
+the first POST to a channel starts with its header line, and capacity=N
+sets how many rows it keeps (default 10000). reset=1 discards the channel
+first. Channels live in the server process, so use them without
+--workers; see live.py.
+
+--mount [VERSION=]ARCHIVE serves a release archive (.zip, .tar, .tar.gz,
+.tgz, .tar.bz2, .tar.xz) at /VERSION/, with the version taken from the
+archive's name by default, as download.html links old releases. Nothing
+is extracted: a member index is built on first use and kept for the most
+recently used archives, so mounting costs nothing until then whatever the
+number of versions. Stored members are sent straight from the archive,
+and archived .html pages get their SSI directives expanded; see
+archives.py.
+
+Static files and in-memory bodies, such as expanded pages, honour Range
+requests (also with If-Range and several ranges, as multipart/byteranges);
+ranges are always of the uncompressed representation. Connections are
+HTTP/1.1 and kept alive between requests.
+
+With --metrics, /__metrics gives request counts, latency histograms, bytes
+served, the time spent expanding SSI, in cache lookups and in socket
+writes, and errors, per route, in the Prometheus text format; --trace FILE
+logs a sample of the requests (--trace-sample, default 0.01). See
+metrics.py.
+
+Static files are sent with sendfile(2) where possible. For load-testing,
+--workers N pre-forks N processes, each with its own listening socket bound
+via SO_REUSEPORT and a thread per connection, so the kernel spreads clients
+across all cores.
+
 Run ./ssi_server.py in this directory and visit localhost:8000 for an example.
 '''
 
+import annotations
+import archives
+import bench
+import collections
+import colstore
+import columnar
+import datagen
+import gzip
+import gviz
+import hashlib
+import io
+import join
+import json
+import live
+import metrics
 import os
+import posixpath
+import pyramid
+import rolling
+import shutil
+import signal
+import socket
 import ssi
+import sys
+import threading
+import urllib.parse
+import zipfile
+from http import HTTPStatus
 from http.server import SimpleHTTPRequestHandler
 import http.server
-import tempfile
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
 
 _errorfnp = None
 
+def _mtimes(paths):
+  """Returns a tuple of (path, mtime) for paths, or None if one is missing."""
+  try:
+    return tuple((path, os.stat(path).st_mtime_ns) for path in paths)
+  except OSError:
+    return None
+
+def _etag(content):
+  return '"%s"' % hashlib.sha1(content).hexdigest()[:20]
+
+class LRUCache(object):
+  """A thread-safe LRU mapping whose values are bounded in total weight.
+
+  Values are tuples; the weight of one is given to put(), and defaults to
+  the length of its last element, the payload, so the limit is in bytes.
+  """
+
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def lookup(self, key):
+    with self._lock:
+      item = self._entries.get(key)
+      if item is None:
+        return None
+      self._entries.move_to_end(key)
+      return item[0]
+
+  def put(self, key, entry, weight=None):
+    if weight is None:
+      weight = len(entry[-1])
+    with self._lock:
+      old = self._entries.pop(key, None)
+      if old is not None:
+        self.size -= old[1]
+      if weight > self.max_bytes:
+        return
+      self._entries[key] = (entry, weight)
+      self.size += weight
+      while self.size > self.max_bytes:
+        _, (_, evicted) = self._entries.popitem(last=False)
+        self.size -= evicted
+
+  def count(self, hit):
+    with self._lock:
+      if hit:
+        self.hits += 1
+      else:
+        self.misses += 1
+
+  def stats(self):
+    return 'hits=%d misses=%d entries=%d bytes=%d' % (
+        self.hits, self.misses, len(self._entries), self.size)
+
+class PageCache(LRUCache):
+  """A size-bounded LRU cache of SSI-expanded pages.
+
+  Entries are validated against the mtimes of the page and all its includes
+  on every lookup, so a stale entry is never served.
+  """
+
+  @metrics.timed('cache')
+  def get(self, path):
+    """Returns (content, etag, hit) for the expanded page at path."""
+    entry = self.lookup(path)
+    if entry is not None:
+      stamps, etag, content = entry
+      if _mtimes(p for p, _ in stamps) == stamps:
+        self.count(True)
+        return content, etag, True
+
+    deps = [path]
+    with metrics.phase('ssi'):
+      content = ssi.InlineIncludes(path, _errorfnp, deps)
+    etag = _etag(content)
+    stamps = _mtimes(deps)
+    self.count(False)
+    if stamps is not None:
+      self.put(path, (stamps, etag, content))
+    return content, etag, False
+
+class CompressedCache(LRUCache):
+  """Caches on-the-fly compressed bodies, keyed on (etag, encoding)."""
+
+  def get(self, etag, encoding, body):
+    """Returns body compressed with encoding; body may be a callable."""
+    entry = self.lookup((etag, encoding))
+    if entry is not None:
+      self.count(True)
+      return entry[0]
+    if callable(body):
+      body = body()
+    if encoding == 'br':
+      compressed = brotli.compress(body, quality=5)
+    else:
+      compressed = gzip.compress(body, compresslevel=6, mtime=0)
+    self.count(False)
+    self.put((etag, encoding), (compressed,))
+    return compressed
+
+class DataCache(LRUCache):
+  """Caches parsed ColumnStores, keyed on (path, layout).
+
+  Entries are validated against the file's mtime and size.
+  """
+
+  @metrics.timed('cache')
+  def get(self, path, layout):
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    entry = self.lookup((path, layout))
+    if entry is not None and entry[0] == stamp:
+      self.count(True)
+      return entry[1]
+    store = colstore.ColumnStore.load(path, layout)
+    self.count(False)
+    self.put((path, layout), (stamp, store), store.nbytes)
+    return store
+
+class AnnotationCache(LRUCache):
+  """Caches annotation indexes, validated by the file's mtime and size."""
+
+  @metrics.timed('cache')
+  def get(self, path):
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    entry = self.lookup(path)
+    if entry is not None and entry[0] == stamp:
+      self.count(True)
+      return entry[1]
+    index = annotations.Index.load(path)
+    self.count(False)
+    self.put(path, (stamp, index), index.nbytes)
+    return index
+
+class ArchiveCache(LRUCache):
+  """Keeps the member indexes of mounted archives, validated by stamp.
+
+  Each weighs 1, so the limit is a number of archives and memory does not
+  grow with the number mounted, only with the number in use.
+  """
+
+  @metrics.timed('cache')
+  def get(self, path):
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    entry = self.lookup(path)
+    if entry is not None and entry[0] == stamp:
+      self.count(True)
+      return entry[1]
+    archive = archives.Archive(path)
+    self.count(False)
+    self.put(path, (archive.stamp, archive), 1)
+    return archive
+
+class PyramidCache(LRUCache):
+  """Keeps pyramid files mapped, validated by mtime and size.
+
+  Each weighs 1, so the limit is the number of open files; their pages
+  are the kernel's.
+  """
+
+  @metrics.timed('cache')
+  def get(self, path):
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    entry = self.lookup(path)
+    if entry is not None and entry[0] == stamp:
+      self.count(True)
+      return entry[1]
+    pyr = pyramid.Pyramid(path)
+    self.count(False)
+    self.put(path, (stamp, pyr), 1)
+    return pyr
+
+class RolledCache(LRUCache):
+  """Caches rolled bodies, keyed on the path, rolling options and format.
+
+  Entries are validated against the file's mtime and size.
+  """
+
+  @metrics.timed('cache')
+  def get(self, path, options, binary=False):
+    """Returns (etag, body, hit) for path rolled with options.
+
+    The body is CSV, or in the columnar format if binary is set.
+    """
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    key = (path, options, binary)
+    entry = self.lookup(key)
+    if entry is not None and entry[0] == stamp:
+      self.count(True)
+      return entry[1], entry[2], True
+    mode = options[0]
+    with open(path, 'rb') as f:
+      labels, xs, series = rolling.read_csv(f.read(), mode)
+    if binary:
+      x, is_date = rolling.parse_xs(xs)
+      layout = 'customBars' if mode in rolling.BAR_MODES else 'plain'
+      body = columnar.encode(labels, x,
+          rolling.rolled_columns(series, *options), layout, is_date, True)
+    else:
+      body = rolling.rolled_csv(labels, xs, series, *options)
+    etag = _etag(body)
+    self.count(False)
+    self.put(key, (stamp, etag, body))
+    return etag, body, False
+
+_page_cache = PageCache(32 << 20)
+_compressed_cache = CompressedCache(32 << 20)
+_data_cache = DataCache(256 << 20)
+_pyramid_cache = PyramidCache(64)
+_rolled_cache = RolledCache(64 << 20)
+_annotation_cache = AnnotationCache(64 << 20)
+_archive_cache = ArchiveCache(16)
+# mounted archives: the first path segment (a version) -> the archive's path
+_mounts = {}
+_live_channels = live.Channels()
+_bench_results = bench.Results('bench-results.jsonl')
+_max_post = 16 << 20
+_max_points = 100000
+
+# Only bodies of these types are worth compressing on the fly.
+_compressible = ('text/', 'application/javascript', 'application/json',
+    'image/svg+xml', columnar.MIME_TYPE)
+_min_compress = 256
+_max_compress = 16 << 20
+_max_ranges = 64
+_max_join_files = 32
+_max_annotations = 1000
+
+def _slurp(path):
+  with open(path, 'rb') as f:
+    return f.read()
+
+def _accepted_encodings(header):
+  """Parses Accept-Encoding into the set of encodings with q > 0."""
+  accepted = set()
+  for item in (header or '').split(','):
+    coding, _, params = item.strip().partition(';')
+    coding = coding.strip().lower()
+    q = 1.0
+    for param in params.split(';'):
+      name, _, value = param.strip().partition('=')
+      if name == 'q':
+        try:
+          q = float(value)
+        except ValueError:
+          q = 0.0
+    if coding and q > 0:
+      accepted.add(coding)
+  if '*' in accepted:
+    accepted.update(('br', 'gzip'))
+  return accepted
+
+def _parse_ranges(header, size):
+  """Parses a Range header for a body of size bytes.
+
+  Returns a sorted list of non-overlapping (start, end) byte ranges, [] if
+  none of them can be satisfied, or None if the header is to be ignored
+  (absent, malformed, not in bytes, or asking for too many ranges).
+  """
+  unit, _, specs = (header or '').partition('=')
+  if unit.strip().lower() != 'bytes':
+    return None
+  ranges = []
+  for spec in specs.split(','):
+    spec = spec.strip()
+    if not spec:
+      continue
+    first, dash, last = spec.partition('-')
+    if not dash or not (first or last) or not (first + last).isdigit():
+      return None
+    if first:
+      start = int(first)
+      end = int(last) + 1 if last else size
+      if last and end <= start:
+        return None
+    else:
+      # the last N bytes
+      start, end = size - int(last), size
+    start = max(0, start)
+    end = min(size, end)
+    if start < end:
+      ranges.append((start, end))
+  if len(ranges) > _max_ranges:
+    return None
+  ranges.sort()
+  merged = []
+  for start, end in ranges:
+    if merged and start <= merged[-1][1]:
+      merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+    else:
+      merged.append((start, end))
+  return merged
+
+class _Ranges(object):
+  """The body of a 206 answer: byte ranges of an open file or of bytes.
+
+  parts is a list of (head, start, end): head is written before the range,
+  for the framing of multipart/byteranges; tail comes after the last one.
+  """
+
+  def __init__(self, source, parts, tail=b''):
+    self.source = source
+    self.parts = parts
+    self.tail = tail
+
+  def __len__(self):
+    return sum(len(head) + end - start for head, start, end in self.parts) + \
+        len(self.tail)
+
+  def write(self, handler):
+    for head, start, end in self.parts:
+      if head:
+        handler.wfile.write(head)
+      if isinstance(self.source, bytes):
+        handler.wfile.write(memoryview(self.source)[start:end])
+        continue
+      try:
+        metrics.sendfile(handler.connection, self.source, start, end - start)
+      except (AttributeError, io.UnsupportedOperation):
+        self.source.seek(start)
+        handler.wfile.write(self.source.read(end - start))
+    if self.tail:
+      handler.wfile.write(self.tail)
+
+  def close(self):
+    if not isinstance(self.source, bytes):
+      self.source.close()
+
+def _pick_encoding(encodings, ctype):
+  """Returns the encoding to compress a ctype body with on the fly, if any."""
+  if not ctype.startswith(_compressible):
+    return None
+  if 'br' in encodings and brotli is not None:
+    return 'br'
+  if 'gzip' in encodings:
+    return 'gzip'
+  return None
+
 class SSIRequestHandler(SimpleHTTPRequestHandler):
   """Adds minimal support for <!-- #include --> directives.
 
-  The key bit is translate_path, which intercepts requests and serves them
-  using a temporary file which inlines the #includes.
+  The key bit is send_head, which intercepts requests for .html files and
+  serves them from the page cache, inlining the #includes. Responses carry
+  strong ETags and are compressed when the client accepts gzip or brotli.
   """
 
-  def __init__(self, request, client_address, server):
-    self.temp_files = []
-    SimpleHTTPRequestHandler.__init__(self, request, client_address, server)
+  protocol_version = 'HTTP/1.1'
+  # seconds an idle kept-alive connection is held open
+  timeout = 120
 
-  def do_GET(self):
-    SimpleHTTPRequestHandler.do_GET(self)
-    self.delete_temp_files()
-
-  def do_HEAD(self):
-    SimpleHTTPRequestHandler.do_HEAD(self)
-    self.delete_temp_files()
+  extensions_map = dict(SimpleHTTPRequestHandler.extensions_map, **{
+      '.map': 'application/json',
+      '.dyc': columnar.MIME_TYPE,
+  })
 
   def translate_path(self, path):
     fs_path = SimpleHTTPRequestHandler.translate_path(self, path)
@@ -47,32 +518,816 @@ class SSIRequestHandler(SimpleHTTPRequestHandler):
         if os.path.exists(index):
           fs_path = index
           break
+    return fs_path
+
+  # special endpoints, by path, and the methods serving them
+  endpoints = {
+      '/__data': 'send_data',
+      '/__rolled': 'send_rolled',
+      '/__live': 'send_live',
+      '/__gen': 'send_generated',
+      '/__join': 'send_join',
+      '/__annotations': 'send_annotations',
+      '/__tq': 'send_tq',
+      '/__bench': 'send_bench',
+      '/__metrics': 'send_metrics',
+  }
+
+  # endpoints accepting POST, by path
+  post_endpoints = {
+      '/__live': 'ingest_live',
+      '/__bench': 'record_bench',
+  }
+
+  def setup(self):
+    SimpleHTTPRequestHandler.setup(self)
+    if metrics.enabled:
+      self.wfile = metrics.MeteredWriter(self.wfile)
+
+  def route(self):
+    """The route of the request, as metrics label it."""
+    path = urllib.parse.urlsplit(self.path).path
+    if path in self.endpoints or path in self.post_endpoints:
+      return path
+    if path[1:].partition('/')[0] in _mounts:
+      return 'archive'
+    return 'page' if path.endswith(('/', '.html')) else 'static'
+
+  def send_response(self, code, message=None):
+    self.status = code
+    SimpleHTTPRequestHandler.send_response(self, code, message)
+
+  def metered(self, method):
+    """Runs a do_* method, recording it in the metrics if they are on."""
+    if not metrics.enabled:
+      return method(self)
+    token = metrics.start(self.route())
+    self.status = 0
+    failed = True
+    try:
+      method(self)
+      failed = False
+    finally:
+      metrics.finish(token, self.status, self.command, self.path, failed)
+
+  def do_GET(self):
+    self.metered(SimpleHTTPRequestHandler.do_GET)
+
+  def do_HEAD(self):
+    self.metered(SimpleHTTPRequestHandler.do_HEAD)
+
+  def do_POST(self):
+    self.metered(SSIRequestHandler.handle_post)
+
+  def handle_post(self):
+    url = urllib.parse.urlsplit(self.path)
+    if url.path not in self.post_endpoints:
+      self.send_error(HTTPStatus.METHOD_NOT_ALLOWED, "Unsupported method")
+      return
+    if self.client_address[0] not in ('127.0.0.1', '::1'):
+      self.send_error(HTTPStatus.FORBIDDEN, "Only local clients may post")
+      return
+    try:
+      length = int(self.headers.get('Content-Length', ''))
+    except ValueError:
+      self.send_error(HTTPStatus.LENGTH_REQUIRED)
+      return
+    if length > _max_post:
+      self.send_error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+      return
+    body = self.rfile.read(length)
+    query = urllib.parse.parse_qs(url.query)
+    answer = getattr(self, self.post_endpoints[url.path])(query, body)
+    if answer is None:
+      return
+    self.send_response(HTTPStatus.OK)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(answer)))
+    self.end_headers()
+    self.wfile.write(answer)
+
+  def send_head(self):
+    url = urllib.parse.urlsplit(self.path)
+    if url.path in self.endpoints:
+      query = urllib.parse.parse_qs(url.query)
+      return getattr(self, self.endpoints[url.path])(query)
+    mount, _, rest = url.path[1:].partition('/')
+    if mount in _mounts:
+      return self.send_archived(url.path, _mounts[mount], rest)
+    fs_path = self.translate_path(self.path)
+    if not os.path.isfile(fs_path) or fs_path.endswith('/'):
+      return SimpleHTTPRequestHandler.send_head(self)
+    ctype = self.guess_type(fs_path)
+    encodings = _accepted_encodings(self.headers.get('Accept-Encoding'))
 
     if fs_path.endswith('.html'):
-      content = ssi.InlineIncludes(fs_path, _errorfnp)
-      fs_path = self.create_temp_file(fs_path, content)
+      content, etag, hit = _page_cache.get(fs_path)
+      headers = [('X-SSI-Cache', 'HIT' if hit else 'MISS')]
+      return self.send_body(content, ctype, etag, encodings, headers)
+
+    try:
+      f = open(fs_path, 'rb')
+    except OSError:
+      self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+      return None
+    try:
+      fs = os.fstat(f.fileno())
+      etag = '"%x-%x"' % (fs.st_mtime_ns, fs.st_size)
+      headers = [('Last-Modified', self.date_time_string(fs.st_mtime))]
+      if 'Range' in self.headers:
+        # ranges are of the file itself, never of a compressed variant
+        return self.send_file(f, ctype, etag, None, headers)
+
+      for encoding, suffix in ('br', '.br'), ('gzip', '.gz'):
+        if encoding not in encodings:
+          continue
+        sibling = fs_path + suffix
+        try:
+          ss = os.stat(sibling)
+          if ss.st_mtime_ns < fs.st_mtime_ns:
+            continue
+          precompressed = open(sibling, 'rb')
+        except OSError:
+          continue
+        f.close()
+        etag = '"%x-%x"' % (ss.st_mtime_ns, ss.st_size)
+        return self.send_file(precompressed, ctype, etag, encoding, headers)
+
+      if (fs.st_size >= _min_compress and fs.st_size <= _max_compress and
+          _pick_encoding(encodings, ctype) is not None):
+        f.close()
+        return self.send_body(lambda: _slurp(fs_path), ctype, etag,
+            encodings, headers)
+      return self.send_file(f, ctype, etag, None, headers)
+    except:
+      f.close()
+      raise
+
+  def send_archived(self, path, archive_path, name):
+    """Serves member name of a mounted archive; see archives.py."""
+    name = posixpath.normpath(urllib.parse.unquote(name))
+    if name == '.':
+      name = ''
+    if name.startswith('..'):
+      self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+      return None
+    try:
+      archive = _archive_cache.get(archive_path)
+    except (OSError, archives.Error, zipfile.BadZipFile) as e:
+      self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, str(e))
+      return None
+    if archive.is_dir(name):
+      if not path.endswith('/'):
+        self.send_response(HTTPStatus.MOVED_PERMANENTLY)
+        self.send_header('Location', path + '/')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return None
+      for index in 'index.html', 'index.htm':
+        if archive.size(posixpath.join(name, index)) is not None:
+          name = posixpath.join(name, index)
+          break
+    size = archive.size(name)
+    if size is None:
+      self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+      return None
+    ctype = self.guess_type(name)
+    encodings = _accepted_encodings(self.headers.get('Accept-Encoding'))
+    mtime_ns, _ = archive.stamp
+    headers = [('Last-Modified', self.date_time_string(mtime_ns // 10**9))]
+    try:
+      if name.endswith('.html'):
+        with metrics.phase('ssi'):
+          content = archive.render(name, _errorfnp)
+        return self.send_body(content, ctype, _etag(content), encodings,
+            headers)
+      etag = '"%x-%x-%s"' % (archive.stamp + (hashlib.sha1(name.encode(
+          'UTF-8')).hexdigest()[:12],))
+      stored = archive.stored(name)
+      if stored is not None and ('Range' in self.headers or not (
+          _min_compress <= size <= _max_compress and
+          _pick_encoding(encodings, ctype) is not None)):
+        f = open(archive_path, 'rb')
+        st = os.fstat(f.fileno())
+        if (st.st_mtime_ns, st.st_size) == archive.stamp:
+          return self.send_slice(f, stored[0], size, ctype, etag, headers)
+        # replaced since it was indexed; read() reports it
+        f.close()
+      return self.send_body(lambda: archive.read(name), ctype, etag,
+          encodings, headers)
+    except (OSError, archives.Error, zipfile.BadZipFile) as e:
+      self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, str(e))
+      return None
+
+  def send_slice(self, f, offset, size, ctype, etag, headers=()):
+    """Sends size bytes of the open file f from offset as the body."""
+    if self.not_modified(etag):
+      f.close()
+      return None
+    if 'Range' in self.headers:
+      partial = self.send_ranges(f, size, ctype, etag, headers, offset)
+      if partial is not False:
+        if partial is None:
+          f.close()
+        return partial
+    self.send_response(HTTPStatus.OK)
+    self.send_header('Content-type', ctype)
+    self.send_header('Content-Length', str(size))
+    self.send_common_headers(etag, None, headers, ctype)
+    self.end_headers()
+    return _Ranges(f, [(b'', offset, offset + size)])
+
+  def query_file(self, query):
+    """Returns the local path of the file= parameter, or sends an error."""
+    name = query.get('file', [''])[0]
+    fs_path = self.translate_path('/' + name.lstrip('/'))
+    if not name or not os.path.isfile(fs_path):
+      self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+      return None
     return fs_path
 
-  def delete_temp_files(self):
-    for temp_file in self.temp_files:
-      os.remove(temp_file)
+  def send_data(self, query):
+    """Serves a time slice of a CSV file, downsampled; see the module doc."""
+    fs_path = self.query_file(query)
+    if fs_path is None:
+      return None
+    arg = lambda name, default=None: query.get(name, [default])[-1]
+    if fs_path.endswith('.pyr'):
+      return self.send_pyramid(fs_path, arg)
+    try:
+      points = min(int(arg('points', '1000')), _max_points)
+      store = _data_cache.get(fs_path, arg('layout', 'plain'))
+      x0 = arg('from')
+      x1 = arg('to')
+      x0 = store.parse_x(x0) if x0 else None
+      x1 = store.parse_x(x1) if x1 else None
+      series = arg('series')
+      series = store.series_index(series) if series else 0
+      method = arg('method', 'minmax')
+      lo, hi = store.window(x0, x1)
+      rows = store.downsample(lo, hi, points, method, series)
+    except (ValueError, colstore.Error) as e:
+      self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+      return None
+    except OSError:
+      self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+      return None
+    fs = os.stat(fs_path)
+    etag = '"%x-%x-%s"' % (fs.st_mtime_ns, fs.st_size, hashlib.sha1(
+        repr((lo, hi, points, method, series, store.layout)).encode(
+        'UTF-8')).hexdigest()[:12])
+    encodings = _accepted_encodings(self.headers.get('Accept-Encoding'))
+    headers = [('X-Data-Rows', '%d/%d' % (len(rows), hi - lo)),
+        ('Vary', 'Accept')]
+    if columnar.accepts(self.headers.get('Accept')):
+      return self.send_body(lambda: columnar.store_rows(store, rows, True),
+          columnar.MIME_TYPE, etag[:-1] + '-c"', encodings, headers)
+    return self.send_body(lambda: store.csv(rows), 'text/csv; charset=UTF-8',
+        etag, encodings, headers)
+
+  def send_pyramid(self, fs_path, arg):
+    """Serves /__data from a pyramid file."""
+    try:
+      pyr = _pyramid_cache.get(fs_path)
+      points = min(int(arg('points', '1000')), _max_points)
+      x0 = arg('from')
+      x1 = arg('to')
+      x0 = pyr.parse_x(x0) if x0 else None
+      x1 = pyr.parse_x(x1) if x1 else None
+      mean_only = arg('format', 'bars') == 'mean'
+      k, lo, hi = pyr.query(x0, x1, points)
+    except (ValueError, pyramid.Error) as e:
+      self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+      return None
+    except OSError:
+      self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+      return None
+    fs = os.stat(fs_path)
+    etag = '"%x-%x-%d-%d-%d-%d"' % (fs.st_mtime_ns, fs.st_size, k, lo, hi,
+        mean_only)
+    encodings = _accepted_encodings(self.headers.get('Accept-Encoding'))
+    headers = [('X-Data-Level', str(k)), ('Vary', 'Accept')]
+    if columnar.accepts(self.headers.get('Accept')):
+      def body():
+        x, columns = pyr.columns(k, lo, hi, mean_only)
+        return columnar.encode(pyr.labels, x, columns,
+            'plain' if mean_only else 'customBars', pyr.is_date, True)
+      return self.send_body(body, columnar.MIME_TYPE, etag[:-1] + '-c"',
+          encodings, headers)
+    return self.send_body(lambda: pyr.csv(k, lo, hi, mean_only),
+        'text/csv; charset=UTF-8', etag, encodings, headers)
+
+  def send_rolled(self, query):
+    """Serves a CSV file with the rolling average applied; see the module doc."""
+    fs_path = self.query_file(query)
+    if fs_path is None:
+      return None
+    arg = lambda name, default=None: query.get(name, [default])[-1]
+    try:
+      mode = arg('mode', 'default')
+      if mode not in rolling.MODES:
+        raise ValueError('unknown mode %r' % mode)
+      roll = int(arg('roll', '1'))
+      if roll < 1:
+        raise ValueError('roll must be at least 1')
+      options = (mode, roll, float(arg('sigma', '2')),
+          arg('wilson', '1') != '0', arg('logscale', '0') != '0')
+      binary = columnar.accepts(self.headers.get('Accept'))
+      etag, body, hit = _rolled_cache.get(fs_path, options, binary)
+    except (ValueError, colstore.Error) as e:
+      self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+      return None
+    except OSError:
+      self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+      return None
+    dygraph_options = {'rollPeriod': 1}
+    if mode in rolling.BAR_MODES:
+      dygraph_options['customBars'] = True
+    encodings = _accepted_encodings(self.headers.get('Accept-Encoding'))
+    headers = [('X-Rolled-Cache', 'HIT' if hit else 'MISS'),
+        ('X-Dygraph-Options', json.dumps(dygraph_options, sort_keys=True)),
+        ('Vary', 'Accept')]
+    ctype = columnar.MIME_TYPE if binary else 'text/csv; charset=UTF-8'
+    return self.send_body(body, ctype, etag, encodings, headers)
+
+  def send_live(self, query):
+    """Streams a live channel as Server-Sent Events; see the module doc."""
+    name = query.get('channel', [''])[-1]
+    channel = _live_channels.get(name)
+    if channel is None:
+      self.send_error(HTTPStatus.NOT_FOUND, "No such channel")
+      return None
+    try:
+      last = int(self.headers.get('Last-Event-ID', ''))
+    except ValueError:
+      last = None
+    self.send_response(HTTPStatus.OK)
+    self.send_header('Content-Type', 'text/event-stream')
+    self.send_header('Cache-Control', 'no-cache')
+    # the stream has no length; it ends with the connection
+    self.send_header('Connection', 'close')
+    self.end_headers()
+    if self.command == 'HEAD':
+      return None
+    try:
+      for event in channel.events(last):
+        self.wfile.write(event)
+    except (ConnectionError, OSError):
+      pass
+    self.close_connection = True
+    return None
+
+  def ingest_live(self, query, body):
+    """Appends the CSV rows of body to a live channel."""
+    arg = lambda name, default=None: query.get(name, [default])[-1]
+    name = arg('channel', '')
+    if not name:
+      self.send_error(HTTPStatus.BAD_REQUEST, "channel missing")
+      return None
+    try:
+      capacity = arg('capacity')
+      capacity = int(capacity) if capacity else None
+      if arg('reset', '0') != '0':
+        _live_channels.delete(name)
+      channel, n = _live_channels.ingest(name, body.decode('UTF-8'), capacity)
+    except (ValueError, live.Error) as e:
+      self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+      return None
+    return json.dumps({'appended': n, 'rows': len(channel),
+        'seq': channel.seq}).encode('UTF-8')
+
+  def send_generated(self, query):
+    """Streams a synthetic data set; see datagen.py."""
+    arg = lambda name, default=None: query.get(name, [default])[-1]
+    try:
+      params = (int(arg('rows', '1000')), int(arg('series', '1')),
+          arg('layout', 'plain'), float(arg('gaps', '0')),
+          arg('dates', '0') != '0', int(arg('seed', '1')))
+      chunks = datagen.chunks(*params)
+    except ValueError as e:
+      self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+      return None
+    etag = '"gen-%s"' % hashlib.sha1(repr(params).encode('UTF-8')).hexdigest(
+        )[:20]
+    if self.not_modified(etag):
+      return None
+    self.send_response(HTTPStatus.OK)
+    self.send_header('Content-Type', 'text/csv; charset=UTF-8')
+    self.send_header('ETag', etag)
+    self.send_header('Connection', 'close')
+    self.end_headers()
+    if self.command == 'HEAD':
+      return None
+    try:
+      for chunk in chunks:
+        self.wfile.write(chunk)
+    except (ConnectionError, OSError):
+      pass
+    self.close_connection = True
+    return None
+
+  def send_join(self, query):
+    """Merge-joins several CSV files on x; see join.py."""
+    arg = lambda name, default=None: query.get(name, [default])[-1]
+    names = query.get('file', [])
+    fmt = arg('format', 'wide')
+    if not names or len(names) > _max_join_files or fmt not in ('wide',
+        'slices'):
+      self.send_error(HTTPStatus.BAD_REQUEST,
+          'give 1 to %d file= and format=wide or slices' % _max_join_files)
+      return None
+    paths = [self.translate_path('/' + name.lstrip('/')) for name in names]
+    if not all(os.path.isfile(path) for path in paths):
+      self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+      return None
+    try:
+      sources = join.open_sources(paths, arg('layout', 'plain'))
+    except join.Error as e:
+      self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+      return None
+    except OSError:
+      self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+      return None
+    try:
+      x0 = arg('from')
+      x1 = arg('to')
+      x0 = sources[0].parse_x(x0) if x0 else None
+      x1 = sources[0].parse_x(x1) if x1 else None
+      stamps = [(st.st_mtime_ns, st.st_size) for st in map(os.stat, paths)]
+      etag = '"join-%s"' % hashlib.sha1(repr((stamps, names, x0, x1, fmt,
+          sources[0].layout)).encode('UTF-8')).hexdigest()[:20]
+      rows = join.join(sources, x0, x1)
+      if fmt == 'slices':
+        try:
+          body = join.slices_json(sources, rows)
+        except join.Error as e:
+          self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+          return None
+        encodings = _accepted_encodings(self.headers.get('Accept-Encoding'))
+        return self.send_body(body, 'application/json', etag, encodings)
+      if self.not_modified(etag):
+        return None
+      self.send_response(HTTPStatus.OK)
+      self.send_header('Content-Type', 'text/csv; charset=UTF-8')
+      self.send_header('ETag', etag)
+      self.send_header('Connection', 'close')
+      self.end_headers()
+      if self.command == 'HEAD':
+        return None
+      try:
+        for chunk in join.wide_csv(sources, rows):
+          self.wfile.write(chunk)
+      except join.Error as e:
+        # too late for an error status; the truncated answer shows it
+        self.log_error('%s', e)
+      except (ConnectionError, OSError):
+        pass
+      self.close_connection = True
+      return None
+    finally:
+      for source in sources:
+        source.close()
+
+  def send_annotations(self, query):
+    """Serves the annotations in an x range; see annotations.py."""
+    fs_path = self.query_file(query)
+    if fs_path is None:
+      return None
+    arg = lambda name, default=None: query.get(name, [default])[-1]
+    try:
+      index = _annotation_cache.get(fs_path)
+      x0 = arg('from')
+      x1 = arg('to')
+      x0 = index.parse_x(x0) if x0 else None
+      x1 = index.parse_x(x1) if x1 else None
+      series = query.get('series')
+      width = int(arg('width', '0'))
+      spacing = float(arg('spacing', '16'))
+      limit = min(int(arg('max', '100')), _max_annotations)
+      found, matching = index.query(x0, x1, series, width, spacing, limit)
+    except (ValueError, annotations.Error) as e:
+      self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+      return None
+    except OSError:
+      self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+      return None
+    body = json.dumps(found, sort_keys=True).encode('UTF-8')
+    encodings = _accepted_encodings(self.headers.get('Accept-Encoding'))
+    return self.send_body(body, 'application/json', _etag(body), encodings,
+        [('X-Annotations', '%d/%d' % (len(found), matching))])
+
+  def send_tq(self, query):
+    """Answers a Google Visualization query; see gviz.py."""
+    fs_path = self.query_file(query)
+    if fs_path is None:
+      return None
+    arg = lambda name, default=None: query.get(name, [default])[-1]
+    tqx = gviz.parse_tqx(arg('tqx'))
+    tq = arg('tq', '')
+    encodings = _accepted_encodings(self.headers.get('Accept-Encoding'))
+    try:
+      store = _data_cache.get(fs_path, arg('layout', 'plain'))
+      fs = os.stat(fs_path)
+      sig = gviz.signature((fs.st_mtime_ns, fs.st_size), store.layout, tq)
+      ctype, chunks = gviz.response(store, tq, tqx, sig)
+    except gviz.Error as e:
+      body = gviz.error_response(tqx, e.reason, str(e) if e.args[0] else None)
+      return self.send_body(body, 'text/javascript; charset=UTF-8',
+          _etag(body), encodings)
+    except colstore.Error as e:
+      self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+      return None
+    except OSError:
+      self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+      return None
+    etag = '"tq-%s-%s"' % (sig, hashlib.sha1(repr(sorted(tqx.items())).encode(
+        'UTF-8')).hexdigest()[:8])
+    if self.not_modified(etag):
+      return None
+    self.send_response(HTTPStatus.OK)
+    self.send_header('Content-Type', ctype)
+    self.send_header('ETag', etag)
+    self.send_header('Connection', 'close')
+    self.end_headers()
+    if self.command == 'HEAD':
+      return None
+    try:
+      for chunk in chunks:
+        self.wfile.write(chunk)
+    except (ConnectionError, OSError):
+      pass
+    self.close_connection = True
+    return None
+
+  def send_metrics(self, query):
+    """Serves the request metrics in the Prometheus format; see metrics.py."""
+    if not metrics.enabled:
+      self.send_error(HTTPStatus.NOT_FOUND, "Metrics are off (see --metrics)")
+      return None
+    body = metrics.render()
+    encodings = _accepted_encodings(self.headers.get('Accept-Encoding'))
+    return self.send_body(body, metrics.MIME_TYPE, _etag(body), encodings,
+        [('Cache-Control', 'no-store')])
+
+  def send_bench(self, query):
+    """Returns stored benchmark results as JSON; see bench.py."""
+    arg = lambda name, default=None: query.get(name, [default])[-1]
+    if 'compare' in query:
+      result = _bench_results.compare(query['compare'], arg('page'))
+    else:
+      params = dict((k[len('param.'):], v[-1]) for k, v in query.items()
+          if k.startswith('param.'))
+      result = _bench_results.records(arg('build'), arg('page'), params)
+    body = json.dumps(result, sort_keys=True).encode('UTF-8')
+    encodings = _accepted_encodings(self.headers.get('Accept-Encoding'))
+    return self.send_body(body, 'application/json', _etag(body), encodings)
+
+  def record_bench(self, query, body):
+    """Stores a benchmark record posted as JSON."""
+    if len(body) > bench.MAX_RECORD:
+      self.send_error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+      return None
+    try:
+      record = _bench_results.add(json.loads(body.decode('UTF-8')),
+          self.headers.get('User-Agent'))
+    except (ValueError, bench.Error) as e:
+      self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+      return None
+    except OSError as e:
+      self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, str(e))
+      return None
+    return json.dumps({'received': record['received']}).encode('UTF-8')
+
+  def not_modified(self, etag):
+    """Answers a conditional request with 304 if etag matches."""
+    inm = self.headers.get('If-None-Match')
+    if inm is None:
+      return False
+    tags = [tag.strip() for tag in inm.split(',')]
+    if '*' not in tags and etag not in tags:
+      return False
+    self.send_response(HTTPStatus.NOT_MODIFIED)
+    self.send_header('ETag', etag)
+    self.end_headers()
+    return True
+
+  def send_body(self, body, ctype, etag, encodings, headers=()):
+    """Sends an in-memory body, compressed when the client allows it.
+
+    body is bytes or a callable producing them, so that cached compressed
+    bodies need not be read from disk again.
+    """
+    ranged = 'Range' in self.headers
+    encoding = None if ranged else _pick_encoding(encodings, ctype)
+    if encoding is not None:
+      etag = etag[:-1] + '-' + encoding + '"'
+      if self.not_modified(etag):
+        return None
+      body = _compressed_cache.get(etag, encoding, body)
+    else:
+      if self.not_modified(etag):
+        return None
+      if callable(body):
+        body = body()
+    if ranged:
+      partial = self.send_ranges(bytes(body), len(body), ctype, etag, headers)
+      if partial is not False:
+        return partial
+    self.send_response(HTTPStatus.OK)
+    self.send_header('Content-type', ctype)
+    self.send_header('Content-Length', str(len(body)))
+    self.send_common_headers(etag, encoding, headers, ctype)
+    self.end_headers()
+    return io.BytesIO(body)
+
+  def send_file(self, f, ctype, etag, encoding, headers=()):
+    """Sends the open file f as the body."""
+    if encoding is not None:
+      etag = etag[:-1] + '-' + encoding + '"'
+    if self.not_modified(etag):
+      f.close()
+      return None
+    size = os.fstat(f.fileno()).st_size
+    if encoding is None and 'Range' in self.headers:
+      partial = self.send_ranges(f, size, ctype, etag, headers)
+      if partial is not False:
+        if partial is None:
+          f.close()
+        return partial
+    self.send_response(HTTPStatus.OK)
+    self.send_header('Content-type', ctype)
+    self.send_header('Content-Length', str(size))
+    self.send_common_headers(etag, encoding, headers, ctype)
+    self.end_headers()
+    return f
+
+  def send_ranges(self, source, size, ctype, etag, headers, base=0):
+    """Answers a Range request for source, an open file or bytes.
+
+    The body is the size bytes of source from offset base.
+
+    Returns the body to copy, None if there is none (416), or False if the
+    whole body is to be sent instead (no usable Range, or If-Range failed).
+    """
+    if_range = self.headers.get('If-Range')
+    if if_range is not None and if_range.strip() != etag and if_range.strip() \
+        not in [v for name, v in headers if name == 'Last-Modified']:
+      return False
+    ranges = _parse_ranges(self.headers.get('Range'), size)
+    if ranges is None:
+      return False
+    if not ranges:
+      self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+      self.send_header('Content-Range', 'bytes */%d' % size)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return None
+    self.send_response(HTTPStatus.PARTIAL_CONTENT)
+    if len(ranges) == 1:
+      start, end = ranges[0]
+      body = _Ranges(source, [(b'', base + start, base + end)])
+      self.send_header('Content-type', ctype)
+      self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1,
+          size))
+    else:
+      boundary = hashlib.sha1(('%s %r' % (etag, ranges)).encode(
+          'UTF-8')).hexdigest()[:24]
+      parts = []
+      for start, end in ranges:
+        head = '\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d' \
+            '\r\n\r\n' % (boundary, ctype, start, end - 1, size)
+        parts.append((head.encode('ascii'), base + start, base + end))
+      body = _Ranges(source, parts, ('\r\n--%s--\r\n' % boundary).encode(
+          'ascii'))
+      self.send_header('Content-type',
+          'multipart/byteranges; boundary=' + boundary)
+    self.send_header('Content-Length', str(len(body)))
+    self.send_header('ETag', etag)
+    for name, value in headers:
+      self.send_header(name, value)
+    self.end_headers()
+    return body
+
+  def send_common_headers(self, etag, encoding, headers, ctype):
+    self.send_header('ETag', etag)
+    self.send_header('Accept-Ranges', 'bytes')
+    if encoding is not None:
+      self.send_header('Content-Encoding', encoding)
+    if ctype.startswith(_compressible):
+      self.send_header('Vary', 'Accept-Encoding')
+    for name, value in headers:
+      self.send_header(name, value)
+
+  def copyfile(self, source, outputfile):
+    if isinstance(source, _Ranges):
+      source.write(self)
+      return
+    if isinstance(source, io.BytesIO):
+      outputfile.write(source.getbuffer())
+      return
+    try:
+      # zero-copy for regular files; falls back to send() by itself
+      metrics.sendfile(self.connection, source)
+    except (AttributeError, io.UnsupportedOperation):
+      shutil.copyfileobj(source, outputfile)
+
+class SSIHTTPServer(http.server.ThreadingHTTPServer):
+  """A threading server with a listen backlog suited to many clients."""
+  daemon_threads = True
+  request_queue_size = 1024
+
+class ReusePortHTTPServer(SSIHTTPServer):
+  """One of several servers sharing a port through SO_REUSEPORT."""
 
-  def create_temp_file(self, original_path, content):
-    _, ext = os.path.splitext(original_path)
-    fd, path = tempfile.mkstemp(suffix=ext)
-    os.write(fd, content)
-    os.close(fd)
+  def server_bind(self):
+    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    SSIHTTPServer.server_bind(self)
 
-    self.temp_files.append(path)
-    return path
+def serve_workers(nworkers, bind, port):
+  """Pre-forks nworkers processes serving on the same port."""
+  if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(os, 'fork'):
+    sys.exit('E: --workers needs fork and SO_REUSEPORT')
+  children = []
+  for _ in range(nworkers):
+    pid = os.fork()
+    if pid == 0:
+      signal.signal(signal.SIGINT, signal.SIG_DFL)
+      with ReusePortHTTPServer((bind, port), SSIRequestHandler) as httpd:
+        httpd.serve_forever()
+      os._exit(0)
+    children.append(pid)
+  sys.stderr.write('Serving HTTP on %s port %d with %d workers ...\n' % (
+      bind or '0.0.0.0', port, nworkers))
+  try:
+    for pid in children:
+      os.waitpid(pid, 0)
+  except KeyboardInterrupt:
+    sys.stderr.write('\nKeyboard interrupt received, exiting.\n')
+  finally:
+    for pid in children:
+      try:
+        os.kill(pid, signal.SIGTERM)
+      except ProcessLookupError:
+        pass
 
 if __name__ == '__main__':
-  import sys
-  def _errorf(msg):
+  import argparse
+  def _errorf(msg, fn=None):
     sys.stderr.write('ERROR: %s\n' % msg)
   _errorfnp = _errorf
-  if len(sys.argv) > 1:
-    port = int(sys.argv[1])
-  else:
-    port = 8081
-  http.server.test(HandlerClass=SSIRequestHandler, port=port)
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--cache-size', type=int, default=32, metavar='MiB',
+      help='memory used for expanded pages and for compressed bodies, '
+      'each (default: %(default)s)')
+  parser.add_argument('--data-cache-size', type=int, default=256,
+      metavar='MiB', help='memory used for parsed /__data files '
+      '(default: %(default)s)')
+  parser.add_argument('--bench-results', default='bench-results.jsonl',
+      metavar='FILE', help='where /__bench stores benchmark results '
+      '(default: %(default)s)')
+  parser.add_argument('--mount', action='append', default=[],
+      metavar='[VERSION=]ARCHIVE', help='serve the release archive ARCHIVE '
+      '(.zip, .tar, .tar.gz, ...) at /VERSION/; VERSION defaults to the one '
+      'in its name (repeatable)')
+  parser.add_argument('--metrics', action='store_true',
+      help='count requests and serve the counts at /__metrics')
+  parser.add_argument('--trace', metavar='FILE',
+      help='with --metrics, append sampled requests to FILE as JSON lines')
+  parser.add_argument('--trace-sample', type=float, default=0.01,
+      metavar='P', help='fraction of the requests traced '
+      '(default: %(default)s)')
+  parser.add_argument('--workers', type=int, default=0, metavar='N',
+      help='pre-fork N worker processes sharing the port')
+  parser.add_argument('--bind', default='', metavar='ADDRESS',
+      help='address to bind to (default: all interfaces)')
+  parser.add_argument('port', type=int, nargs='?', default=8081)
+  args = parser.parse_args()
+  _page_cache = PageCache(args.cache_size << 20)
+  _compressed_cache = CompressedCache(args.cache_size << 20)
+  _data_cache = DataCache(args.data_cache_size << 20)
+  _bench_results = bench.Results(args.bench_results)
+  if args.metrics:
+    metrics.enable(args.trace, args.trace_sample)
+  for mount in args.mount:
+    version, _, archive = mount.rpartition('=')
+    version = version or archives.version_of(archive)
+    if not version or '/' in version or not os.path.isfile(archive):
+      parser.error('cannot mount %r' % mount)
+    _mounts[version] = archive
+  if args.workers > 0:
+    serve_workers(args.workers, args.bind, args.port)
+    sys.exit(0)
+  try:
+    http.server.test(HandlerClass=SSIRequestHandler,
+        ServerClass=SSIHTTPServer, protocol=SSIRequestHandler.protocol_version,
+        port=args.port, bind=args.bind or None)
+  finally:
+    sys.stderr.write('SSI page cache: %s\n' % _page_cache.stats())
+    sys.stderr.write('Compressed cache: %s\n' % _compressed_cache.stats())
+    sys.stderr.write('Data cache: %s\n' % _data_cache.stats())
+    sys.stderr.write('Pyramid cache: %s\n' % _pyramid_cache.stats())
+    sys.stderr.write('Rolled cache: %s\n' % _rolled_cache.stats())
+    sys.stderr.write('Annotation cache: %s\n' % _annotation_cache.stats())
+    sys.stderr.write('Archive cache: %s\n' % _archive_cache.stats())
+    sys.stderr.write('Live channels: %s\n' % _live_channels.stats())
+    _live_channels.close()
@@ -20,7 +20,7 @@ fi
 
 rm -f docs/download.html docs/options.html docs/versions.html
 python3 scripts/generate-download.py ${dv:+"$dv"} >docs/download.html
-python3 scripts/generate-documentation.py >docs/options.html
+python3 scripts/generate-documentation.py --output docs/options.html
 mksh scripts/generate-versions.sh >docs/versions.html
 chmod a+r docs/download.html docs/options.html docs/versions.html
 for file in docs/download.html docs/options.html docs/versions.html; do
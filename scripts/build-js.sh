@@ -51,7 +51,7 @@ fi
 pax -rw -l auto_tests src disttmp/
 
 # licence headers for unminified and minified js, respectively
-mksh scripts/txt2js.sh LICENSE.txt disttmp/LICENCE.js
+python3 scripts/buildsteps.py 'txt2js LICENSE.txt disttmp/LICENCE.js'
 header="/*! @license https://github.com/danvk/dygraphs/blob/v$relv/LICENSE.txt (MIT) */"
 
 # prepare for building; avoid bad relative paths
@@ -123,7 +123,7 @@ rm -rf auto_tests src
 
 # bundle dygraph.js{,.map} and tests.js with dev env
 cp -r es5 src
-mksh ../scripts/env-patcher.sh development src
+python3 ../scripts/buildsteps.py 'env-patch development src'
 $node_js "$patchedbrowserify" \
     -v \
     --debug \
@@ -140,16 +140,10 @@ $node_js "$patchedbrowserify" \
     tests5/tests/*.js \
     >tests.tmp.js
 rm -rf src
-python3 ../scripts/smap-out.py dygraph.tmp.js dygraph.js dygraph.js.map
-python3 ../scripts/smap-out.py tests.tmp.js tests.tmp2.js tests.tmp.map
-jq . <tests.tmp.map | perl -MCwd -pe \
-    's!^ *"((?:\.\./)+)!Cwd::realpath($1) eq "/" ? "\"/" : $&!e;' \
-    >tests.tmp2.map
-python3 ../scripts/smap-in.py tests.tmp2.js tests.tmp2.map tests.js #--nonl
-
-# bundle and minify dygraph.min.js{,.map} with prod env
+
+# bundle dygraph.min.js{,.map} with prod env
 cp -r es5 src
-mksh ../scripts/env-patcher.sh production src
+python3 ../scripts/buildsteps.py 'env-patch production src'
 $node_js "$patchedbrowserify" \
     -v \
     --debug \
@@ -158,8 +152,17 @@ $node_js "$patchedbrowserify" \
     src/dygraph.js \
     >dygraph.min.tmp.js
 rm -rf src
-python3 ../scripts/smap-out.py dygraph.min.tmp.js /dev/null dygraph.min.tmp.js.map
 
+# extract/fix up the source maps; the three chains run concurrently
+# and are skipped if their bundle did not change since the last build
+python3 ../scripts/buildsteps.py \
+    'smap-out dygraph.tmp.js dygraph.js dygraph.js.map' \
+    'smap-out --stream tests.tmp.js tests.tmp2.js tests.tmp.map' \
+    'absolutise tests.tmp.map tests.tmp2.map' \
+    'smap-in --stream tests.tmp2.js tests.tmp2.map tests.js' \
+    'smap-out dygraph.min.tmp.js /dev/null dygraph.min.tmp.js.map'
+
+# minify
 uglifyjs=$(uglifyjs --help 2>&1)
 set -A compatopts -- --no-module --v8 --webkit
 [[ $uglifyjs = *--no-module* ]] || unset compatopts[0]
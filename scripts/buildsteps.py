@@ -0,0 +1,472 @@
+#!/usr/bin/python3
+'''
+Runs the Python-driven build steps of build-js.sh in one interpreter.
+
+Every step names a tool and its arguments, as it would be invoked from
+the shell. The source map tools (smap-out, smap-in, absolutise, compose)
+run in-process; txt2js and env-patch only spawn the node half of their
+work. Steps are cached by content: the key of a step is the SHA-1 of its
+tool, arguments, the tool's own sources and the contents of its inputs,
+and a hit copies the stored outputs instead of running it. Steps that do
+not read or write each other's files run concurrently, in order otherwise.
+
+Usage:
+
+  python3 buildsteps.py [--cache DIR] [--jobs N] 'tool arg ...' ...
+  python3 buildsteps.py --test
+
+Tools:
+
+  smap-out [--stream] in.js out.js out.map [maplink]
+  smap-in [--stream] in.js in.map out.js [--nonl]
+  absolutise in.map out.map
+  compose inner.map outer.map out.map
+  txt2js in.txt out.js
+  env-patch development|production path ...
+
+env-patch expands to one step per file below the paths that mentions
+process.env.NODE_ENV, each patched in place.
+
+The cache defaults to $DYGRAPHS_BUILD_CACHE or .buildcache at the top of
+the source tree; --cache '' disables it. Entries not used for two weeks
+are removed at the end of a run.
+'''
+
+import concurrent.futures
+import hashlib
+import importlib.util
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+mydir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, mydir)
+import smap_stream
+import sourcemap
+
+_cache_version = 1
+_max_age = 14 * 86400
+_log_lock = threading.Lock()
+
+def log(msg):
+    with _log_lock:
+        sys.stderr.write(msg + '\n')
+
+def _load_script(name):
+    '''Imports scripts/<name>.py, which has no importable module name.'''
+    spec = importlib.util.spec_from_file_location(
+        name.replace('-', '_'), os.path.join(mydir, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+smap_out = _load_script('smap-out')
+smap_in = _load_script('smap-in')
+
+def _node():
+    return 'nodejs' if shutil.which('nodejs') else 'node'
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(1 << 20)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+class Step(object):
+    '''One cacheable unit of work.
+
+    run() must create all outputs from the inputs; files named in tools
+    (relative to scripts/) are part of the cache key.
+    '''
+
+    def __init__(self, label, inputs, outputs, run, tools=()):
+        self.label = label
+        self.inputs = [os.path.normpath(p) for p in inputs]
+        self.outputs = [os.path.normpath(p) for p in outputs
+                        if p != os.devnull]
+        self.run = run
+        self.tools = tools
+
+    def key(self):
+        h = hashlib.sha1()
+        h.update(b'%d\0%s\0%s\0' % (_cache_version,
+                 self.label.encode('UTF-8'), os.getcwd().encode('UTF-8')))
+        for tool in self.tools:
+            h.update(file_digest(os.path.join(mydir, tool)).encode('ascii'))
+        for path in self.inputs:
+            h.update(b'%s\0%s\0' % (path.encode('UTF-8'),
+                     file_digest(path).encode('ascii')))
+        return h.hexdigest()
+
+    def conflicts(self, other):
+        '''Whether this step must not run concurrently with other.'''
+        mine = set(self.inputs) | set(self.outputs)
+        theirs = set(other.inputs) | set(other.outputs)
+        return bool(set(other.outputs) & mine or set(self.outputs) & theirs)
+
+def _split_stream(args):
+    if args and args[0] == '--stream':
+        return True, args[1:]
+    return False, args
+
+def _smap_out(args):
+    stream, args = _split_stream(args)
+    if len(args) not in (3, 4):
+        raise ValueError('smap-out [--stream] in.js out.js out.map [maplink]')
+    maplink = args[3] if len(args) == 4 else args[2]
+    fn = smap_stream.extract if stream else smap_out.extract
+    return Step(shlex.join(['smap-out'] + (['--stream'] if stream else []) + args),
+                [args[0]], [args[1], args[2]],
+                lambda: fn(args[0], args[1], args[2], maplink),
+                ('smap-out.py', 'smap_stream.py'))
+
+def _smap_in(args):
+    stream, args = _split_stream(args)
+    if len(args) == 4 and args[3] == '--nonl':
+        donl = False
+    elif len(args) == 3:
+        donl = True
+    else:
+        raise ValueError('smap-in [--stream] in.js in.map out.js [--nonl]')
+    fn = smap_stream.embed if stream else smap_in.embed
+    return Step(shlex.join(['smap-in'] + (['--stream'] if stream else []) + args),
+                args[:2], [args[2]],
+                lambda: fn(args[0], args[1], args[2], donl),
+                ('smap-in.py', 'smap_stream.py'))
+
+def _absolutise(args):
+    if len(args) != 2:
+        raise ValueError('absolutise in.map out.map')
+    def run():
+        smap = sourcemap.SourceMap.load(args[0])
+        smap.absolutise_sources()
+        smap.save(args[1], indent=2)
+    return Step(shlex.join(['absolutise'] + args), args[:1], args[1:], run,
+                ('sourcemap.py',))
+
+def _compose(args):
+    if len(args) != 3:
+        raise ValueError('compose inner.map outer.map out.map')
+    def run():
+        outer = sourcemap.SourceMap.load(args[1])
+        outer.compose(sourcemap.SourceMap.load(args[0])).save(args[2])
+    return Step(shlex.join(['compose'] + args), args[:2], args[2:], run,
+                ('sourcemap.py',))
+
+def _txt2js(args):
+    if len(args) != 2:
+        raise ValueError('txt2js in.txt out.js')
+    infile, outfile = args
+    def run():
+        tmp = outfile + '.tmp.js'
+        log('I: converting %s to %s' % (infile, outfile))
+        try:
+            subprocess.run([_node(), os.path.join(mydir, 'txt2js.js'),
+                            infile, tmp], check=True)
+            smap_in.embed(tmp, tmp + '.map', outfile, False)
+        finally:
+            for path in (tmp, tmp + '.map'):
+                if os.path.exists(path):
+                    os.unlink(path)
+    return Step(shlex.join(['txt2js'] + args), [infile], [outfile], run,
+                ('txt2js.js', 'smap-in.py'))
+
+def _env_patch_file(mode, path):
+    rpl = 'true' if mode == 'development' else 'false'
+    def run():
+        log('I: patching %s for !prod=%s' % (path, rpl))
+        with tempfile.TemporaryDirectory(prefix='env-patcher.') as tmp:
+            smap_out.extract(path, os.path.join(tmp, 'env-patcher.tmp-in.js'),
+                             os.path.join(tmp, 'env-patcher.tmp-in.map'),
+                             'env-patcher.tmp-in.map')
+            env = dict(os.environ, s=os.path.join(mydir, 'env-patcher.js'),
+                       r=rpl, NODE_REPL_HISTORY='', NODE_NO_READLINE='1')
+            proc = subprocess.run([_node(), '-i'], cwd=tmp, env=env,
+                                  input=b'await require(process.env.s)(process.env.r);\n',
+                                  stdout=subprocess.PIPE)
+            out_js = os.path.join(tmp, 'env-patcher.tmp-out.js')
+            if proc.returncode or not os.path.exists(out_js):
+                sys.stderr.buffer.write(proc.stdout)
+                raise smap_stream.Error('env-patcher failed for %s' % path)
+            smap_in.embed(out_js, os.path.join(tmp, 'env-patcher.tmp-out.map'),
+                          path, False)
+    return Step(shlex.join(['env-patch', mode, path]), [path], [path], run,
+                ('env-patcher.js', 'smap-out.py', 'smap-in.py'))
+
+def _env_patch(args):
+    if len(args) < 2 or args[0] not in ('development', 'production'):
+        raise ValueError('env-patch development|production path ...')
+    steps = []
+    for top in args[1:]:
+        paths = [top] if os.path.isfile(top) else sorted(
+            os.path.join(dirpath, filename)
+            for dirpath, _, filenames in os.walk(top)
+            for filename in filenames)
+        for path in paths:
+            with open(path, 'rb') as f:
+                if b'process.env.NODE_ENV' in f.read():
+                    steps.append(_env_patch_file(args[0], path))
+    return steps
+
+_tools = {
+    'smap-out': _smap_out,
+    'smap-in': _smap_in,
+    'absolutise': _absolutise,
+    'compose': _compose,
+    'txt2js': _txt2js,
+    'env-patch': _env_patch,
+}
+
+def parse_step(spec):
+    '''Returns the list of Steps for a 'tool arg ...' string.'''
+    words = shlex.split(spec)
+    if not words or words[0] not in _tools:
+        raise ValueError('unknown tool in %r' % spec)
+    steps = _tools[words[0]](words[1:])
+    return steps if isinstance(steps, list) else [steps]
+
+class Cache(object):
+    '''Stores the outputs of steps by key below directory top.'''
+
+    def __init__(self, top):
+        self.top = top
+
+    def _dir(self, key):
+        return os.path.join(self.top, key[:2], key)
+
+    def restore(self, key, outputs):
+        entry = self._dir(key)
+        if not os.path.isdir(entry):
+            return False
+        for i, path in enumerate(outputs):
+            if not os.path.exists(os.path.join(entry, str(i))):
+                return False
+        for i, path in enumerate(outputs):
+            # never write through a hardlink into the source tree
+            if os.path.lexists(path):
+                os.unlink(path)
+            shutil.copyfile(os.path.join(entry, str(i)), path)
+        os.utime(entry)
+        return True
+
+    def store(self, key, outputs):
+        entry = self._dir(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=key + '.', dir=os.path.dirname(entry))
+        try:
+            for i, path in enumerate(outputs):
+                shutil.copyfile(path, os.path.join(tmp, str(i)))
+            os.rename(tmp, entry)
+        except OSError:
+            # a concurrent build stored the same key first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def prune(self, max_age=_max_age):
+        limit = time.time() - max_age
+        if not os.path.isdir(self.top):
+            return
+        for prefix in os.listdir(self.top):
+            subdir = os.path.join(self.top, prefix)
+            for key in os.listdir(subdir):
+                entry = os.path.join(subdir, key)
+                if os.stat(entry).st_mtime < limit:
+                    shutil.rmtree(entry, ignore_errors=True)
+
+def run_steps(steps, cache=None, jobs=None):
+    '''Runs steps, concurrently where they are independent.
+
+    Returns (number of cache hits, list of (step, exception) failures).
+    '''
+    deps = [set(j for j in range(i) if steps[i].conflicts(steps[j]))
+            for i in range(len(steps))]
+    hits = []
+    failures = []
+
+    def execute(step):
+        key = step.key() if cache else None
+        if key and cache.restore(key, step.outputs):
+            hits.append(step)
+            return
+        step.run()
+        if key:
+            cache.store(key, step.outputs)
+
+    done = set()
+    started = set()
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(jobs or os.cpu_count() or 1) as pool:
+        while True:
+            if not failures:
+                for i, step in enumerate(steps):
+                    if i not in started and deps[i] <= done:
+                        started.add(i)
+                        running[pool.submit(execute, step)] = i
+            if not running:
+                break
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                i = running.pop(future)
+                if future.exception() is not None:
+                    failures.append((steps[i], future.exception()))
+                else:
+                    done.add(i)
+    return len(hits), failures
+
+def _selftest():
+    rv = 0
+    tmp = tempfile.mkdtemp(prefix='buildsteps-test.')
+    def path(name):
+        return os.path.join(tmp, name)
+    def read(name):
+        with open(path(name)) as f:
+            return f.read()
+    def write(name, text):
+        with open(path(name), 'w') as f:
+            f.write(text)
+
+    # stub steps write fn(concatenated inputs) to each output and log runs
+    ran = []
+    def stub(label, inputs, outputs, fn, delay=0):
+        def run():
+            ran.append(label)
+            text = ''.join(read(name) for name in inputs)
+            time.sleep(delay)
+            for name in outputs:
+                write(name, fn(text))
+        return Step(label, [path(n) for n in inputs],
+                    [path(n) for n in outputs], run)
+    # count reads what upper writes, so must wait for it despite the delay
+    def build():
+        return [stub('upper', ['a.txt'], ['a.out'], str.upper, 0.2),
+                stub('count', ['a.out'], ['b.out'], lambda t: str(len(t))),
+                stub('copy', ['c.txt'], ['c.out'], lambda t: t)]
+
+    cache = Cache(path('cache'))
+    try:
+        write('a.txt', 'abc')
+        write('c.txt', 'c')
+        result = run_steps(build(), cache, 4)
+        if result != (0, []) or (read('a.out'), read('b.out')) != ('ABC', '3'):
+            print('bad first run', result)
+            rv = 1
+        if [label for label in ran if label != 'copy'] != ['upper', 'count']:
+            print('conflicting steps out of order', ran)
+            rv = 1
+
+        del ran[:]
+        for name in ('a.out', 'b.out', 'c.out'):
+            os.unlink(path(name))
+        result = run_steps(build(), cache, 4)
+        if result != (3, []) or ran or (read('a.out'), read('b.out'),
+                                        read('c.out')) != ('ABC', '3', 'c'):
+            print('unchanged rerun missed the cache', result, ran)
+            rv = 1
+
+        write('a.txt', 'abcd')
+        result = run_steps(build(), cache, 4)
+        if result != (1, []) or sorted(ran) != ['count', 'upper'] or \
+                read('b.out') != '4':
+            print('edited input hit the cache', result, ran)
+            rv = 1
+
+        # like env-patch, patches in place: keyed by the unpatched file
+        del ran[:]
+        for _ in range(2):
+            write('p.js', 'env')
+            run_steps([stub('patch', ['p.js'], ['p.js'], lambda t: t + '!')],
+                      cache)
+        if ran != ['patch'] or read('p.js') != 'env!':
+            print('bad in-place step', ran, read('p.js'))
+            rv = 1
+
+        def fail():
+            raise smap_stream.Error('broken')
+        # nothing new starts after a failure, dependent on it or not
+        del ran[:]
+        steps = build() + [stub('again', ['c.out'], ['d.out'], str.upper)]
+        steps[0].run = fail
+        steps[2] = stub('copy', ['c.txt'], ['c.out'], lambda t: t, 0.2)
+        write('a.txt', 'xyz')
+        write('c.txt', 'cc')
+        hits, failures = run_steps(steps, cache, 4)
+        if [(step.label, str(e)) for step, e in failures] != [
+                ('upper', 'broken')] or ran != ['copy'] or read('b.out') != '4':
+            print('failure did not stop dependent steps', failures, ran)
+            rv = 1
+
+        write('q.js', 'if (process.env.NODE_ENV) {}')
+        write('r.js', 'plain')
+        steps = parse_step('env-patch production ' + shlex.quote(tmp))
+        if [(s.inputs, s.outputs) for s in steps] != [([path('q.js')],
+                                                       [path('q.js')])]:
+            print('bad env-patch steps', [s.label for s in steps])
+            rv = 1
+        for spec in ('frobnicate x', 'env-patch staging ' + tmp):
+            try:
+                parse_step(spec)
+                print('no error for', spec)
+                rv = 1
+            except ValueError:
+                pass
+
+        entries = [os.path.join(cache.top, prefix, key)
+                   for prefix in os.listdir(cache.top)
+                   for key in os.listdir(os.path.join(cache.top, prefix))]
+        old = time.time() - _max_age - 60
+        os.utime(entries[0], (old, old))
+        cache.prune()
+        if os.path.exists(entries[0]) or \
+                not all(os.path.exists(e) for e in entries[1:]):
+            print('bad prune')
+            rv = 1
+    finally:
+        shutil.rmtree(tmp)
+    print('test finished')
+    return rv
+
+def default_cache_dir():
+    return os.environ.get('DYGRAPHS_BUILD_CACHE',
+                          os.path.join(os.path.dirname(mydir), '.buildcache'))
+
+if __name__ == '__main__':
+    usage = "E: syntax: python3 buildsteps.py [--cache DIR] [--jobs N] 'tool arg ...' ...\n"
+    args = sys.argv[1:]
+    if args == ['--test']:
+        sys.exit(_selftest())
+    cache_dir = default_cache_dir()
+    jobs = None
+    while len(args) >= 2 and args[0] in ('--cache', '--jobs'):
+        if args[0] == '--cache':
+            cache_dir = args[1]
+        else:
+            jobs = int(args[1])
+        args = args[2:]
+    if not args:
+        sys.stderr.write(usage)
+        sys.exit(1)
+    try:
+        steps = [step for spec in args for step in parse_step(spec)]
+    except (ValueError, OSError) as e:
+        sys.stderr.write('E: %s\n%s' % (e, usage))
+        sys.exit(1)
+
+    cache = Cache(os.path.abspath(cache_dir)) if cache_dir else None
+    t0 = time.perf_counter()
+    hits, failures = run_steps(steps, cache, jobs)
+    for step, e in failures:
+        log('E: %s: %s' % (step.label, e))
+    if cache and not failures:
+        cache.prune()
+    log('I: %d steps, %d cached, %.2fs' % (len(steps), hits,
+        time.perf_counter() - t0))
+    sys.exit(1 if failures else 0)
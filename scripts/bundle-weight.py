@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+'''
+Attributes the bytes of the minified bundle to the original modules.
+
+Every byte of dygraph.min.js is assigned to the source of the source map
+segment covering it (bytes before the first segment of a line, and those
+of unmapped segments, count as "(unmapped)"); sources are grouped into
+modules such as src/plugins/legend.js or node_modules/<package>.
+
+Minified bytes add up to the file size. Compressed sizes cannot be split
+like that, so the gzip (level 9) and brotli (quality 11, needs the
+brotli module) figure of a module is its marginal cost: the compressed
+size of the whole bundle minus that of the bundle with the module's bytes
+cut out.
+
+Usage:
+
+  python3 bundle-weight.py [options] [dygraph.min.js [dygraph.min.js.map]]
+
+  --history FILE    append the results to this JSON file
+                    (default .bundle-weight.json; '' to not record)
+  --budget FILE     JSON {"module or total": {"min"|"gzip"|"br": bytes}}
+                    of upper limits
+  --max-growth PCT  fail if a module grew by more than PCT percent (and
+                    at least 64 bytes) in any metric since the last run
+                    recorded in the history
+  --json            print the results as JSON instead of a table
+
+The exit status is 1 if a budget or growth threshold was exceeded. The
+run is recorded anyway, marked as not ok, and growth is measured from the
+last run that was ok, so a regression keeps failing until it is fixed or
+the threshold is raised. scripts/clean.sh keeps the history, and the CI
+workflow carries it from one run to the next in the Actions cache.
+'''
+
+import argparse
+import gzip
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from sourcemap import SourceMap
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+UNMAPPED = '(unmapped)'
+_metrics = ('min', 'gzip', 'br')
+_min_growth = 64
+
+def module_of(source):
+    '''Returns the module a source path is accounted to.'''
+    path = source.replace('\\', '/')
+    m = re.search(r'(?:^|/)node_modules/((?:@[^/]+/)?[^/]+)', path)
+    if m:
+        return 'node_modules/' + m.group(1)
+    m = re.search(r'(?:^|/)(src|auto_tests)/(.*)$', path)
+    if m:
+        return '%s/%s' % (m.group(1), m.group(2))
+    return os.path.basename(path) or path
+
+def _line_offsets(line):
+    '''Returns a function from UTF-16 column to byte offset in line.'''
+    if line.isascii():
+        return lambda col: min(col, len(line))
+    offsets = [0]
+    for c in line:
+        n = len(c.encode('UTF-8'))
+        for _ in range(2 if ord(c) > 0xFFFF else 1):
+            offsets.append(offsets[-1] + n)
+    nbytes = offsets[-1]
+    return lambda col: offsets[col] if col < len(offsets) else nbytes
+
+def attribute(js, smap):
+    '''Splits the bytes of js (str) among modules.
+
+    Returns a dict mapping each module to a list of (start, end) byte
+    ranges, which together cover all of js exactly once.
+    '''
+    ranges = {}
+    index = smap.line_index()
+    gen_col = smap.gen_col
+    src = smap.src
+    modules = [module_of(s) for s in smap.sources]
+    pos = 0
+    for l, text in enumerate(js.splitlines(keepends=True)):
+        body = text.rstrip('\r\n')
+        offset = _line_offsets(body)
+        nbytes = len(text.encode('UTF-8'))
+        lo, hi = (index[l], index[l + 1]) if l + 1 < len(index) else (0, 0)
+        cuts = [(0, UNMAPPED)]
+        for i in range(lo, hi):
+            cuts.append((offset(gen_col[i]),
+                         modules[src[i]] if src[i] >= 0 else UNMAPPED))
+        cuts.append((nbytes, None))
+        for (start, module), (end, _) in zip(cuts, cuts[1:]):
+            if end <= start:
+                continue
+            spans = ranges.setdefault(module, [])
+            if spans and spans[-1][1] == pos + start:
+                spans[-1] = (spans[-1][0], pos + end)
+            else:
+                spans.append((pos + start, pos + end))
+        pos += nbytes
+    return ranges
+
+def _compressors():
+    fns = {'gzip': lambda b: len(gzip.compress(b, 9, mtime=0))}
+    if brotli is not None:
+        fns['br'] = lambda b: len(brotli.compress(b, quality=11))
+    return fns
+
+def weigh(js_path, map_path):
+    '''Returns {"total": {...}, "modules": {module: {metric: bytes}}}.'''
+    with open(js_path, 'rb') as f:
+        data = f.read()
+    smap = SourceMap.load(map_path)
+    ranges = attribute(data.decode('UTF-8'), smap)
+    compressors = _compressors()
+    total = {'min': len(data)}
+    for name, fn in compressors.items():
+        total[name] = fn(data)
+    modules = {}
+    for module, spans in ranges.items():
+        entry = {'min': sum(end - start for start, end in spans)}
+        rest = []
+        pos = 0
+        for start, end in spans:
+            rest.append(data[pos:start])
+            pos = end
+        rest.append(data[pos:])
+        rest = b''.join(rest)
+        for name, fn in compressors.items():
+            entry[name] = total[name] - fn(rest)
+        modules[module] = entry
+    return {'total': total, 'modules': modules}
+
+def check_budget(result, budget):
+    '''Yields a message for every limit in budget that result exceeds.'''
+    for module, limits in sorted(budget.items()):
+        entry = result['total'] if module == 'total' else \
+            result['modules'].get(module, {})
+        for metric, limit in sorted(limits.items()):
+            value = entry.get(metric)
+            if value is not None and value > limit:
+                yield '%s: %s %d bytes exceeds budget of %d' % (
+                    module, metric, value, limit)
+
+def check_growth(result, previous, pct):
+    '''Yields a message for every module that grew too much since previous.'''
+    for module, entry in sorted(result['modules'].items()):
+        old = previous['modules'].get(module)
+        if old is None:
+            continue
+        for metric in _metrics:
+            if metric not in entry or metric not in old:
+                continue
+            grown = entry[metric] - old[metric]
+            if grown >= _min_growth and grown > old[metric] * pct / 100.0:
+                yield '%s: %s grew from %d to %d bytes (+%.1f%%)' % (
+                    module, metric, old[metric], entry[metric],
+                    100.0 * grown / max(old[metric], 1))
+
+def _revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, check=True,
+                              text=True).stdout.strip() or None
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_history(path):
+    try:
+        with open(path, 'r', encoding='UTF-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+def save_history(path, history):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='UTF-8') as f:
+        json.dump(history, f, indent=1, sort_keys=True)
+        f.write('\n')
+    os.replace(tmp, path)
+
+def print_table(result, previous):
+    metrics = [m for m in _metrics if m in result['total']]
+    rows = sorted(result['modules'].items(), key=lambda kv: -kv[1]['min'])
+    width = max([len(m) for m, _ in rows] + [5])
+    header = '%-*s' % (width, 'module') + ''.join('%10s' % m for m in metrics)
+    if previous:
+        header += '  %s' % 'delta (min)'
+    print(header)
+    for module, entry in rows + [('total', result['total'])]:
+        line = '%-*s' % (width, module) + ''.join(
+            '%10d' % entry[m] for m in metrics)
+        if previous:
+            old = previous['total'] if module == 'total' else \
+                previous['modules'].get(module)
+            line += '  %+d' % (entry['min'] - old['min']) if old else '  new'
+        print(line)
+    if 'br' not in result['total']:
+        print('(brotli module not available, br not measured)')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Attribute dygraph.min.js bytes to source modules.')
+    parser.add_argument('js', nargs='?', default='dist/dygraph.min.js')
+    parser.add_argument('map', nargs='?')
+    parser.add_argument('--history', default='.bundle-weight.json')
+    parser.add_argument('--budget')
+    parser.add_argument('--max-growth', type=float)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    result = weigh(args.js, args.map or args.js + '.map')
+    history = load_history(args.history) if args.history else []
+    # runs failing a check are recorded, but not measured against
+    previous = next((entry for entry in reversed(history)
+                     if entry.get('ok', True)), None)
+
+    if args.json:
+        json.dump(result, sys.stdout, indent=1, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        print_table(result, previous)
+
+    failures = []
+    if args.budget:
+        with open(args.budget, 'r', encoding='UTF-8') as f:
+            failures.extend(check_budget(result, json.load(f)))
+    if args.max_growth is not None and previous:
+        failures.extend(check_growth(result, previous, args.max_growth))
+    for msg in failures:
+        sys.stderr.write('E: %s\n' % msg)
+
+    if args.history:
+        result['time'] = int(time.time())
+        result['revision'] = _revision()
+        result['ok'] = not failures
+        history.append(result)
+        save_history(args.history, history)
+    sys.exit(1 if failures else 0)
@@ -2,4 +2,4 @@
 set -ex
 cd "$(dirname "$0")/.."
 rm -rf disttmp
-git clean -dfx -e node_modules -e package-lock.json
+git clean -dfx -e node_modules -e package-lock.json -e .bundle-weight.json
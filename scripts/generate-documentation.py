@@ -1,13 +1,36 @@
 #!/usr/bin/env python3
 
 # Generate docs/options.html
-
+#
+# Usage: generate-documentation.py [--output FILE] [--cache FILE] [--jobs N]
+#
+# Option usages in tests/*.html and gallery/*.js are kept in a usage index
+# in the --cache file; only files whose mtime or size changed are rescanned,
+# in parallel when there are several. With --output, the page is only
+# rendered (and the file only written) when the index, the reference JSON
+# or this script changed.
+
+import argparse
+import concurrent.futures
+import contextlib
 import glob
+import hashlib
+import io
 import json
+import multiprocessing
 import os
 import re
 import sys
 
+parser = argparse.ArgumentParser()
+parser.add_argument('-o', '--output', metavar='FILE',
+    help='write to FILE instead of stdout')
+parser.add_argument('--cache', metavar='FILE', default='.options-usage.json',
+    help='usage index cache (default: %(default)s; empty to disable)')
+parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+    metavar='N', help='scan files in N processes (default: %(default)s)')
+args = parser.parse_args()
+
 # Set this to the path to a test file to get debug output for just that test
 # file. Can be helpful to figure out why a test is not being shown for a
 # particular option.
@@ -49,71 +72,228 @@ def encode_cb(match):
 def encode_anchor(name):
   return encode_re.sub(encode_cb, name)
 
+# Tokens looked for outside of {..} braces. Only braces matter there, but
+# comments are skipped so that braces in them do not count; a // preceded by
+# anything but whitespace is taken to be part of a URL in HTML text.
+_outer_re = re.compile(r'''
+    (?P<comment>/\*.*?(?:\*/|\Z)|(?:^|(?<=[\s;]))//[^\n]*)
+  | (?P<function>\bfunction\()
+  | (?P<open>\{)
+''', re.DOTALL | re.MULTILINE | re.VERBOSE)
+
+# Tokens looked for inside {..} braces. Strings are skipped as a whole;
+# unterminated ones end at the end of the line, so a stray quote (e.g. in
+# a regular expression literal) cannot swallow the rest of the file.
+_inner_re = re.compile(r'''
+    (?P<comment>/\*.*?(?:\*/|\Z)|//[^\n]*)
+  | (?P<string>"(?:[^"\\\n]|\\.)*"?|'(?:[^'\\\n]|\\.)*'?|`(?:[^`\\]|\\.)*`?)
+  | (?P<function>\bfunction\()
+  | (?P<option>\b[a-zA-Z0-9]+(?=\ *:))
+  | (?P<open>\{)
+  | (?P<close>\})
+''', re.DOTALL | re.MULTILINE | re.VERBOSE)
+
+_active_re = re.compile(r'//galleryActive=(true|false)$')
+
 # This is helpful for differentiating uses of options like 'width' and 'height'
 # from appearances of identically-named options in CSS.
-def find_braces(txt):
-  """Really primitive method to find text inside of {..} braces.
-  Doesn't work if there's an unmatched brace in a string, e.g. '{'. """
-  out = ''
+def scan_options(text, gallery=False):
+  """Single-pass scan for option usages inside {..} braces.
+
+  Yields (kind, value, start, end) tuples:
+    ('option', name, start, end) for text followed by a colon in braces,
+    ('block', None, start, end) for each outermost {..} region,
+    ('active', bool, start, end) for a //galleryActive= annotation.
+  For gallery files, only text after the first 'function(' (if any) is
+  considered, to skip past demo titles in the Gallery.register() attributes.
+  """
   level = 0
-  for char in txt:
-    if char == '{':
+  block_start = 0
+  seen_function = not gallery or 'function(' not in text
+  pos = 0
+  while True:
+    m = (_inner_re if level else _outer_re).search(text, pos)
+    if m is None:
+      break
+    pos = m.end()
+    kind = m.lastgroup
+    if kind == 'comment':
+      am = _active_re.match(m.group())
+      if am:
+        yield ('active', am.group(1) == 'true', m.start(), m.end())
+    elif kind == 'function':
+      if not seen_function:
+        seen_function = True
+        level = 0
+    elif not seen_function or kind == 'string':
+      continue
+    elif kind == 'option':
+      yield ('option', m.group(), m.start(), m.end())
+    elif kind == 'open':
+      if level == 0:
+        block_start = m.start()
       level += 1
-    if level >= 1:
-      out += char
-    if char == '}':
+    elif kind == 'close':
       level -= 1
-  return out
-
-ext_tests = []
-gallery_files = {}
+      if level == 0:
+        yield ('block', None, block_start, m.end())
+  if level and seen_function:
+    yield ('block', None, block_start, len(text))
+
+def debug_highlight(text, hits):
+  """Returns the braced parts of text with the option hits highlighted."""
+  out = ["\033[0m"]
+  blocks = [(start, end) for kind, _, start, end in hits if kind == 'block']
+  options = [(start, end) for kind, _, start, end in hits if kind == 'option']
+  i = 0
+  for start, end in blocks:
+    pos = start
+    while i < len(options) and options[i][0] < end:
+      ostart, oend = options[i]
+      colon = text.index(':', oend) + 1
+      out.append(text[pos:ostart])
+      out.append("\033[1;31m" + text[ostart:colon] + "\033[0m")
+      pos = colon
+      i += 1
+    out.append(text[pos:end])
+  return ''.join(out)
+
+def scan_file(job):
+  """Scans one test or gallery file and returns its usage index entry."""
+  test_file, type = job
+  with open(test_file, 'rb') as infile:
+    data = infile.read()
+  st = os.stat(test_file)
+  text = data.decode('UTF-8').replace('\r\n', '\n').replace('\r', '\n')
+  hits = list(scan_options(text, gallery=(type == "gallery")))
 
-def search_files(type, files):
   # Find text followed by a colon. These won't all be options, but those that
   # have the same name as a Dygraph option probably will be.
-  prop_re = re.compile(r'\b([a-zA-Z0-9]+) *:')
-  gf_re = re.compile(r'//galleryActive=(true|false)$', re.MULTILINE)
-  for test_file in files:
-    if os.path.isfile(test_file): # Basically skips directories
-      with open(test_file, 'rt',
-                encoding='UTF-8', errors='strict', newline=None) as infile:
-        text = infile.read()
-
-      if type == "tests":
-        if text.find("src=\"http") >= 0:
-          ext_tests.append(test_file)
-
-      # Hack for slipping past gallery demos that have title in their attributes
-      # so they don't appear as reasons for the demo to have 'title' options.
-      if type == "gallery":
-        ga = re.findall(gf_re, text)
-        if ga:
-          ga = ga[0] == "true"
-        else:
-          # not annotated
-          ga = None
-        gallery_files[test_file] = ga
-        idx = text.find("function(")
-        if idx >= 0:
-          text = text[idx:]
-      braced_html = find_braces(text)
-      if test_file in debug_tests:
-        print("\033[0m" + re.sub(prop_re, lambda m: "\033[1;31m" + m.group(0) + "\033[0m", braced_html))
-        print("\033[1;34m==================================================================\033[0m")
-
-      ms = re.findall(prop_re, braced_html)
-      if test_file in debug_tests:
-        print('\n'.join(sorted(set(ms))))
-      for opt in ms:
-        if opt in docs and test_file not in docs[opt][type]:
-          docs[opt][type].append(test_file)
-
-search_files("tests", glob.glob("tests/*.html"))
-search_files("gallery", glob.glob("gallery/*.js")) #TODO add grep "Gallery.register\("
+  ms = [value for kind, value, _, _ in hits if kind == 'option']
+  entry = {
+    'type': type,
+    'stamp': [st.st_mtime_ns, st.st_size],
+    'sha1': hashlib.sha1(data).hexdigest(),
+    'options': sorted(set(ms)),
+  }
+
+  if type == "tests":
+    entry['ext'] = text.find("src=\"http") >= 0
+
+  # Hack for slipping past gallery demos that have title in their attributes
+  # so they don't appear as reasons for the demo to have 'title' options.
+  if type == "gallery":
+    ga = [value for kind, value, _, _ in hits if kind == 'active']
+    if ga:
+      ga = ga[0]
+    else:
+      # not annotated
+      ga = None
+    entry['active'] = ga
+
+  if test_file in debug_tests:
+    print(debug_highlight(text, hits))
+    print("\033[1;34m==================================================================\033[0m")
+    print('\n'.join(entry['options']))
+  return test_file, entry
+
+def update_index(index, files, jobs):
+  """Rescans those of files whose mtime or size differs from the index.
+
+  Returns the new index and whether anything was rescanned.
+  """
+  fresh = {}
+  todo = []
+  for test_file, type in files:
+    if not os.path.isfile(test_file): # Basically skips directories
+      continue
+    st = os.stat(test_file)
+    entry = index.get(test_file)
+    if (entry is not None and entry['type'] == type and
+        entry['stamp'] == [st.st_mtime_ns, st.st_size] and
+        test_file not in debug_tests):
+      fresh[test_file] = entry
+    else:
+      todo.append((test_file, type))
+  # workers must be forked: this script does its work at the top level
+  if (jobs > 1 and len(todo) > 1 and not debug_tests and
+      'fork' in multiprocessing.get_all_start_methods()):
+    with concurrent.futures.ProcessPoolExecutor(jobs,
+        mp_context=multiprocessing.get_context('fork')) as pool:
+      results = list(pool.map(scan_file, todo, chunksize=4))
+  else:
+    results = [scan_file(job) for job in todo]
+  fresh.update(results)
+  return fresh, bool(todo) or len(fresh) != len(index)
+
+def load_cache(path):
+  try:
+    with open(path, 'rt', encoding='UTF-8') as f:
+      cache = json.load(f)
+  except (OSError, ValueError):
+    return {}
+  if cache.get('version') != cache_version:
+    return {}
+  return cache
+
+def save_cache(path, cache):
+  cache['version'] = cache_version
+  with open(path + '.tmp', 'wt', encoding='UTF-8') as f:
+    json.dump(cache, f, ensure_ascii=False, sort_keys=True)
+  os.replace(path + '.tmp', path)
+
+cache_version = 1
+cache = load_cache(args.cache) if args.cache else {}
+files = ([(f, "tests") for f in sorted(glob.glob("tests/*.html"))] +
+    [(f, "gallery") for f in sorted(glob.glob("gallery/*.js"))]) #TODO add grep "Gallery.register\("
+index, rescanned = update_index(cache.get('index', {}), files, args.jobs)
 
 if debug_tests:
   sys.exit(0)
 
+# The page only depends on the reference JSON, the index and this script.
+key = hashlib.sha1()
+with open(__file__, 'rb') as f:
+  key.update(f.read())
+for part in js:
+  key.update(part.encode('UTF-8'))
+for test_file in sorted(index):
+  entry = dict(index[test_file])
+  del entry['stamp']
+  key.update(json.dumps([test_file, entry], sort_keys=True).encode('UTF-8'))
+key = key.hexdigest()
+
+def write_output(html):
+  """Writes html to the --output file, unless it already has that content."""
+  try:
+    with open(args.output, 'rt', encoding='UTF-8', newline='') as f:
+      if f.read() == html:
+        return
+  except OSError:
+    pass
+  with open(args.output, 'wt', encoding='UTF-8', newline='') as f:
+    f.write(html)
+
+if args.output and cache.get('key') == key and 'html' in cache:
+  if rescanned and args.cache:
+    cache['index'] = index
+    save_cache(args.cache, cache)
+  write_output(cache['html'])
+  sys.exit(0)
+
+ext_tests = []
+gallery_files = {}
+for test_file in sorted(index):
+  entry = index[test_file]
+  type = entry['type']
+  if type == "tests" and entry['ext']:
+    ext_tests.append(test_file)
+  if type == "gallery":
+    gallery_files[test_file] = entry['active']
+  for opt in entry['options']:
+    if opt in docs:
+      docs[opt][type].append(test_file)
+
 # Extract a labels list.
 labels = []
 for _, opt in docs.items():
@@ -126,7 +306,9 @@ for label in labels:
 for label in cats:
   assert label in labels, "unused label: " + label
 
-print("""
+def render():
+  """Prints options.html to stdout."""
+  print("""
 <!--#set var="pagetitle" value="options reference" -->
 <!--#include virtual="header.html" -->
 
@@ -143,11 +325,11 @@ print("""
 <ul class='nav'>
   <li><a href="#usage">Usage</a>
 """.strip())
-for label in sorted(labels):
-  print('  <li><a href="#%s">%s</a>' % (encode_anchor(label), label))
-print('</ul></div></div>')
+  for label in sorted(labels):
+    print('  <li><a href="#%s">%s</a>' % (encode_anchor(label), label))
+  print('</ul></div></div>')
 
-print("""
+  print("""
 <div id='content' class='col-lg-9'>
 <h2>Options Reference</h2>
 <p>Dygraphs tries to do a good job of displaying your data
@@ -188,69 +370,69 @@ print("""
 <p>And, without further ado, here's the complete list of options:</p>
 """)
 
-def test_name(f):
-  """Takes 'tests/demo.html' -> 'demo'"""
-  return f.replace('tests/', '').replace('.html', '')
+  def test_name(f):
+    """Takes 'tests/demo.html' -> 'demo'"""
+    return f.replace('tests/', '').replace('.html', '')
 
-def gallery_name(f):
-  """Takes 'gallery/demo.js' -> 'demo'"""
-  return f.replace('gallery/', '').replace('.js', '')
+  def gallery_name(f):
+    """Takes 'gallery/demo.js' -> 'demo'"""
+    return f.replace('gallery/', '').replace('.js', '')
 
-def urlify_gallery(f):
-  """Takes 'gallery/demo.js' -> 'demo'"""
-  return f.replace('gallery/', 'gallery/#g/').replace('.js', '')
+  def urlify_gallery(f):
+    """Takes 'gallery/demo.js' -> 'demo'"""
+    return f.replace('gallery/', 'gallery/#g/').replace('.js', '')
 
-def test_fmt(f):
-  res = '<a href="%s">%s</a>' % (f, test_name(f))
-  if f in ext_tests:
-    res += '<b class="extlink" title="WARNING: accesses external resources (Google jsapi)">⚠</b>'
-  return res
+  def test_fmt(f):
+    res = '<a href="%s">%s</a>' % (f, test_name(f))
+    if f in ext_tests:
+      res += '<b class="extlink" title="WARNING: accesses external resources (Google jsapi)">⚠</b>'
+    return res
 
-def gallery_fmt(f):
-  if gallery_files[f]:
-    res = '<a href="%s">%s</a>' % (urlify_gallery(f), gallery_name(f))
-  else:
-    res = '<font color="#9999FF" title="inactive">%s</font>' % gallery_name(f)
-  return res
-
-for label in sorted(labels):
-  print('<a name="%s"></a><h3>%s</h3>' % (encode_anchor(label), label))
-  if cats[label]:
-    print('<p>%s</p>' % cats[label])
-
-  for opt_name in sorted(docs.keys()):
-    opt = docs[opt_name]
-    if label not in opt['labels']: continue
-    tests = opt['tests']
-    if not tests:
-      examples_html = '<font color=red>NONE</font>'
+  def gallery_fmt(f):
+    if gallery_files[f]:
+      res = '<a href="%s">%s</a>' % (urlify_gallery(f), gallery_name(f))
     else:
-      examples_html = '; '.join(test_fmt(f) for f in sorted(tests, key=test_name))
+      res = '<font color="#9999FF" title="inactive">%s</font>' % gallery_name(f)
+    return res
+
+  for label in sorted(labels):
+    print('<a name="%s"></a><h3>%s</h3>' % (encode_anchor(label), label))
+    if cats[label]:
+      print('<p>%s</p>' % cats[label])
+
+    for opt_name in sorted(docs.keys()):
+      opt = docs[opt_name]
+      if label not in opt['labels']: continue
+      tests = opt['tests']
+      if not tests:
+        examples_html = '<font color=red>NONE</font>'
+      else:
+        examples_html = '; '.join(test_fmt(f) for f in sorted(tests, key=test_name))
 
-    gallery = opt['gallery']
-    if not gallery:
-      gallery_html = '<font color=red>NONE</font>'
-    else:
-      gallery_html = '; '.join(gallery_fmt(f) for f in sorted(gallery, key=gallery_name))
+      gallery = opt['gallery']
+      if not gallery:
+        gallery_html = '<font color=red>NONE</font>'
+      else:
+        gallery_html = '; '.join(gallery_fmt(f) for f in sorted(gallery, key=gallery_name))
 
-    if 'parameters' in opt:
-      parameters = opt['parameters']
-      type_want = 'function(%s)' % ', '.join(p[0] for p in parameters)
-      if opt['type'] == type_want:
-        pass
+      if 'parameters' in opt:
+        parameters = opt['parameters']
+        type_want = 'function(%s)' % ', '.join(p[0] for p in parameters)
+        if opt['type'] == type_want:
+          pass
+        else:
+          assert opt['type'].startswith(type_want + ' → '), \
+           "%s type does not match %s" % (opt_name, type_want)
+        parameters_html = '\n'.join("<tr><th>%s:</th><td>%s</td></tr>" % (p[0], p[1]) for p in parameters)
+        parameters_html = "\n  </p><div class='parameters'><table>\n%s\n  </table></div><p>" % (parameters_html);
       else:
-        assert opt['type'].startswith(type_want + ' → '), \
-         "%s type does not match %s" % (opt_name, type_want)
-      parameters_html = '\n'.join("<tr><th>%s:</th><td>%s</td></tr>" % (p[0], p[1]) for p in parameters)
-      parameters_html = "\n  </p><div class='parameters'><table>\n%s\n  </table></div><p>" % (parameters_html);
-    else:
-      parameters_html = ''
+        parameters_html = ''
 
-    if not opt['type']: opt['type'] = '(missing)'
-    if not opt['default']: opt['default'] = '(missing)'
-    if not opt['description']: opt['description'] = '(missing)'
+      if not opt['type']: opt['type'] = '(missing)'
+      if not opt['default']: opt['default'] = '(missing)'
+      if not opt['description']: opt['description'] = '(missing)'
 
-    print("""
+      print("""
   <div class='option'><p>
   <a name="%(namenc)s"></a><b>%(name)s</b>
   <a class="link" href="#%(namenc)s">#</a>
@@ -264,15 +446,15 @@ for label in sorted(labels):
   <tr><th>Other Examples:</th><td>%(examples_html)s</td></tr>
   </table></div>
   """.rstrip() % { 'name': opt_name,
-          'namenc': encode_anchor(opt_name),
-          'type': opt['type'],
-          'parameters': parameters_html,
-          'default': opt['default'],
-          'desc': opt['description'],
-          'examples_html': examples_html,
-          'gallery_html': gallery_html})
-
-print("""
+            'namenc': encode_anchor(opt_name),
+            'type': opt['type'],
+            'parameters': parameters_html,
+            'default': opt['default'],
+            'desc': opt['description'],
+            'examples_html': examples_html,
+            'gallery_html': gallery_html})
+
+  print("""
 <a name="point_properties"></a><h3>Point Properties</h3>
 Some callbacks take a point argument. Its properties are:<br />
 <ul>
@@ -285,5 +467,17 @@ Some callbacks take a point argument. Its properties are:<br />
 
 <!--#include virtual="footer.html" -->""")
 
+out = io.StringIO()
+with contextlib.redirect_stdout(out):
+  render()
+html = out.getvalue()
+if args.cache:
+  cache.update(index=index, key=key, html=html)
+  save_cache(args.cache, cache)
+if args.output:
+  write_output(html)
+else:
+  sys.stdout.write(html)
+
 # This page was super-helpful:
 # https://beautifier.io/
@@ -56,6 +56,7 @@ srcfiles+=\ src/plugins/chart-labels.js
 srcfiles+=\ src/plugins/grid.js
 #srcfiles+=\ src/plugins/legend.js
 #srcfiles+=\ src/plugins/range-selector.js
+#srcfiles+=\ src/extras/columnar.js
 #srcfiles+=\ src/extras/crosshair.js
 #srcfiles+=\ src/extras/hairlines.js
 #srcfiles+=\ src/extras/rebase.js
@@ -5,45 +5,62 @@ import base64
 import json
 import sys
 
+import smap_stream
+
 _b64leader = 'sourceMappingURL=data:application/json;charset=UTF-8;base64,'
 _linefmt = '//# %s%s\n'
 
-if len(sys.argv) == 4:
-    donl = True
-elif len(sys.argv) == 5 and sys.argv[4] == '--nonl':
-    # evil hack for browserify
-    donl = False
-else:
-    sys.stderr.write('E: syntax: python3 smap-in.py in.js in.map out.js\n')
-    sys.exit(1)
-
-with open(sys.argv[1], 'r') as f:
-    lines = f.readlines()
-
-if lines[-1].startswith('//# sourceMappingURL='):
-    lines.pop()
-elif lines[-1].startswith('/*# sourceMappingURL='):
-    _linefmt = '/*# %s%s */\n'
-    lines.pop()
-
-with open(sys.argv[2], 'r') as f:
-    smap = json.load(f)
-
-# clear "file" key as it’s inappropriate for embedded maps
-smap.pop('file', None)
-
-smap = json.dumps(smap, ensure_ascii=False, allow_nan=False,
-  indent=None, separators=(',', ':'))
-smap = base64.b64encode(smap.encode('UTF-8')).decode('UTF-8')
-
-while lines[-1] == '\n':
-    lines.pop()
-if not lines[-1].endswith('\n'):
-    lines.append('\n')
-if not donl:
-    # evil hack for browserify
-    _linefmt = _linefmt.rstrip('\n')
-lines.append(_linefmt % (_b64leader, smap))
-
-with open(sys.argv[3], 'w') as f:
-    f.writelines(lines)
+def embed(in_js, in_map, out_js, donl=True):
+    '''Writes in_js to out_js with in_map embedded as a data: URL.'''
+    linefmt = _linefmt
+    with open(in_js, 'r') as f:
+        lines = f.readlines()
+
+    if lines and lines[-1].startswith('//# sourceMappingURL='):
+        lines.pop()
+    elif lines and lines[-1].startswith('/*# sourceMappingURL='):
+        linefmt = '/*# %s%s */\n'
+        lines.pop()
+
+    with open(in_map, 'r') as f:
+        smap = json.load(f)
+
+    # clear "file" key as it’s inappropriate for embedded maps
+    smap.pop('file', None)
+
+    smap = json.dumps(smap, ensure_ascii=False, allow_nan=False,
+      indent=None, separators=(',', ':'))
+    smap = base64.b64encode(smap.encode('UTF-8')).decode('UTF-8')
+
+    while lines and lines[-1] == '\n':
+        lines.pop()
+    if lines and not lines[-1].endswith('\n'):
+        lines.append('\n')
+    if not donl:
+        # evil hack for browserify
+        linefmt = linefmt.rstrip('\n')
+    lines.append(linefmt % (_b64leader, smap))
+
+    with open(out_js, 'w') as f:
+        f.writelines(lines)
+
+def main(argv):
+    stream = len(argv) > 1 and argv[1] == '--stream'
+    if stream:
+        argv = argv[:1] + argv[2:]
+
+    if len(argv) == 4:
+        donl = True
+    elif len(argv) == 5 and argv[4] == '--nonl':
+        # evil hack for browserify
+        donl = False
+    else:
+        sys.stderr.write('E: syntax: python3 smap-in.py [--stream] in.js in.map out.js\n')
+        return 1
+
+    # --stream uses constant memory
+    (smap_stream.embed if stream else embed)(argv[1], argv[2], argv[3], donl)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -6,13 +6,15 @@ import json
 import re
 import sys
 
+import smap_stream
+
 _linefmt = '//# %s%s\n'
 _smap = re.compile('^(?://# |(?P<iscss>/\\*# ))sourceMappingURL=data:application/json(?:;charset[=:](?i:iso-ir-6|ANSI_X3\\.4-19[68][86]|ISO_646\\.irv:1991|ISO646-US|(?:US-|cs)?ASCII|us|(?:IBM|cp)367|(?:cs)?utf-?8))?;base64,(?P<b64>(?:[A-Za-z0-9+/]{4})*(?:[A-Za-z0-9+/]{2}[A-Za-z0-9+/=]=)?)(?(iscss) \\*/)\n?$', re.ASCII)
 
-if len(sys.argv) == 2 and sys.argv[1] == '--test':
+def _selftest():
     rv = 0
     def t(s, css=False):
-        global rv
+        nonlocal rv
         m = _smap.match(s)
         if m is None:
             print('no match', s)
@@ -24,7 +26,7 @@ if len(sys.argv) == 2 and sys.argv[1] == '--test':
             rv = 1
         print('got b64', m.group('b64'))
     def f(s):
-        global rv
+        nonlocal rv
         if _smap.match(s) is not None:
             print('bogus match', s)
             rv = 1
@@ -56,48 +58,68 @@ if len(sys.argv) == 2 and sys.argv[1] == '--test':
     f('//# sourceMappingURL=data:application/json;charset:ascii;base64,foo-')
     f('//# sourceMappingURL=data:application/json;base64,Zm9vYmFy\r\n')
     print('test finished')
-    sys.exit(rv)
-
-if len(sys.argv) == 4:
-    smapname = sys.argv[3]
-elif len(sys.argv) == 5:
-    smapname = sys.argv[4]
-else:
-    sys.stderr.write('E: syntax: python3 smap-out.py in.js out.js out.map [maplink]\n')
-    sys.exit(1)
-
-with open(sys.argv[1], 'r') as f:
-    lines = f.readlines()
-
-if lines[-1].find('sourceMappingURL=') == -1:
-    sys.stderr.write('E: file does not contain a source map\n')
-    sys.exit(1)
-
-smap = _smap.match(lines[-1])
-if smap is None:
-    sys.stderr.write('E: incomprehensible source map\n')
-    sys.exit(1)
-
-lines.pop()
-if smap.group('iscss') is not None:
-    _linefmt = '/*# %s%s */\n'
-smap = smap.group('b64')
-smap = base64.b64decode(smap.rstrip('\n'), validate=True).decode('UTF-8')
-smap = json.loads(smap)
-
-# clear "file" key as browserify writes the wrong one and it’s optional anyway
-smap.pop('file', None)
-
-with open(sys.argv[3], 'w') as f:
-    json.dump(smap, f, ensure_ascii=False, allow_nan=False,
-      indent=2, separators=(',', ': '))
-    f.write('\n')
-
-while lines[-1] == '\n':
+    return rv
+
+def extract(in_js, out_js, out_map, maplink):
+    '''Moves the inline source map of in_js into out_map (indented).'''
+    linefmt = _linefmt
+    with open(in_js, 'r') as f:
+        lines = f.readlines()
+
+    if not lines or lines[-1].find('sourceMappingURL=') == -1:
+        raise smap_stream.Error('file does not contain a source map')
+
+    smap = _smap.match(lines[-1])
+    if smap is None:
+        raise smap_stream.Error('incomprehensible source map')
+
     lines.pop()
-if not lines[-1].endswith('\n'):
-    lines.append('\n')
-lines.append(_linefmt % ('sourceMappingURL=', smapname))
+    if smap.group('iscss') is not None:
+        linefmt = '/*# %s%s */\n'
+    smap = smap.group('b64')
+    smap = base64.b64decode(smap.rstrip('\n'), validate=True).decode('UTF-8')
+    smap = json.loads(smap)
+
+    # clear "file" key as browserify writes the wrong one and it’s optional anyway
+    smap.pop('file', None)
+
+    with open(out_map, 'w') as f:
+        json.dump(smap, f, ensure_ascii=False, allow_nan=False,
+          indent=2, separators=(',', ': '))
+        f.write('\n')
+
+    while lines and lines[-1] == '\n':
+        lines.pop()
+    if lines and not lines[-1].endswith('\n'):
+        lines.append('\n')
+    lines.append(linefmt % ('sourceMappingURL=', maplink))
+
+    with open(out_js, 'w') as f:
+        f.writelines(lines)
+
+def main(argv):
+    if len(argv) == 2 and argv[1] == '--test':
+        return _selftest()
+
+    stream = len(argv) > 1 and argv[1] == '--stream'
+    if stream:
+        argv = argv[:1] + argv[2:]
+
+    if len(argv) == 4:
+        smapname = argv[3]
+    elif len(argv) == 5:
+        smapname = argv[4]
+    else:
+        sys.stderr.write('E: syntax: python3 smap-out.py [--stream] in.js out.js out.map [maplink]\n')
+        return 1
+
+    # --stream uses constant memory; the map is written compact instead of indented
+    try:
+        (smap_stream.extract if stream else extract)(argv[1], argv[2], argv[3], smapname)
+    except smap_stream.Error as e:
+        sys.stderr.write('E: %s\n' % e)
+        return 1
+    return 0
 
-with open(sys.argv[2], 'w') as f:
-    f.writelines(lines)
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
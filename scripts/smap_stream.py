@@ -0,0 +1,387 @@
+'''
+Constant-memory source map extraction and embedding, used by the --stream
+modes of smap-out.py and smap-in.py.
+
+The sourceMappingURL line is located by seeking backwards from the end of
+the file, the JS body is copied with copy_file_range(2) or sendfile(2),
+and the base64 payload is decoded resp. encoded in fixed-size chunks. The
+map JSON is passed through a streaming filter that drops the "file" key
+and all insignificant whitespace, so peak memory no longer scales with the
+bundle or map size. Unlike the slurping modes, the map is not re-indented.
+
+  python3 smap_stream.py --test
+
+compares the streaming modes with the slurping ones of smap-out.py and
+smap-in.py.
+'''
+
+import base64
+import binascii
+import codecs
+import json
+import os
+import re
+import sys
+
+_chunk = 1 << 20
+_b64leader = 'sourceMappingURL=data:application/json;charset=UTF-8;base64,'
+_header = re.compile(b'(?://# |(?P<iscss>/\\*# ))sourceMappingURL=data:application/json(?:;charset[=:](?i:iso-ir-6|ANSI_X3\\.4-19[68][86]|ISO_646\\.irv:1991|ISO646-US|(?:US-|cs)?ASCII|us|(?:IBM|cp)367|(?:cs)?utf-?8))?;base64,')
+
+class Error(Exception):
+    pass
+
+def last_line(f, size):
+    '''Returns (start, end) of the last line of f, excluding its newline.'''
+    end = size
+    if end > 0:
+        f.seek(end - 1)
+        if f.read(1) == b'\n':
+            end -= 1
+    pos = end
+    while pos > 0:
+        step = min(_chunk, pos)
+        f.seek(pos - step)
+        block = f.read(step)
+        nl = block.rfind(b'\n')
+        if nl != -1:
+            return pos - step + nl + 1, end
+        pos -= step
+    return 0, end
+
+def body_end(f, end):
+    '''Returns end with trailing empty lines before it dropped.'''
+    while end >= 2:
+        f.seek(end - 2)
+        if f.read(2) != b'\n\n':
+            break
+        end -= 1
+    return end
+
+def copy_range(src, dst, count):
+    '''Copies count bytes from the start of file src to file dst.'''
+    ifd = src.fileno()
+    ofd = dst.fileno()
+    dst.flush()
+    offset = 0
+    for how in ('copy_file_range', 'sendfile'):
+        fn = getattr(os, how, None)
+        if fn is None:
+            continue
+        try:
+            while offset < count:
+                if how == 'sendfile':
+                    n = fn(ofd, ifd, offset, count - offset)
+                else:
+                    n = fn(ifd, ofd, count - offset, offset)
+                if n == 0:
+                    break
+                offset += n
+            if offset == count:
+                return
+        except OSError:
+            pass
+    src.seek(offset)
+    while offset < count:
+        block = src.read(min(_chunk, count - offset))
+        if not block:
+            raise Error('short read')
+        os.write(ofd, block)
+        offset += len(block)
+
+class MapFilter(object):
+    '''Streaming JSON filter for a source map object.
+
+    Removes the top-level members named in drop and all whitespace outside
+    of strings. Feed it str chunks of any size.
+    '''
+
+    _instr = re.compile(r'["\\]')
+    _outstr = re.compile(r'[\s"{}\[\],]')
+
+    def __init__(self, drop=('file',)):
+        self.drop = drop
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.expect_key = False
+        self.key = None
+        self.skipping = False
+        self.members = 0
+        self.opened = False
+
+    def _emit(self, out, s):
+        if self.key is not None:
+            self.key.append(s)
+        elif not self.skipping:
+            out.append(s)
+
+    def _end_key(self, out):
+        key = ''.join(self.key)
+        self.key = None
+        if json.loads(key) in self.drop:
+            self.skipping = True
+            return
+        if self.members:
+            out.append(',')
+        out.append(key)
+        self.members += 1
+
+    def feed(self, s):
+        out = []
+        i = 0
+        n = len(s)
+        while i < n:
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                    self._emit(out, s[i])
+                    i += 1
+                    continue
+                m = self._instr.search(s, i)
+                if m is None:
+                    self._emit(out, s[i:])
+                    break
+                j = m.start()
+                self._emit(out, s[i:j + 1])
+                i = j + 1
+                if s[j] == '\\':
+                    self.escape = True
+                else:
+                    self.in_string = False
+                    if self.key is not None:
+                        self._end_key(out)
+                continue
+            m = self._outstr.search(s, i)
+            if m is None:
+                self._emit(out, s[i:])
+                break
+            j = m.start()
+            self._emit(out, s[i:j])
+            c = s[j]
+            i = j + 1
+            if c.isspace():
+                continue
+            if c == '"':
+                self.in_string = True
+                if self.depth == 1 and self.expect_key:
+                    self.expect_key = False
+                    self.key = [c]
+                else:
+                    self._emit(out, c)
+            elif c == '{' or c == '[':
+                self.depth += 1
+                if self.depth == 1:
+                    if c != '{' or self.opened:
+                        raise Error('source map is not a JSON object')
+                    self.opened = True
+                    self.expect_key = True
+                self._emit(out, c)
+            elif c == '}' or c == ']':
+                if self.depth == 1:
+                    self.skipping = False
+                self.depth -= 1
+                self._emit(out, c)
+            elif self.depth == 1:
+                # comma between members, emitted before the next kept key
+                self.skipping = False
+                self.expect_key = True
+            else:
+                self._emit(out, c)
+        return ''.join(out)
+
+    def finish(self):
+        if not self.opened or self.depth or self.in_string:
+            raise Error('source map is not a JSON object')
+
+def extract(in_js, out_js, out_map, maplink):
+    '''Moves the inline source map of in_js into out_map.
+
+    out_js gets the JS body followed by a sourceMappingURL line pointing
+    to maplink.
+    '''
+    with open(in_js, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        start, end = last_line(f, size)
+        f.seek(start)
+        head = f.read(min(end - start, 1024))
+        if head.find(b'sourceMappingURL=') == -1:
+            raise Error('file does not contain a source map')
+        m = _header.match(head)
+        if m is None:
+            raise Error('incomprehensible source map')
+        linefmt = '//# %s%s\n'
+        b64end = end
+        if m.group('iscss') is not None:
+            linefmt = '/*# %s%s */\n'
+            f.seek(end - 3)
+            if end - 3 < start + m.end() or f.read(3) != b' */':
+                raise Error('incomprehensible source map')
+            b64end -= 3
+        pos = start + m.end()
+        if (b64end - pos) % 4:
+            raise Error('incomprehensible source map')
+
+        decoder = codecs.getincrementaldecoder('UTF-8')()
+        mapfilter = MapFilter()
+        f.seek(pos)
+        with open(out_map, 'wb') as mf:
+            while pos < b64end:
+                block = f.read(min(_chunk, b64end - pos))
+                pos += len(block)
+                if pos < b64end and b'=' in block:
+                    raise Error('incomprehensible source map')
+                try:
+                    data = base64.b64decode(block, validate=True)
+                except binascii.Error:
+                    raise Error('incomprehensible source map')
+                mf.write(mapfilter.feed(decoder.decode(data)).encode('UTF-8'))
+            mf.write(mapfilter.feed(decoder.decode(b'', True)).encode('UTF-8'))
+            mapfilter.finish()
+            mf.write(b'\n')
+
+        bend = body_end(f, start)
+        with open(out_js, 'wb') as of:
+            copy_range(f, of, bend)
+            of.seek(0, os.SEEK_END)
+            if bend and not _ends_with_newline(f, bend):
+                of.write(b'\n')
+            of.write((linefmt % ('sourceMappingURL=', maplink)).encode('UTF-8'))
+
+def _ends_with_newline(f, end):
+    f.seek(end - 1)
+    return f.read(1) == b'\n'
+
+def embed(in_js, in_map, out_js, donl=True):
+    '''Writes in_js to out_js with in_map embedded as a data: URL.
+
+    An existing trailing sourceMappingURL line in in_js is replaced.
+    '''
+    linefmt = '//# %s%s\n'
+    with open(in_js, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        start, end = last_line(f, size)
+        f.seek(start)
+        head = f.read(min(end - start, 32))
+        if head.startswith(b'//# sourceMappingURL='):
+            bend = start
+        elif head.startswith(b'/*# sourceMappingURL='):
+            linefmt = '/*# %s%s */\n'
+            bend = start
+        else:
+            bend = size
+        bend = body_end(f, bend)
+        if not donl:
+            # evil hack for browserify
+            linefmt = linefmt.rstrip('\n')
+        prefix, suffix = linefmt.split('%s%s')
+
+        with open(out_js, 'wb') as of:
+            copy_range(f, of, bend)
+            of.seek(0, os.SEEK_END)
+            if bend and not _ends_with_newline(f, bend):
+                of.write(b'\n')
+            of.write((prefix + _b64leader).encode('UTF-8'))
+            mapfilter = MapFilter()
+            pending = b''
+            with open(in_map, 'r', encoding='UTF-8') as mf:
+                while True:
+                    block = mf.read(_chunk)
+                    if not block:
+                        break
+                    pending += mapfilter.feed(block).encode('UTF-8')
+                    cut = len(pending) - len(pending) % 3
+                    of.write(base64.b64encode(pending[:cut]))
+                    pending = pending[cut:]
+            mapfilter.finish()
+            of.write(base64.b64encode(pending))
+            of.write(suffix.encode('UTF-8'))
+
+def _selftest():
+    global _chunk
+    import importlib.util
+    import shutil
+    import tempfile
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    def load(name):
+        spec = importlib.util.spec_from_file_location(name.replace('-', '_'),
+            os.path.join(here, name + '.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    smap_out = load('smap-out')
+    smap_in = load('smap-in')
+
+    rv = 0
+    tmp = tempfile.mkdtemp()
+    def path(name):
+        return os.path.join(tmp, name)
+    def read(name):
+        with open(path(name), 'rb') as f:
+            return f.read()
+    def write(name, data):
+        with open(path(name), 'wb') as f:
+            f.write(data.encode('UTF-8'))
+
+    smap = {'version': 3, 'file': 'wrong.min.js',
+            'sources': ['src/"quoted".js', 'C:\\src\\back\\slash.js',
+                        'src/ünïcødé/π.js'],
+            'sourcesContent': ['var s = "\\"\\\\";\n' * 40 + '€ 𝄞\n', None,
+                               'x' * 300],
+            'names': ['é', 'x'], 'mappings': 'AAAA,CAAC;' * 100}
+    kept = dict(smap)
+    del kept['file']
+    compact = json.dumps(kept, ensure_ascii=False, separators=(',', ':'))
+    bodies = {
+        'js': 'var a = "//# sourceMappingURL=";\n\n\n',
+        'css': 'a { content: "é" }\n/*# sourceMappingURL=old.css.map */\n',
+    }
+    saved = _chunk
+    try:
+        # a small chunk size splits escapes, UTF-8 sequences and base64 quads
+        for _chunk in (saved, 16):
+            for kind, body in sorted(bodies.items()):
+                for ascii in (False, True):
+                    what = '%s, chunk %d%s' % (kind, _chunk,
+                                               ', escaped' if ascii else '')
+                    write('in.js', body)
+                    write('in.map', json.dumps(smap, ensure_ascii=ascii,
+                                               indent=2))
+                    smap_in.embed(path('in.js'), path('in.map'),
+                                  path('slurped.js'))
+                    embed(path('in.js'), path('in.map'), path('streamed.js'))
+                    slurped = read('slurped.js')
+                    streamed = read('streamed.js')
+                    if not ascii and streamed != slurped:
+                        print('embed differs:', what)
+                        rv = 1
+                    # escapes are kept as they are, the same JSON either way
+                    line = streamed.rsplit(b'\n', 2)[-2]
+                    if (kind == 'css') != line.startswith(b'/*# ') or \
+                            json.loads(base64.b64decode(line.split(b',')[1]
+                            .split(b' ')[0]).decode('UTF-8')) != kept:
+                        print('embedded map differs:', what)
+                        rv = 1
+
+                    smap_out.extract(path('slurped.js'), path('slurped.out'),
+                                     path('slurped.map'), 'x.map')
+                    extract(path('slurped.js'), path('streamed.out'),
+                            path('streamed.map'), 'x.map')
+                    if read('streamed.out') != read('slurped.out'):
+                        print('extracted JS differs:', what)
+                        rv = 1
+                    if read('streamed.map').decode('UTF-8') != compact + '\n' \
+                            or json.loads(read('slurped.map')) != kept:
+                        print('extracted map differs:', what)
+                        rv = 1
+    finally:
+        _chunk = saved
+        shutil.rmtree(tmp)
+    print('test finished')
+    return rv
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--test']:
+        sys.exit(_selftest())
+    sys.stderr.write('E: syntax: python3 smap_stream.py --test\n')
+    sys.exit(1)
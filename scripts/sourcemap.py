@@ -0,0 +1,483 @@
+#!/usr/bin/python3
+'''
+Source map (revision 3) handling for the build scripts.
+
+SourceMap keeps the decoded mappings in six parallel compact arrays, one
+entry per segment, sorted by generated position, plus the index of the
+first segment of every generated line, so lookups are a bisection within
+one line. It can rewrite source paths and compose two maps (A→B plus B→C
+gives A→C), which covers the jq | perl path fixup of build-js.sh.
+
+Usage:
+
+  python3 sourcemap.py absolutise in.map out.map
+  python3 sourcemap.py compose inner.map outer.map out.map
+  python3 sourcemap.py --test [file.map ...]
+  python3 sourcemap.py --benchmark file.map ...
+
+absolutise turns sources consisting of a ../ chain that climbs up to the
+root directory into absolute paths, as seen from the current directory.
+compose writes the map from the sources of inner.map to the file generated
+by outer.map, whose sources must be the file inner.map describes.
+--test checks VLQ round-trips and decode/encode parity on a built-in map
+and on the given maps (default: dist/*.map, warning if there are none),
+--benchmark prints decode and encode speed.
+'''
+
+import array
+import bisect
+import json
+import os
+import sys
+
+_b64chars = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+_b64digit = [-1] * 256
+for _i, _c in enumerate(_b64chars):
+    _b64digit[_c] = _i
+_SEMI = ord(';')
+_COMMA = ord(',')
+
+class Error(Exception):
+    pass
+
+def encode_vlq(value, out):
+    '''Appends the base64 VLQ encoding of the integer value to bytearray out.'''
+    value = ((-value) << 1) | 1 if value < 0 else value << 1
+    while True:
+        digit = value & 31
+        value >>= 5
+        if value:
+            out.append(_b64chars[digit | 32])
+        else:
+            out.append(_b64chars[digit])
+            return
+
+def decode_vlq(s):
+    '''Decodes a string of base64 VLQ values into a list of integers.'''
+    out = []
+    value = shift = 0
+    for c in s.encode('ascii'):
+        digit = _b64digit[c]
+        if digit < 0:
+            raise Error('bad VLQ digit %r' % chr(c))
+        value += (digit & 31) << shift
+        if digit & 32:
+            shift += 5
+        else:
+            out.append(-(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    if shift:
+        raise Error('truncated VLQ value')
+    return out
+
+class SourceMap(object):
+    '''A decoded source map.
+
+    Segment i generates line gen_line[i], column gen_col[i]; when src[i] is
+    not -1 it comes from sources[src[i]] at orig_line[i], orig_col[i], with
+    name names[name[i]] unless name[i] is -1. Lines and columns are 0-based.
+    '''
+
+    def __init__(self, sources=None, names=None, sources_content=None):
+        self.sources = list(sources or [])
+        self.names = list(names or [])
+        self.sources_content = sources_content
+        self.extra = {}
+        self.gen_line = array.array('i')
+        self.gen_col = array.array('i')
+        self.src = array.array('i')
+        self.orig_line = array.array('i')
+        self.orig_col = array.array('i')
+        self.name = array.array('i')
+        self._nlines = 0
+        self._line_index = None
+
+    def __len__(self):
+        return len(self.gen_col)
+
+    @classmethod
+    def from_json(cls, obj):
+        if obj.get('version') != 3:
+            raise Error('unsupported source map version %r' % obj.get('version'))
+        if 'sections' in obj:
+            raise Error('indexed source maps are not supported')
+        smap = cls(obj.get('sources', []), obj.get('names', []),
+                   obj.get('sourcesContent'))
+        smap.extra = {k: v for k, v in obj.items() if k not in (
+            'version', 'sources', 'names', 'sourcesContent', 'mappings')}
+        smap.decode(obj.get('mappings', ''))
+        return smap
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='UTF-8') as f:
+            return cls.from_json(json.load(f))
+
+    def to_json(self):
+        obj = {'version': 3}
+        obj.update(self.extra)
+        obj['sources'] = self.sources
+        obj['names'] = self.names
+        obj['mappings'] = self.encode()
+        if self.sources_content is not None:
+            obj['sourcesContent'] = self.sources_content
+        return obj
+
+    def save(self, path, indent=None):
+        with open(path, 'w', encoding='UTF-8') as f:
+            if indent is None:
+                json.dump(self.to_json(), f, ensure_ascii=False,
+                          allow_nan=False, separators=(',', ':'))
+            else:
+                json.dump(self.to_json(), f, ensure_ascii=False,
+                          allow_nan=False, indent=indent,
+                          separators=(',', ': '))
+            f.write('\n')
+
+    def decode(self, mappings):
+        '''Decodes a "mappings" string into the (empty) segment arrays.'''
+        gen_line = self.gen_line
+        gen_col = self.gen_col
+        src = self.src
+        orig_line = self.orig_line
+        orig_col = self.orig_col
+        name = self.name
+        digit_of = _b64digit
+        line = col = s = oline = ocol = n = 0
+        fields = []
+        value = shift = 0
+        data = mappings.encode('ascii')
+        for c in data + b';':
+            if c == _SEMI or c == _COMMA:
+                if shift:
+                    raise Error('truncated VLQ value')
+                nf = len(fields)
+                if nf:
+                    col += fields[0]
+                    gen_line.append(line)
+                    gen_col.append(col)
+                    if nf == 1:
+                        src.append(-1)
+                        orig_line.append(0)
+                        orig_col.append(0)
+                        name.append(-1)
+                    elif nf == 4 or nf == 5:
+                        s += fields[1]
+                        oline += fields[2]
+                        ocol += fields[3]
+                        src.append(s)
+                        orig_line.append(oline)
+                        orig_col.append(ocol)
+                        if nf == 5:
+                            n += fields[4]
+                            name.append(n)
+                        else:
+                            name.append(-1)
+                    else:
+                        raise Error('segment with %d fields' % nf)
+                    fields = []
+                if c == _SEMI:
+                    line += 1
+                    col = 0
+                continue
+            digit = digit_of[c]
+            if digit < 0:
+                raise Error('bad VLQ digit %r' % chr(c))
+            value += (digit & 31) << shift
+            if digit & 32:
+                shift += 5
+            else:
+                fields.append(-(value >> 1) if value & 1 else value >> 1)
+                value = shift = 0
+        # the appended ';' counted one line too many
+        self._nlines = line - 1 if data else 0
+        self._line_index = None
+
+    def encode(self):
+        '''Returns the "mappings" string for the current segments.'''
+        out = bytearray()
+        enc = encode_vlq
+        line = 0
+        col = s = oline = ocol = n = 0
+        first = True
+        for i in range(len(self.gen_col)):
+            gl = self.gen_line[i]
+            if gl != line:
+                out.extend(b';' * (gl - line))
+                line = gl
+                col = 0
+                first = True
+            if not first:
+                out.append(_COMMA)
+            first = False
+            c = self.gen_col[i]
+            enc(c - col, out)
+            col = c
+            si = self.src[i]
+            if si < 0:
+                continue
+            enc(si - s, out)
+            s = si
+            v = self.orig_line[i]
+            enc(v - oline, out)
+            oline = v
+            v = self.orig_col[i]
+            enc(v - ocol, out)
+            ocol = v
+            ni = self.name[i]
+            if ni >= 0:
+                enc(ni - n, out)
+                n = ni
+        nlines = self._nlines
+        if nlines > line:
+            out.extend(b';' * (nlines - line))
+        return out.decode('ascii')
+
+    def append(self, gen_line, gen_col, src=-1, orig_line=0, orig_col=0,
+               name=-1):
+        '''Adds a segment; segments must be added in generated order.'''
+        self.gen_line.append(gen_line)
+        self.gen_col.append(gen_col)
+        self.src.append(src)
+        self.orig_line.append(orig_line)
+        self.orig_col.append(orig_col)
+        self.name.append(name)
+        self._nlines = max(self._nlines, gen_line)
+        self._line_index = None
+
+    def line_index(self):
+        '''Returns an array whose entry l is the first segment of line l.
+
+        It has one more entry than there are lines, so that segments of
+        line l are line_index[l]:line_index[l + 1].
+        '''
+        if self._line_index is None:
+            nlines = (self.gen_line[-1] + 1) if len(self.gen_line) else 0
+            index = array.array('i', [0]) * (nlines + 1)
+            i = 0
+            gen_line = self.gen_line
+            total = len(gen_line)
+            for l in range(nlines + 1):
+                while i < total and gen_line[i] < l:
+                    i += 1
+                index[l] = i
+            self._line_index = index
+        return self._line_index
+
+    def lookup(self, line, col):
+        '''Returns the index of the segment covering line, col or -1.'''
+        index = self.line_index()
+        if line < 0 or line + 1 >= len(index):
+            return -1
+        lo = index[line]
+        hi = index[line + 1]
+        i = bisect.bisect_right(self.gen_col, col, lo, hi) - 1
+        return i if i >= lo else -1
+
+    def original(self, line, col):
+        '''Returns (source, line, col, name) for a generated position.
+
+        Any of them is None where unknown; source is None when the position
+        is not mapped at all.
+        '''
+        i = self.lookup(line, col)
+        if i < 0 or self.src[i] < 0:
+            return None, None, None, None
+        n = self.name[i]
+        return (self.sources[self.src[i]], self.orig_line[i],
+                self.orig_col[i], self.names[n] if n >= 0 else None)
+
+    _index_fields = ('gen_col', 'src', 'orig_line', 'orig_col', 'name')
+
+    def save_index(self, f, key=''):
+        '''Writes the lookup structures to the binary file f.
+
+        They can be read back with load_index() much faster than the
+        mappings can be decoded; key is stored to validate them later.
+        '''
+        header = json.dumps({
+            'key': key,
+            'sources': self.sources,
+            'names': self.names,
+            'nsegments': len(self.gen_col),
+            'nlines': len(self.line_index()),
+            'itemsize': self.gen_col.itemsize,
+        }, ensure_ascii=False).encode('UTF-8')
+        f.write(header + b'\n')
+        self.line_index().tofile(f)
+        for field in self._index_fields:
+            getattr(self, field).tofile(f)
+
+    @classmethod
+    def load_index(cls, f, key=''):
+        '''Reads what save_index() wrote; returns None if key differs.
+
+        The result supports lookup() and original() only.
+        '''
+        header = json.loads(f.readline().decode('UTF-8'))
+        if header['key'] != key or header['itemsize'] != array.array('i').itemsize:
+            return None
+        smap = cls(header['sources'], header['names'])
+        index = array.array('i')
+        index.fromfile(f, header['nlines'])
+        smap._line_index = index
+        for field in cls._index_fields:
+            getattr(smap, field).fromfile(f, header['nsegments'])
+        return smap
+
+    def rewrite_sources(self, fn):
+        '''Replaces every source path p with fn(p).'''
+        self.sources = [fn(p) for p in self.sources]
+
+    def absolutise_sources(self, base='.'):
+        '''Makes sources that are a ../ chain up to the root absolute.'''
+        def fn(p):
+            up = 0
+            while p.startswith('../', up * 3):
+                up += 1
+            if up and os.path.realpath(os.path.join(base, '../' * up)) == '/':
+                return '/' + p[up * 3:]
+            return p
+        self.rewrite_sources(fn)
+
+    def compose(self, inner):
+        '''Returns the map from the sources of inner to self's output.
+
+        self maps its output back to the file that inner describes, so that
+        the result maps self's output straight to inner's sources. Segments
+        falling on unmapped positions of inner become unmapped.
+        '''
+        result = SourceMap(inner.sources, [], inner.sources_content)
+        result.extra = dict(self.extra)
+        names = {}
+        def name_index(s):
+            if s not in names:
+                names[s] = len(result.names)
+                result.names.append(s)
+            return names[s]
+        for i in range(len(self.gen_col)):
+            gl = self.gen_line[i]
+            gc = self.gen_col[i]
+            if self.src[i] < 0:
+                result.append(gl, gc)
+                continue
+            j = inner.lookup(self.orig_line[i], self.orig_col[i])
+            if j < 0 or inner.src[j] < 0:
+                result.append(gl, gc)
+                continue
+            n = inner.name[j]
+            if n >= 0:
+                n = name_index(inner.names[n])
+            elif self.name[i] >= 0:
+                n = name_index(self.names[self.name[i]])
+            result.append(gl, gc, inner.src[j], inner.orig_line[j],
+                          inner.orig_col[j], n)
+        result._nlines = self._nlines
+        return result
+
+def _selftest(paths):
+    import glob
+    rv = 0
+    for v in (0, 1, -1, 15, 16, -16, 1023, -1024, 123456789, -987654321):
+        out = bytearray()
+        encode_vlq(v, out)
+        if decode_vlq(out.decode('ascii')) != [v]:
+            print('VLQ round trip failed for', v)
+            rv = 1
+    m = SourceMap.from_json({'version': 3, 'sources': ['a.js'],
+                             'names': ['x'], 'mappings': 'AAAA,CAACA;;EAAE'})
+    if (list(m.gen_line), list(m.gen_col), list(m.name)) != (
+            [0, 0, 2], [0, 1, 2], [-1, 0, -1]):
+        print('bad decode of AAAA,CAACA;;EAAE')
+        rv = 1
+    if m.original(2, 5) != ('a.js', 0, 3, None) or m.lookup(1, 0) != -1:
+        print('bad lookup')
+        rv = 1
+    # B is 'a.js' shifted one column right; C swaps the two lines of B
+    a2b = SourceMap.from_json({'version': 3, 'sources': ['a.js'],
+                               'names': [], 'mappings': 'CAAA;CACA'})
+    b2c = SourceMap.from_json({'version': 3, 'sources': ['b.js'],
+                               'names': [], 'mappings': 'AACC;AADA'})
+    a2c = b2c.compose(a2b)
+    if a2c.original(0, 0) != ('a.js', 1, 0, None) or \
+            a2c.original(1, 0) != ('a.js', 0, 0, None):
+        print('bad composition', a2c.to_json())
+        rv = 1
+    import io
+    buf = io.BytesIO()
+    m.save_index(buf, 'k')
+    buf.seek(0)
+    m2 = SourceMap.load_index(buf, 'k')
+    if m2 is None or m2.original(2, 5) != m.original(2, 5) or \
+            m2.original(0, 1) != ('a.js', 0, 1, 'x'):
+        print('bad index round trip')
+        rv = 1
+    buf.seek(0)
+    if SourceMap.load_index(buf, 'other') is not None:
+        print('stale index accepted')
+        rv = 1
+    # decode/encode parity on a map with every kind of segment: 1, 4 and
+    # 5 fields, empty lines and negative deltas, decoded by hand
+    fixture = {'version': 3, 'sources': ['a.js', 'b.js'],
+               'names': ['x', 'y', 'z'],
+               'mappings': 'AAAA,SAASA,GAAGC,K;;AACZ,IAAIC;ACDJ,MAAMF;;;;EDGN'}
+    smap = SourceMap.from_json(fixture)
+    if list(zip(smap.gen_line, smap.gen_col, smap.src, smap.orig_line,
+                smap.orig_col, smap.name)) != [
+            (0, 0, 0, 0, 0, -1), (0, 9, 0, 0, 9, 0), (0, 12, 0, 0, 12, 1),
+            (0, 17, -1, 0, 0, -1), (2, 0, 0, 1, 0, -1), (2, 4, 0, 1, 4, 2),
+            (3, 0, 1, 0, 0, -1), (3, 6, 1, 0, 6, 0), (7, 2, 0, 3, 0, -1)]:
+        print('bad decode of the built-in map')
+        rv = 1
+    if smap.encode() != fixture['mappings']:
+        print('round trip mismatch: the built-in map')
+        rv = 1
+    if not paths:
+        paths = sorted(glob.glob('dist/*.map'))
+        if not paths:
+            print('warning: no dist/*.map; only the built-in map was '
+                  'round-tripped (run after a build, or name maps)')
+    for path in paths:
+        with open(path, 'r', encoding='UTF-8') as f:
+            obj = json.load(f)
+        smap = SourceMap.from_json(obj)
+        if smap.encode() != obj['mappings']:
+            print('round trip mismatch:', path)
+            rv = 1
+        else:
+            print('round trip ok: %s (%d mappings)' % (path, len(smap)))
+    print('test finished')
+    return rv
+
+def _benchmark(paths):
+    import time
+    for path in paths:
+        with open(path, 'r', encoding='UTF-8') as f:
+            mappings = json.load(f)['mappings']
+        t0 = time.perf_counter()
+        smap = SourceMap()
+        smap.decode(mappings)
+        t1 = time.perf_counter()
+        smap.encode()
+        t2 = time.perf_counter()
+        print('%s: %d mappings, decode %.0f/s, encode %.0f/s' % (
+            path, len(smap), len(smap) / (t1 - t0), len(smap) / (t2 - t1)))
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args and args[0] == '--test':
+        sys.exit(_selftest(args[1:]))
+    if len(args) >= 2 and args[0] == '--benchmark':
+        _benchmark(args[1:])
+    elif len(args) == 3 and args[0] == 'absolutise':
+        smap = SourceMap.load(args[1])
+        smap.absolutise_sources()
+        smap.save(args[2], indent=2)
+    elif len(args) == 4 and args[0] == 'compose':
+        SourceMap.load(args[2]).compose(SourceMap.load(args[1])).save(args[3])
+    else:
+        sys.stderr.write('E: syntax: python3 sourcemap.py absolutise in.map out.map\n'
+                         '   or: python3 sourcemap.py compose inner.map outer.map out.map\n'
+                         '   or: python3 sourcemap.py --test [file.map ...]\n'
+                         '   or: python3 sourcemap.py --benchmark file.map ...\n')
+        sys.exit(1)
@@ -0,0 +1,340 @@
+#!/usr/bin/python3
+'''
+Maps stack frames of the minified bundle back to the src/*.js sources.
+
+The source map (normally dist/dygraph.min.js.map) is decoded once into the
+compact, bisectable arrays of sourcemap.SourceMap. The decoded index is
+cached on disk, keyed by the map's path, modification time and size, so
+later runs skip the VLQ decoding altogether.
+
+Usage:
+
+  python3 symbolicate.py [--cache-dir DIR] [--bundle NAME] map [trace ...]
+  python3 symbolicate.py [--cache-dir DIR] --json map < frames.json
+  python3 symbolicate.py [--cache-dir DIR] --serve PORT map
+  python3 symbolicate.py [--cache-dir DIR] --benchmark N map
+  python3 symbolicate.py --test
+
+By default, the stack traces in the given files (or on stdin) are copied
+to stdout with every bundle:LINE:COLUMN location (bundle defaults to
+dygraph.min.js) followed by the original source location and name.
+Lines and columns are 1-based on input and output, as in browser stack
+traces.
+
+--json reads a JSON list of [line, column] pairs and writes a list with
+one {"source", "line", "column", "name"} object (or null, where the
+position is not mapped) per frame.
+
+--serve answers POST requests on 127.0.0.1:PORT: a JSON body is handled
+as with --json, anything else as a stack trace. The map is reloaded when
+it changes.
+
+--benchmark symbolicates N random frames and prints the rates, along with
+the cold and cached load times.
+
+--test checks frames, traces and the index cache against a built-in map.
+
+The cache lives in $XDG_CACHE_HOME/dygraphs (default ~/.cache/dygraphs);
+--cache-dir '' disables it.
+'''
+
+import hashlib
+import http.server
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from sourcemap import SourceMap
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'dygraphs')
+
+def _key(path, st):
+    return '%s %d %d' % (path, st.st_mtime_ns, st.st_size)
+
+def load_map(path, cache_dir=None):
+    '''Returns the SourceMap for path, using the on-disk index if fresh.'''
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    key = _key(path, st)
+    if not cache_dir:
+        return SourceMap.load(path)
+    name = hashlib.sha1(path.encode('UTF-8')).hexdigest()[:16] + '.smidx'
+    cache = os.path.join(cache_dir, name)
+    try:
+        with open(cache, 'rb') as f:
+            smap = SourceMap.load_index(f, key)
+        if smap is not None:
+            return smap
+    except (OSError, ValueError, EOFError, KeyError):
+        pass
+    smap = SourceMap.load(path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = '%s.%d.tmp' % (cache, os.getpid())
+        with open(tmp, 'wb') as f:
+            smap.save_index(f, key)
+        os.replace(tmp, cache)
+    except OSError as e:
+        sys.stderr.write('W: cannot write %s: %s\n' % (cache, e))
+    return smap
+
+class Symbolicator(object):
+    '''Symbolicates frames against one source map file.'''
+
+    def __init__(self, path, cache_dir=None):
+        self.path = path
+        self.cache_dir = cache_dir
+        self._stamp = None
+        self._smap = None
+        self._lock = threading.Lock()
+
+    def smap(self):
+        '''Returns the SourceMap, reloading it if the file changed.'''
+        st = os.stat(self.path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp != self._stamp:
+            with self._lock:
+                if stamp != self._stamp:
+                    self._smap = load_map(self.path, self.cache_dir)
+                    self._stamp = stamp
+        return self._smap
+
+    def frames(self, frames):
+        '''Maps (line, column) pairs, both 1-based, to original positions.
+
+        Returns one (source, line, column, name) tuple, or None, per frame.
+        '''
+        smap = self.smap()
+        lookup = smap.lookup
+        src = smap.src
+        orig_line = smap.orig_line
+        orig_col = smap.orig_col
+        name = smap.name
+        sources = smap.sources
+        names = smap.names
+        out = []
+        for line, col in frames:
+            i = lookup(line - 1, col - 1)
+            if i < 0 or src[i] < 0:
+                out.append(None)
+                continue
+            n = name[i]
+            out.append((sources[src[i]], orig_line[i] + 1, orig_col[i] + 1,
+                        names[n] if n >= 0 else None))
+        return out
+
+    def trace(self, text, bundle='dygraph.min.js'):
+        '''Annotates every bundle:LINE:COLUMN location in text.'''
+        location = re.compile(r'[^\s()@]*%s:(\d+):(\d+)' % re.escape(bundle))
+        matches = list(location.finditer(text))
+        results = self.frames((int(m.group(1)), int(m.group(2)))
+                              for m in matches)
+        out = []
+        pos = 0
+        for m, result in zip(matches, results):
+            out.append(text[pos:m.end()])
+            pos = m.end()
+            if result is not None:
+                out.append(' [%s]' % format_frame(result))
+        out.append(text[pos:])
+        return ''.join(out)
+
+def format_frame(result):
+    source, line, col, name = result
+    if name is None:
+        return '%s:%d:%d' % (source, line, col)
+    return '%s:%d:%d %s' % (source, line, col, name)
+
+def frames_to_json(results):
+    return [None if r is None else
+            {'source': r[0], 'line': r[1], 'column': r[2], 'name': r[3]}
+            for r in results]
+
+def _parse_frames(obj):
+    if isinstance(obj, dict):
+        obj = obj.get('frames')
+    if not isinstance(obj, list):
+        raise ValueError('expected a list of [line, column] pairs')
+    return [(int(line), int(col)) for line, col in obj]
+
+class SymbolicateHandler(http.server.BaseHTTPRequestHandler):
+    symbolicator = None
+    bundle = 'dygraph.min.js'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('UTF-8', 'replace')
+        ctype = self.headers.get('Content-Type', '')
+        try:
+            if ctype.startswith('application/json'):
+                results = self.symbolicator.frames(_parse_frames(json.loads(body)))
+                out = json.dumps(frames_to_json(results)).encode('UTF-8')
+            else:
+                ctype = 'text/plain; charset=UTF-8'
+                out = self.symbolicator.trace(body, self.bundle).encode('UTF-8')
+        except (ValueError, TypeError) as e:
+            self.send_error(400, str(e))
+            return
+        except OSError as e:
+            self.send_error(500, str(e))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+def benchmark(symbolicator, n):
+    t0 = time.perf_counter()
+    smap = SourceMap.load(symbolicator.path)
+    t1 = time.perf_counter()
+    symbolicator.smap()
+    t2 = time.perf_counter()
+    load_map(symbolicator.path, symbolicator.cache_dir)
+    t3 = time.perf_counter()
+    print('%s: %d mappings, decode %.3fs, cache %s %.3fs' % (
+        symbolicator.path, len(smap), t1 - t0,
+        'load' if symbolicator.cache_dir else 'disabled, decode',
+        t3 - t2))
+    index = smap.line_index()
+    nlines = len(index) - 1
+    rng = random.Random(0)
+    frames = []
+    for _ in range(n):
+        line = rng.randrange(nlines) if nlines else 0
+        lo, hi = (index[line], index[line + 1]) if nlines else (0, 0)
+        maxcol = smap.gen_col[hi - 1] + 10 if hi > lo else 100
+        frames.append((line + 1, rng.randrange(maxcol) + 1))
+    t0 = time.perf_counter()
+    results = symbolicator.frames(frames)
+    t1 = time.perf_counter()
+    for (line, col), result in zip(frames, results):
+        expected = smap.original(line - 1, col - 1)
+        got = (None, None, None, None) if result is None else \
+            (result[0], result[1] - 1, result[2] - 1, result[3])
+        assert got == expected, ((line, col), got, expected)
+    print('%d frames: %.0f frames/s, results match the uncached map' % (
+        n, n / (t1 - t0)))
+
+def _selftest():
+    import shutil
+    import tempfile
+    rv = 0
+    tmp = tempfile.mkdtemp(prefix='symbolicate-test.')
+    try:
+        # the built-in map of sourcemap.py's own --test
+        path = os.path.join(tmp, 'dygraph.min.js.map')
+        with open(path, 'w') as f:
+            json.dump({'version': 3, 'sources': ['a.js', 'b.js'],
+                       'names': ['x', 'y', 'z'],
+                       'mappings': 'AAAA,SAASA,GAAGC,K;;AACZ,IAAIC;ACDJ,MAAMF;;;;EDGN'},
+                      f)
+        cache_dir = os.path.join(tmp, 'cache')
+        expected = [('a.js', 1, 10, 'x'), None, None, ('a.js', 2, 1, None),
+                    ('b.js', 1, 7, 'x')]
+        frames = [(1, 10), (1, 18), (2, 1), (3, 3), (4, 7)]
+        for run in ('cold', 'cached'):
+            got = Symbolicator(path, cache_dir).frames(frames)
+            if got != expected:
+                print('bad %s frames' % run, got)
+                rv = 1
+            if not os.listdir(cache_dir):
+                print('no index cached')
+                rv = 1
+        text = ('Error: x\n    at f (http://h/dygraph.min.js:4:7)\n'
+                '    at g (dygraph.min.js:1:18)\n    at other.js:4:7\n')
+        got = Symbolicator(path).trace(text)
+        if got != text.replace(':4:7)', ':4:7 [b.js:1:7 x])', 1):
+            print('bad trace', repr(got))
+            rv = 1
+        if frames_to_json(expected[:2]) != [
+                {'source': 'a.js', 'line': 1, 'column': 10, 'name': 'x'},
+                None]:
+            print('bad json frames')
+            rv = 1
+        if _parse_frames({'frames': [[4, 7]]}) != [(4, 7)]:
+            print('bad frames object')
+            rv = 1
+        for bad in ({}, [['a', 1]], [[1, 2, 3]], [4]):
+            try:
+                _parse_frames(bad)
+                print('no error for', bad)
+                rv = 1
+            except (ValueError, TypeError):
+                pass
+    finally:
+        shutil.rmtree(tmp)
+    print('test finished')
+    return rv
+
+if __name__ == '__main__':
+    usage = ('E: syntax: python3 symbolicate.py [--cache-dir DIR] [--bundle NAME] map [trace ...]\n'
+             '   or: python3 symbolicate.py [--cache-dir DIR] --json map < frames.json\n'
+             '   or: python3 symbolicate.py [--cache-dir DIR] --serve PORT map\n'
+             '   or: python3 symbolicate.py [--cache-dir DIR] --benchmark N map\n'
+             '   or: python3 symbolicate.py --test\n')
+    args = sys.argv[1:]
+    if args == ['--test']:
+        sys.exit(_selftest())
+    cache_dir = default_cache_dir()
+    bundle = 'dygraph.min.js'
+    mode = None
+    arg = None
+    while args and args[0].startswith('--'):
+        if args[0] == '--json':
+            mode = 'json'
+            args = args[1:]
+            continue
+        if len(args) < 2:
+            break
+        if args[0] == '--cache-dir':
+            cache_dir = args[1]
+        elif args[0] == '--bundle':
+            bundle = args[1]
+        elif args[0] in ('--serve', '--benchmark'):
+            mode = args[0][2:]
+            arg = int(args[1])
+        else:
+            break
+        args = args[2:]
+    if not args or args[0].startswith('--') or (mode and len(args) != 1):
+        sys.stderr.write(usage)
+        sys.exit(1)
+    symbolicator = Symbolicator(args[0], cache_dir)
+
+    if mode == 'json':
+        try:
+            frames = _parse_frames(json.load(sys.stdin))
+        except (ValueError, TypeError) as e:
+            sys.stderr.write('E: bad frames: %s\n' % e)
+            sys.exit(1)
+        results = symbolicator.frames(frames)
+        json.dump(frames_to_json(results), sys.stdout, indent=1)
+        sys.stdout.write('\n')
+    elif mode == 'serve':
+        symbolicator.smap()
+        SymbolicateHandler.symbolicator = symbolicator
+        SymbolicateHandler.bundle = bundle
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', arg),
+                                                 SymbolicateHandler)
+        sys.stderr.write('I: symbolicating on http://127.0.0.1:%d/\n' % arg)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    elif mode == 'benchmark':
+        benchmark(symbolicator, arg)
+    else:
+        traces = args[1:]
+        if not traces:
+            sys.stdout.write(symbolicator.trace(sys.stdin.read(), bundle))
+        for trace in traces:
+            with open(trace, 'r', encoding='UTF-8') as f:
+                sys.stdout.write(symbolicator.trace(f.read(), bundle))
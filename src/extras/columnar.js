@@ -0,0 +1,159 @@
+/**
+ * @license
+ * Part of dygraphs, see top-level LICENSE.txt file
+ * MIT-licenced: https://opensource.org/license/MIT
+ */
+
+/**
+ * Loader for the binary columnar format the data endpoints of
+ * docs/ssi_server.py send (see docs/columnar.py for the layout).
+ *
+ * Usage:
+ *
+ *   Dygraph.Columnar.fetch('/__data?file=big.csv&points=2000',
+ *       function(result) {
+ *     g = new Dygraph(div, result.data, result.options);
+ *   });
+ *
+ * or, with an ArrayBuffer from elsewhere:
+ *
+ *   var result = Dygraph.Columnar.decode(buffer);
+ *   g.updateOptions(Object.assign({file: result.data}, result.options));
+ *
+ * result.data is in the native array format, result.options has the labels
+ * and the errorBars, customBars or fractions option the data needs.
+ * Dygraph.Columnar.columns(buffer) gives the columns themselves, as
+ * Float64Array views on the buffer, without building any rows.
+ */
+
+/* loader wrapper to allow browser use and ES6 imports */
+(function _extras_columnar_closure() {
+'use strict';
+var Dygraph;
+if (window.Dygraph) {
+  Dygraph = window.Dygraph;
+} else if (typeof(module) !== 'undefined') {
+  Dygraph = require('../dygraph');
+  if (typeof(Dygraph.NAME) === 'undefined' && typeof(Dygraph.default) !== 'undefined')
+    Dygraph = Dygraph.default;
+}
+/* end of loader wrapper header */
+
+var MIME_TYPE = 'application/vnd.dygraphs.columns';
+var MAGIC = 'DYCOLS\0\x01';
+
+// index of the central value of a point, by layout
+var CENTER = { plain: 0, errorBars: 0, customBars: 1, fractions: 0 };
+
+/**
+ * Parses the header and wraps the columns of an encoded buffer.
+ * @param {ArrayBuffer} buffer
+ * @return {{header: Object, x: Float64Array, columns: Array.<Float64Array>}}
+ */
+var columns = function columns(buffer) {
+  var bytes = new Uint8Array(buffer, 0, Math.min(buffer.byteLength, 12));
+  for (var i = 0; i < MAGIC.length; i++) {
+    if (bytes[i] !== MAGIC.charCodeAt(i)) {
+      throw new Error('Dygraph.Columnar: not columnar data');
+    }
+  }
+  var size = new DataView(buffer).getUint32(MAGIC.length, true);
+  var text = '';
+  var raw = new Uint8Array(buffer, MAGIC.length + 4, size);
+  for (i = 0; i < raw.length; i += 8192) {
+    text += String.fromCharCode.apply(null, raw.subarray(i, i + 8192));
+  }
+  var header = JSON.parse(decodeURIComponent(escape(text)));
+  var n = header.nrows;
+
+  var x;
+  if (header.x.type === 'delta-i32') {
+    var deltas = new Int32Array(buffer, header.x.offset, n);
+    x = new Float64Array(n);
+    var v = header.x.base;
+    for (i = 0; i < n; i++) {
+      v += deltas[i];
+      x[i] = v;
+    }
+  } else {
+    x = new Float64Array(buffer, header.x.offset, n);
+  }
+  var cols = [];
+  for (i = 0; i < header.columns.length; i++) {
+    cols.push(new Float64Array(buffer, header.columns[i], n));
+  }
+  return { header: header, x: x, columns: cols };
+};
+
+/**
+ * Decodes a buffer into Dygraph's native array format.
+ * @param {ArrayBuffer} buffer
+ * @return {{data: Array, options: Object}}
+ */
+var decode = function decode(buffer) {
+  var c = columns(buffer);
+  var header = c.header, x = c.x, cols = c.columns;
+  var n = header.nrows, width = header.width;
+  var nseries = header.labels.length - 1;
+  var center = CENTER[header.layout];
+  var data = new Array(n);
+  for (var i = 0; i < n; i++) {
+    var row = new Array(nseries + 1);
+    row[0] = header.is_date ? new Date(x[i]) : x[i];
+    for (var j = 0; j < nseries; j++) {
+      var v = cols[j * width + center][i];
+      if (width === 1) {
+        row[j + 1] = v !== v ? null : v;
+      } else if (v !== v) {
+        row[j + 1] = null;
+      } else {
+        var point = new Array(width);
+        for (var k = 0; k < width; k++) {
+          var w = cols[j * width + k][i];
+          point[k] = w !== w ? null : w;
+        }
+        row[j + 1] = point;
+      }
+    }
+    data[i] = row;
+  }
+  var options = { labels: header.labels };
+  if (header.layout !== 'plain') options[header.layout] = true;
+  return { data: data, options: options };
+};
+
+/**
+ * Requests url with the columnar format and calls callback with the
+ * result of decode(), or with null and the XMLHttpRequest on failure.
+ * @param {string} url
+ * @param {function(Object, XMLHttpRequest=)} callback
+ */
+var fetch = function fetch(url, callback) {
+  var req = new XMLHttpRequest();
+  req.open('GET', url, true);
+  req.responseType = 'arraybuffer';
+  req.setRequestHeader('Accept', MIME_TYPE + ', text/csv;q=0.5');
+  req.onload = function onload() {
+    var type = req.getResponseHeader('Content-Type') || '';
+    if (req.status !== 200 || type.indexOf(MIME_TYPE) !== 0) {
+      callback(null, req);
+      return;
+    }
+    callback(decode(req.response));
+  };
+  req.onerror = function onerror() {
+    callback(null, req);
+  };
+  req.send(null);
+};
+
+Dygraph.Columnar = {
+  MIME_TYPE: MIME_TYPE,
+  columns: columns,
+  decode: decode,
+  fetch: fetch
+};
+
+/* closure and loader wrapper */
+Dygraph._require.add('dygraphs/src/extras/columnar.js', /* exports */ {});
+})();